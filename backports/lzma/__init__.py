@@ -17,22 +17,32 @@ __all__ = [
     "MF_HC3", "MF_HC4", "MF_BT2", "MF_BT3", "MF_BT4",
     "MODE_FAST", "MODE_NORMAL", "PRESET_DEFAULT", "PRESET_EXTREME",
 
-    "LZMACompressor", "LZMADecompressor", "LZMAFile", "LZMAError",
-    "open", "compress", "decompress", "is_check_supported",
+    "LZMACompressor", "LZMADecompressor", "LZMAFile", "LZMAError", "XZIndex",
+    "BlockCache", "LineIndex",
+    "open", "compress", "decompress", "parallel_decompress",
+    "compress_many", "decompress_many", "build_preset_dict",
+    "iter_compress", "iter_decompress",
+    "is_check_supported",
 ]
 
-try:
-    #Python 3
-    import builtins
-except ImportError:
-    #Python 2
-    import __builtin__ as builtins
+import bisect
+import collections
+import hashlib
+import heapq
 import io
 import os.path
-import subprocess
+import struct
+import sys
+import threading
+import time
 import warnings
+from array import array
+from collections import namedtuple
 from ._lzma import *
 from ._lzma import _encode_filter_properties, _decode_filter_properties
+from ._lzma import _decode_stream_footer, _decode_index
+from ._lzma import _merge_indexes, _encode_stream_footer, _decompress_sized
+from ._lzma import _compress_buffer, _compress_many, _decompress_many
 
 
 _MODE_CLOSED   = 0
@@ -41,10 +51,771 @@ _MODE_READ_EOF = 2
 _MODE_WRITE    = 3
 
 _BUFFER_SIZE = 8192
+# The most data LZMAFile decompresses ahead of the reader at once.
+_READAHEAD_SIZE = 8 * _BUFFER_SIZE
+
+# When LZMAFile adapts its read size, it times this many reads at each
+# size, and keeps doubling the size while that speeds reading up by at
+# least _ADAPT_GAIN.
+_ADAPT_READS = 8
+_ADAPT_GAIN = 1.1
+
+_clock = getattr(time, "perf_counter", time.time)
 
 
 __version__ = "0.0.2a"
 
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+
+try:
+    array("Q")
+    _INDEX_TYPECODE = "Q"
+except ValueError:
+    # Python 2 has no typecode for unsigned long long.
+    _INDEX_TYPECODE = "L"
+
+
+if hasattr(array, "tobytes"):
+    def _array_tobytes(a):
+        return a.tobytes()
+
+    def _array_frombytes(a, data):
+        a.frombytes(data)
+else:
+    # Python 2 names these methods after str.
+    def _array_tobytes(a):
+        return a.tostring()
+
+    def _array_frombytes(a, data):
+        a.fromstring(data)
+
+
+class XZIndex(object):
+
+    """The block table of an .xz file.
+
+    An XZIndex describes where every block of every stream in a file
+    starts and ends, both in the compressed file and in the decompressed
+    data. It is built from the indexes stored in the file itself, so
+    nothing needs to be decompressed to obtain it.
+
+    The table is stored column-wise in arrays, using 8 bytes per value,
+    and looking up the block holding an uncompressed offset takes
+    O(log n) time.
+
+    Iterating over an XZIndex yields XZIndex.Block tuples, in file order.
+    """
+
+    Block = namedtuple("Block", "number stream compressed_offset "
+                       "uncompressed_offset compressed_size uncompressed_size")
+
+    Stream = namedtuple("Stream", "number compressed_offset compressed_size "
+                        "padding uncompressed_offset uncompressed_size "
+                        "check first_block block_count")
+
+    # Layout of tobytes(): a header, then the raw contents of each column.
+    _HEADER = struct.Struct("<4sBcQQQQ")
+    _MAGIC = b"XZIx"
+    _BLOCK_COLUMNS = ("_c_offsets", "_u_offsets", "_c_sizes", "_u_sizes")
+    _STREAM_COLUMNS = ("_s_offsets", "_s_sizes", "_s_padding", "_s_u_offsets",
+                       "_s_index_offsets", "_s_first_blocks", "_s_checks")
+
+    def __init__(self):
+        # One entry per block. compressed_size includes the block header,
+        # block padding and check.
+        self._c_offsets = array(_INDEX_TYPECODE)
+        self._u_offsets = array(_INDEX_TYPECODE)
+        self._c_sizes = array(_INDEX_TYPECODE)
+        self._u_sizes = array(_INDEX_TYPECODE)
+        # One entry per stream. A stream's index starts where its last
+        # block ends.
+        self._s_offsets = array(_INDEX_TYPECODE)
+        self._s_sizes = array(_INDEX_TYPECODE)
+        self._s_padding = array(_INDEX_TYPECODE)
+        self._s_u_offsets = array(_INDEX_TYPECODE)
+        self._s_index_offsets = array(_INDEX_TYPECODE)
+        self._s_first_blocks = array(_INDEX_TYPECODE)
+        self._s_checks = array("B")
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+
+    @classmethod
+    def from_file(cls, fp):
+        """Read the block table of a seekable .xz file object.
+
+        The file is walked backwards from its end, one stream at a time:
+        for each stream, only the footer and the index are read, so the
+        cost does not depend on the size of the compressed data.
+
+        Raises LZMAError if fp does not contain a sequence of .xz streams.
+        """
+        fp.seek(0, 2)
+        pos = fp.tell()
+        padding = 0
+        streams = []
+        while pos > 0:
+            if pos < 2 * STREAM_HEADER_SIZE:
+                raise LZMAError("Truncated stream")
+            fp.seek(pos - STREAM_HEADER_SIZE)
+            footer = fp.read(STREAM_HEADER_SIZE)
+            if footer[-4:] == b"\x00\x00\x00\x00":
+                # Stream padding - always a multiple of four null bytes.
+                pos -= 4
+                padding += 4
+                continue
+            backward_size, check = _decode_stream_footer(footer)
+            index_offset = pos - STREAM_HEADER_SIZE - backward_size
+            if index_offset < STREAM_HEADER_SIZE:
+                raise LZMAError("Corrupt input data")
+            fp.seek(index_offset)
+            stream_size, uncompressed_size, blocks = \
+                _decode_index(fp.read(backward_size))
+            if stream_size > pos:
+                raise LZMAError("Corrupt input data")
+            pos -= stream_size
+            streams.append((pos, stream_size, padding, check, index_offset,
+                            uncompressed_size, blocks))
+            padding = 0
+        if padding:
+            raise LZMAError("Input format not supported by decoder")
+
+        index = cls()
+        for stream in reversed(streams):
+            index._append_stream(*stream)
+        return index
+
+    def tobytes(self):
+        """Serialize the index to a bytes object.
+
+        The result can be turned back into an XZIndex by frombytes(), on
+        any machine with the same byte order.
+        """
+        byteorder = b"<" if sys.byteorder == "little" else b">"
+        header = self._HEADER.pack(self._MAGIC, self._c_offsets.itemsize,
+                                   byteorder, len(self._c_offsets),
+                                   len(self._s_offsets),
+                                   self.uncompressed_size,
+                                   self.compressed_size)
+        columns = [_array_tobytes(getattr(self, name))
+                   for name in self._BLOCK_COLUMNS + self._STREAM_COLUMNS]
+        return header + b"".join(columns)
+
+    @classmethod
+    def frombytes(cls, data):
+        """Rebuild an XZIndex from the output of tobytes().
+
+        Raises ValueError if data is not a valid serialized index.
+        """
+        index = cls()
+        if len(data) < cls._HEADER.size:
+            raise ValueError("Serialized index is truncated")
+        (magic, itemsize, byteorder, block_count, stream_count,
+         uncompressed_size, compressed_size) = \
+            cls._HEADER.unpack_from(data)
+        if (magic != cls._MAGIC or
+            itemsize != index._c_offsets.itemsize or
+            byteorder != (b"<" if sys.byteorder == "little" else b">")):
+            raise ValueError("Serialized index has an incompatible format")
+        pos = cls._HEADER.size
+        for names, count in ((cls._BLOCK_COLUMNS, block_count),
+                             (cls._STREAM_COLUMNS, stream_count)):
+            for name in names:
+                column = getattr(index, name)
+                size = count * column.itemsize
+                if pos + size > len(data):
+                    raise ValueError("Serialized index is truncated")
+                _array_frombytes(column, data[pos:pos + size])
+                pos += size
+        if pos != len(data):
+            raise ValueError("Serialized index has trailing data")
+        index.uncompressed_size = uncompressed_size
+        index.compressed_size = compressed_size
+        return index
+
+    def _append_stream(self, offset, size, padding, check, index_offset,
+                       uncompressed_size, blocks):
+        # blocks are given as (compressed_offset, uncompressed_offset,
+        # compressed_size, uncompressed_size) tuples, relative to the start
+        # of the stream, as returned by _decode_index().
+        self._s_offsets.append(offset)
+        self._s_sizes.append(size)
+        self._s_padding.append(padding)
+        self._s_u_offsets.append(self.uncompressed_size)
+        self._s_index_offsets.append(index_offset)
+        self._s_first_blocks.append(len(self._c_offsets))
+        self._s_checks.append(check)
+        for c_off, u_off, c_size, u_size in blocks:
+            self._c_offsets.append(offset + c_off)
+            self._u_offsets.append(self.uncompressed_size + u_off)
+            self._c_sizes.append(c_size)
+            self._u_sizes.append(u_size)
+        self.uncompressed_size += uncompressed_size
+        self.compressed_size = offset + size + padding
+
+    def __len__(self):
+        return len(self._c_offsets)
+
+    def __iter__(self):
+        for i in range(len(self._c_offsets)):
+            yield self.block(i)
+
+    @property
+    def block_count(self):
+        """Number of blocks in the file."""
+        return len(self._c_offsets)
+
+    @property
+    def stream_count(self):
+        """Number of streams in the file."""
+        return len(self._s_offsets)
+
+    def block(self, number):
+        """Return the XZIndex.Block tuple describing a block."""
+        if number < 0:
+            number += len(self._c_offsets)
+        if not 0 <= number < len(self._c_offsets):
+            raise IndexError("Block number out of range")
+        return self.Block(number, self._stream_of(number),
+                          self._c_offsets[number], self._u_offsets[number],
+                          self._c_sizes[number], self._u_sizes[number])
+
+    def streams(self):
+        """Iterate over the streams in the file, as XZIndex.Stream tuples."""
+        for i in range(len(self._s_offsets)):
+            if i + 1 < len(self._s_offsets):
+                block_count = self._s_first_blocks[i + 1]
+            else:
+                block_count = len(self._c_offsets)
+            block_count -= self._s_first_blocks[i]
+            if i + 1 < len(self._s_u_offsets):
+                uncompressed_size = self._s_u_offsets[i + 1]
+            else:
+                uncompressed_size = self.uncompressed_size
+            uncompressed_size -= self._s_u_offsets[i]
+            yield self.Stream(i, self._s_offsets[i], self._s_sizes[i],
+                              self._s_padding[i], self._s_u_offsets[i],
+                              uncompressed_size, self._s_checks[i],
+                              self._s_first_blocks[i], block_count)
+
+    def locate(self, uncompressed_offset):
+        """Return the number of the block holding uncompressed_offset.
+
+        Offsets at or past the end of the data map to the last block.
+        Raises ValueError if the file has no blocks, or the offset is
+        negative.
+        """
+        if uncompressed_offset < 0:
+            raise ValueError("Offset must not be negative")
+        if not self._u_offsets:
+            raise ValueError("No blocks to locate offset in")
+        return bisect.bisect_right(self._u_offsets, uncompressed_offset) - 1
+
+    # Return the number of the stream holding a block.
+    def _stream_of(self, block):
+        return bisect.bisect_right(self._s_first_blocks, block) - 1
+
+    # Return the number of the first stream starting at or after a
+    # compressed offset, or None if there is none.
+    def _stream_at_or_after(self, compressed_offset):
+        i = bisect.bisect_left(self._s_offsets, compressed_offset)
+        if i == len(self._s_offsets):
+            return None
+        return i
+
+
+# Index cache files hold a header identifying the indexed file, its path,
+# and then the output of XZIndex.tobytes().
+_CACHE_HEADER = struct.Struct("<8sQd12sH")
+_CACHE_MAGIC = b"XZIcache"
+_CACHE_SUFFIX = ".xzidx"
+_LINE_CACHE_SUFFIX = ".xzlines"
+
+
+def _index_cache_path(filename, index_cache, suffix=_CACHE_SUFFIX):
+    # index_cache is True for a sidecar file next to filename, or the name
+    # of a directory holding cache files named after a hash of the path.
+    if index_cache is True:
+        if isinstance(filename, bytes):
+            return filename + suffix.encode("ascii")
+        return filename + suffix
+    digest = hashlib.sha1(_encode_filename(filename)).hexdigest()
+    return os.path.join(index_cache, digest + suffix)
+
+
+def _encode_filename(filename):
+    if isinstance(filename, bytes):
+        return filename
+    if hasattr(os, "fsencode"):
+        return os.fsencode(filename)
+    return filename.encode("utf-8")
+
+
+def _index_cache_key(fp, filename):
+    # Identify the file by its path, size and mtime, and by its last
+    # bytes - which include the CRC32 of the final stream footer.
+    st = os.fstat(fp.fileno())
+    fp.seek(max(st.st_size - STREAM_HEADER_SIZE, 0), 0)
+    # fp may be a _MemoryFile, whose read() returns a memoryview.
+    tail = memoryview(fp.read(STREAM_HEADER_SIZE)).tobytes()
+    path = _encode_filename(filename)
+    return _CACHE_HEADER.pack(_CACHE_MAGIC, st.st_size, st.st_mtime,
+                              tail, len(path)) + path
+
+
+def _load_cached_index(cache_path, key, cls=XZIndex):
+    try:
+        with io.open(cache_path, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if not data.startswith(key):
+        return None
+    try:
+        return cls.frombytes(data[len(key):])
+    except ValueError:
+        return None
+
+
+def _save_cached_index(cache_path, key, index):
+    # Write to a temporary file first, so that concurrent readers never
+    # see a partial cache file. Failing to write the cache isn't an error.
+    suffix = ".%d.tmp" % os.getpid()
+    if isinstance(cache_path, bytes):
+        suffix = suffix.encode("ascii")
+    tmp_path = cache_path + suffix
+    try:
+        with io.open(tmp_path, "wb") as f:
+            f.write(key + index.tobytes())
+        getattr(os, "replace", os.rename)(tmp_path, cache_path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except (IOError, OSError):
+            pass
+
+
+# multiprocessing is imported on demand, as it is slow to import and only
+# needed for parallel (de)compression. Threads are enough for parallelism,
+# since liblzma runs with the GIL released.
+
+def _cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def _thread_pool(workers):
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(workers)
+
+
+def _decompress_block(header, block, uncompressed_size):
+    # Decompress a single block, by feeding a decompressor the header of
+    # the block's stream followed by the block itself.
+    decomp = LZMADecompressor(FORMAT_XZ)
+    decomp.decompress(header)
+    data = decomp.decompress(block)
+    if len(data) != uncompressed_size:
+        raise LZMAError("Corrupt input data")
+    return data
+
+
+def _decompress_blocks(fp, index, first_block, pool, readahead,
+                       cache=None, file_id=None):
+    """Yield the decompressed contents of blocks of an indexed .xz file.
+
+    Blocks are yielded in order, from first_block to the end of the file.
+    The compressed blocks are read from fp by the calling thread, and up
+    to readahead of them are decompressed at once in pool. If cache is
+    a BlockCache, blocks are looked up in it under file_id first, and
+    the ones decompressed are added to it.
+    """
+    headers = {}
+    pending = collections.deque()
+    block = first_block
+    while block < len(index) or pending:
+        while block < len(index) and len(pending) < readahead:
+            if cache is not None:
+                data = cache._get((file_id, block))
+                if data is not None:
+                    pending.append((block, data))
+                    block += 1
+                    continue
+            stream = index._stream_of(block)
+            if stream not in headers:
+                fp.seek(index._s_offsets[stream], 0)
+                headers[stream] = fp.read(STREAM_HEADER_SIZE)
+            fp.seek(index._c_offsets[block], 0)
+            data = fp.read(index._c_sizes[block])
+            if len(data) < index._c_sizes[block]:
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+            pending.append((block, pool.apply_async(
+                _decompress_block,
+                (headers[stream], data, index._u_sizes[block]))))
+            block += 1
+        number, result = pending.popleft()
+        if isinstance(result, bytes):
+            yield result
+            continue
+        data = result.get()
+        if cache is not None:
+            cache._put((file_id, number), data)
+        yield data
+
+
+def _byte_view(b):
+    # Return a flat memoryview of the bytes of a buffer, whatever its format.
+    view = memoryview(b)
+    if view.ndim != 1 or view.format != "B":
+        if not hasattr(view, "cast"):
+            # Python 2's memoryview cannot be cast, so only buffers of
+            # bytes (such as bytearray) are supported there.
+            raise TypeError("a buffer of bytes is required")
+        view = view.cast("B")
+    return view
+
+
+class _MemoryFile(object):
+
+    # A read-only, seekable file object over a buffer (such as an mmap),
+    # whose read() returns memoryview slices of the buffer rather than
+    # copies of the data. fp is the file the buffer maps, if any; it is
+    # closed along with the _MemoryFile.
+
+    def __init__(self, data, fp=None):
+        self._data = data
+        self._fp = fp
+        try:
+            self._view = memoryview(data)
+        except TypeError:
+            # Python 2's mmap objects only have the old buffer interface,
+            # so slicing them has to copy the data.
+            self._view = data
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = min(self._pos, len(self._view))
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % (offset,))
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    # Return up to size bytes from offset, without moving the position.
+    def pread(self, offset, size):
+        return self._view[offset:offset + size]
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        if self._fp is None:
+            raise io.UnsupportedOperation("fileno")
+        return self._fp.fileno()
+
+    def close(self):
+        if self._view is None:
+            return
+        if isinstance(self._view, memoryview) and \
+                hasattr(self._view, "release"):
+            self._view.release()
+        self._view = None
+        try:
+            if hasattr(self._data, "close"):
+                self._data.close()
+        except BufferError:
+            # Slices of the mapping are still in use somewhere; it will be
+            # unmapped once the last of them is freed.
+            pass
+        finally:
+            self._data = None
+            if self._fp is not None:
+                self._fp.close()
+
+
+def _map_file(fp):
+    # Map the whole of the file fp into memory, for reading. Empty files
+    # can't be mapped, and are returned as they are.
+    import mmap
+    try:
+        mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        if os.fstat(fp.fileno()).st_size:
+            raise
+        return fp
+    return _MemoryFile(mapping, fp)
+
+
+def _index_from_stream_tail(tail):
+    # Build the block table of a single .xz stream from its final bytes,
+    # which must hold the whole of its index and its footer - as the data
+    # returned by LZMACompressor.flush() does.
+    backward_size, check = _decode_stream_footer(tail[-STREAM_HEADER_SIZE:])
+    index_end = len(tail) - STREAM_HEADER_SIZE
+    stream_size, uncompressed_size, blocks = \
+        _decode_index(tail[index_end - backward_size:index_end])
+    index = XZIndex()
+    index._append_stream(0, stream_size, 0, check,
+                         stream_size - STREAM_HEADER_SIZE - backward_size,
+                         uncompressed_size, blocks)
+    return index
+
+
+class BlockCache(object):
+
+    """A cache of decompressed blocks of .xz files, with a memory budget.
+
+    A BlockCache can be shared by any number of LZMAFile objects, in any
+    number of threads, by passing it as their block_cache argument. Blocks
+    of named files are cached under the identity of the file on disk, so
+    files opened more than once share their cached blocks.
+
+    Once the cached blocks take up more than max_bytes, the least recently
+    used ones are evicted. Blocks larger than max_bytes are not cached.
+
+    The hits and misses attributes count the lookups that found a block
+    in the cache and those that had to decompress it.
+    """
+
+    def __init__(self, max_bytes):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must not be negative")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    @property
+    def size(self):
+        """Total size of the cached blocks, in bytes."""
+        return self._size
+
+    def clear(self):
+        """Remove all blocks from the cache, and reset the counters."""
+        with self._lock:
+            self._blocks.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # Re-insert the block to mark it as the most recently used.
+            self._blocks[key] = data
+            self.hits += 1
+            return data
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._blocks[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                evicted = self._blocks.popitem(last=False)[1]
+                self._size -= len(evicted)
+
+
+def _count_lines(data, interval):
+    # Count the line ends in data, and find the offsets just past every
+    # interval-th of them. Also returns whether data ends with a line end.
+    checkpoints = []
+    if interval:
+        pos = n = 0
+        while True:
+            pos = data.find(b"\n", pos) + 1
+            if not pos:
+                break
+            n += 1
+            if n == interval:
+                checkpoints.append(pos)
+                n = 0
+    return data.count(b"\n"), checkpoints, data.endswith(b"\n")
+
+
+class LineIndex(object):
+
+    """The line table of a text .xz file, built on top of its XZIndex.
+
+    A LineIndex records how many lines end in each block of the file and,
+    if checkpoint_interval is not 0, where every checkpoint_interval-th
+    line end in each block is. LZMAFile.seek_line() uses it to find the
+    start of a line by decompressing only the block that holds it. A
+    block can only be decoded from its start, so checkpoints do not save
+    any decompression; they only save counting the line ends in the
+    decompressed data before the line, from the last checkpoint on
+    rather than from the start of the block. That counting is cheap next
+    to decompression, so checkpoints are rarely worth their space.
+
+    Lines end with b"\\n", and are numbered from 0. line_count is the
+    number of lines in the file.
+    """
+
+    # Layout of tobytes(): a header, then the raw contents of each column.
+    _HEADER = struct.Struct("<4sBcQQQQ")
+    _MAGIC = b"XZLn"
+    _COLUMNS = ("_block_lines", "_block_checkpoints", "_checkpoints")
+
+    def __init__(self, checkpoint_interval=0):
+        # One entry per block, plus one for the end of the file: the number
+        # of lines ending before the block, and the position in
+        # _checkpoints of the block's first checkpoint. Checkpoints are
+        # offsets in their block, just past a line end.
+        self._block_lines = array(_INDEX_TYPECODE)
+        self._block_checkpoints = array(_INDEX_TYPECODE)
+        self._checkpoints = array(_INDEX_TYPECODE)
+        self.checkpoint_interval = checkpoint_interval
+        self.line_count = 0
+
+    @classmethod
+    def from_file(cls, f, checkpoint_interval=0, workers=None):
+        """Build the line table of a seekable .xz LZMAFile open for reading.
+
+        The blocks of the file are decompressed in parallel by workers
+        threads (by default, one per CPU), without changing the file
+        position of f.
+        """
+        if checkpoint_interval < 0:
+            raise ValueError("checkpoint_interval must not be negative")
+        index = f.index
+        if index is None:
+            raise io.UnsupportedOperation("Line indexes require an "
+                                          "indexed .xz file")
+        count = lambda block: _count_lines(f._block_data(block),
+                                           checkpoint_interval)
+        blocks = range(len(index))
+        if workers is None:
+            workers = _cpu_count()
+        if workers > 1 and len(index) > 1:
+            pool = _thread_pool(workers)
+            try:
+                results = pool.map(count, blocks)
+            finally:
+                pool.terminate()
+        else:
+            results = [count(block) for block in blocks]
+
+        lines = cls(checkpoint_interval)
+        lines._block_lines.append(0)
+        lines._block_checkpoints.append(0)
+        partial = False
+        for block, (newlines, checkpoints, ends_line) in enumerate(results):
+            lines._block_lines.append(lines._block_lines[-1] + newlines)
+            lines._checkpoints.extend(checkpoints)
+            lines._block_checkpoints.append(len(lines._checkpoints))
+            if index._u_sizes[block]:
+                partial = not ends_line
+        lines.line_count = lines._block_lines[-1] + partial
+        return lines
+
+    def tobytes(self):
+        """Serialize the line table to a bytes object.
+
+        The result can be turned back into a LineIndex by frombytes(), on
+        any machine with the same byte order.
+        """
+        byteorder = b"<" if sys.byteorder == "little" else b">"
+        header = self._HEADER.pack(self._MAGIC, self._checkpoints.itemsize,
+                                   byteorder, len(self._block_lines),
+                                   len(self._checkpoints),
+                                   self.checkpoint_interval, self.line_count)
+        columns = [_array_tobytes(getattr(self, name))
+                   for name in self._COLUMNS]
+        return header + b"".join(columns)
+
+    @classmethod
+    def frombytes(cls, data):
+        """Rebuild a LineIndex from the output of tobytes().
+
+        Raises ValueError if data is not a valid serialized line table.
+        """
+        if len(data) < cls._HEADER.size:
+            raise ValueError("Serialized line index is truncated")
+        (magic, itemsize, byteorder, block_count, checkpoint_count,
+         checkpoint_interval, line_count) = cls._HEADER.unpack_from(data)
+        lines = cls(checkpoint_interval)
+        if (magic != cls._MAGIC or
+            itemsize != lines._checkpoints.itemsize or
+            byteorder != (b"<" if sys.byteorder == "little" else b">")):
+            raise ValueError("Serialized line index has an incompatible "
+                             "format")
+        pos = cls._HEADER.size
+        for name, count in zip(cls._COLUMNS, (block_count, block_count,
+                                              checkpoint_count)):
+            size = count * itemsize
+            if pos + size > len(data):
+                raise ValueError("Serialized line index is truncated")
+            _array_frombytes(getattr(lines, name), data[pos:pos + size])
+            pos += size
+        if pos != len(data):
+            raise ValueError("Serialized line index has trailing data")
+        lines.line_count = line_count
+        return lines
+
+    # Return the block holding the start of line n, which must be between
+    # 1 and the number of line ends; the offset in the block of the last
+    # checkpoint before the line (or 0); and the number of line ends
+    # from there to the start of the line.
+    def _locate(self, n):
+        block = bisect.bisect_left(self._block_lines, n) - 1
+        skip = n - self._block_lines[block]
+        offset = 0
+        if self.checkpoint_interval:
+            checkpoint = skip // self.checkpoint_interval
+            if checkpoint:
+                offset = self._checkpoints[self._block_checkpoints[block] +
+                                           checkpoint - 1]
+                skip -= checkpoint * self.checkpoint_interval
+        return block, offset, skip
+
+
+def _split_lines(buf, start):
+    # Split the whole lines of buf from start, for LZMAFile.__next__().
+    # Returns [buf, start, lines], with the lines in reverse order, or
+    # None if there are none.
+    end = buf.rfind(b"\n", start) + 1
+    if end <= start:
+        return None
+    chunk = buf[start:end]
+    if b"\r" in chunk:
+        # splitlines() would split at these too.
+        lines = [line + b"\n" for line in chunk[:-1].split(b"\n")]
+    else:
+        lines = chunk.splitlines(True)
+    lines.reverse()
+    return [buf, start, lines]
+
+
 class LZMAFile(io.BufferedIOBase):
 
     """A file object providing transparent LZMA (de)compression.
@@ -57,7 +828,10 @@ class LZMAFile(io.BufferedIOBase):
     """
 
     def __init__(self, filename=None, mode="r",
-                 format=None, check=-1, preset=None, filters=None):
+                 format=None, check=-1, preset=None, filters=None,
+                 index_cache=None, threads=1, block_size=0,
+                 buffer_size=None, max_buffer_size=None, mmap=False,
+                 block_cache=None):
         """Open an LZMA-compressed file in binary mode.
 
         filename can be either an actual file name (given as a str or
@@ -98,12 +872,65 @@ class LZMAFile(io.BufferedIOBase):
         filters (if provided) should be a sequence of dicts. Each dict
         should have an entry for "id" indicating ID of the filter, plus
         additional entries for options to the filter.
+
+        index_cache enables caching of the file's block table, when
+        reading a named file. If True, the table is saved in a sidecar
+        file next to the compressed file (named after it, with the suffix
+        ".xzidx"); if a directory name, the table is saved in that
+        directory. Cached tables are checked against the file's path,
+        size, modification time and final stream footer, and are rebuilt
+        when the file has changed. The file's line index, once built, is
+        cached in the same way (with the suffix ".xzlines").
+
+        threads sets the number of threads used, or 0 for one per CPU
+        core. When reading, if threads is not 1 and the file is a seekable
+        .xz file, its blocks are decompressed in parallel by a pool of
+        threads. Otherwise, if format is FORMAT_XZ, threads is passed to
+        the LZMADecompressor, which decompresses multi-block streams in
+        parallel as they are read. When
+        writing, threads and block_size are passed to the LZMACompressor;
+        block_size cannot be used when reading.
+
+        Giving block_size when writing a FORMAT_XZ file splits the data
+        into independent blocks of block_size uncompressed bytes, so that
+        the file can later be read from any block without decompressing
+        the ones before it. Once the file is closed, the index attribute
+        holds the block table of the stream written.
+
+        buffer_size sets how many compressed bytes are read from the
+        underlying file at a time when reading (8192 by default). If
+        max_buffer_size is also given, the read size adapts to the file:
+        it is doubled while that makes reading faster, up to at most
+        max_buffer_size bytes. Up to 8 times the read size is
+        decompressed ahead of the reader. Neither argument can be used
+        when writing.
+
+        If mmap is true, a named file opened for reading is mapped into
+        memory, and the decompressor is fed straight from the mapping
+        instead of from copies of the file's contents.
+
+        block_cache, if given, is a BlockCache holding decompressed blocks
+        of .xz files. When reading a seekable .xz file, read(), seek()
+        and pread() decompress whole blocks, looking them up in the cache
+        first and adding the ones decompressed to it.
         """
         self._fp = None
         self._closefp = False
         self._mode = _MODE_CLOSED
         self._pos = 0
         self._size = -1
+        self._index = None
+        self._blocks_end = None
+        self._dont_read_past = None
+        self._pool = None
+        self._blocks = None
+        self._pread_fd = None
+        self._pread_lock = threading.Lock()
+        self._pread_headers = {}
+        self._block_cache = None
+        self._cache_id = None
+        self._index_cache = None
+        self._line_index = None
 
         if mode in ("r", "rb"):
             if check != -1:
@@ -112,21 +939,52 @@ class LZMAFile(io.BufferedIOBase):
             if preset is not None:
                 raise ValueError("Cannot specify a preset compression "
                                  "level when opening a file for reading")
+            if block_size:
+                raise ValueError("Cannot specify a block size "
+                                 "when opening a file for reading")
             if format is None:
                 format = FORMAT_AUTO
+            if buffer_size is None:
+                buffer_size = _BUFFER_SIZE
+            elif buffer_size <= 0:
+                raise ValueError("buffer_size must be positive")
+            if max_buffer_size is None:
+                max_buffer_size = buffer_size
+            elif max_buffer_size < buffer_size:
+                raise ValueError("max_buffer_size must not be less "
+                                 "than buffer_size")
+            self._max_read_size = max_buffer_size
+            self._set_read_size(buffer_size)
+            self._adapt_start = None
+            self._adapt_rate = 0
             mode_code = _MODE_READ
             # Save the args to pass to the LZMADecompressor initializer.
             # If the file contains multiple compressed streams, each
             # stream will need a separate decompressor object.
             self._init_args = {"format":format, "filters":filters}
             self._decompressor = LZMADecompressor(**self._init_args)
-            self._buffer = None
+            self._buffer = b""
+            self._buffer_offset = 0
+            # Lines split from the buffer by __next__(), yet to be returned.
+            self._split = None
         elif mode in ("w", "wb", "a", "ab"):
+            if buffer_size is not None or max_buffer_size is not None:
+                raise ValueError("Cannot specify a buffer size "
+                                 "when opening a file for writing")
+            if mmap:
+                raise ValueError("Cannot memory-map a file "
+                                 "opened for writing")
+            if block_cache is not None:
+                raise ValueError("Cannot use a block cache "
+                                 "when opening a file for writing")
             if format is None:
                 format = FORMAT_XZ
             mode_code = _MODE_WRITE
+            self._write_format = format
             self._compressor = LZMACompressor(format=format, check=check,
-                                              preset=preset, filters=filters)
+                                              preset=preset, filters=filters,
+                                              threads=threads,
+                                              block_size=block_size)
         else:
             raise ValueError("Invalid mode: {!r}".format(mode))
 
@@ -134,54 +992,109 @@ class LZMAFile(io.BufferedIOBase):
             if "b" not in mode:
                 mode += "b"
             self._fp = io.open(filename, mode)
+            if mmap:
+                self._fp = _map_file(self._fp)
+            elif mode_code == _MODE_READ and hasattr(os, "pread"):
+                self._pread_fd = self._fp.fileno()
             self._filename = os.path.abspath(filename)
-            # offsets in decompressed stream -> offsets in compressed stream
-            self._seek_offsets = None
-            self._get_seek_offsets()
             self._closefp = True
             self._mode = mode_code
+            self._index_cache = index_cache
+            if mode_code == _MODE_READ and format in (FORMAT_AUTO, FORMAT_XZ):
+                self._read_index(index_cache)
         elif hasattr(filename, "read") or hasattr(filename, "write"):
+            if mmap:
+                raise ValueError("mmap can only be used with a file name")
             self._fp = filename
-            self._seek_offsets = None
             self._filename = None
-            self._dont_read_past = None
             self._mode = mode_code
         else:
             raise TypeError("filename must be a str or bytes object, or a file")
 
+        if (mode_code == _MODE_READ and threads != 1 and
+            format in (FORMAT_AUTO, FORMAT_XZ) and self._fp.seekable()):
+            if threads == 0:
+                threads = _cpu_count()
+            if self._index is None:
+                self._read_index()
+            if self._index is not None:
+                self._pool = _thread_pool(threads)
+                self._readahead = 2 * threads
+        if (mode_code == _MODE_READ and block_cache is not None and
+            format in (FORMAT_AUTO, FORMAT_XZ) and self._fp.seekable()):
+            if self._index is None:
+                self._read_index()
+            if self._index is not None:
+                self._block_cache = block_cache
+                self._cache_id = self._file_identity()
+        if self._pool is not None or self._block_cache is not None:
+            self._blocks = self._iter_blocks(0)
+        if (mode_code == _MODE_READ and threads != 1 and
+            format == FORMAT_XZ and self._pool is None):
+            self._init_args["threads"] = threads
+            self._decompressor = LZMADecompressor(**self._init_args)
+
+    @property
+    def index(self):
+        """The XZIndex describing the blocks of the file.
+
+        This is None if the file is not an .xz file, or its index could
+        not be read.
+
+        For a file opened for writing in FORMAT_XZ, this is only available
+        once the file is closed, and describes the stream written to it;
+        compressed offsets are relative to the start of that stream.
+        """
+        if self._mode == _MODE_CLOSED and self._index is not None:
+            return self._index
+        self._check_can_seek()
+        if self._index is None:
+            self._read_index()
+        return self._index
+
     def seek_offsets(self):
         """Returns byte offsets it's cheap to seek to"""
-        if not self._seek_offsets:
-            self._get_seek_offsets()
-        return sorted(self._seek_offsets.keys())
-
-    def _get_seek_offsets(self):
-        if not self._filename:
-            raise ValueError("filename must be a str or bytes object, not a file object")
+        index = self.index
+        if index is None:
+            return []
+        return sorted(set(index._u_offsets))
+
+    def _read_index(self, index_cache=None):
+        # Build the seek table from the indexes stored in the file itself.
+        # Files that don't start with an .xz stream (such as FORMAT_ALONE
+        # data) simply aren't indexed.
+        self._index = None
+        self._blocks_end = None
+        self._dont_read_past = None
+        saved_pos = self._fp.tell()
         try:
-            with builtins.open(os.devnull, 'w') as NULL:
-                xz_args = ['--list','--verbose','--robot']
-                xz_raw = subprocess.check_output(['xz'] + xz_args + [self._filename],
-                                                  stderr=NULL)
-                xz_list = xz_raw.split("\n")
-        except:
-            warnings.warn("LZMAFile: can't _get_seek_offsets, is this an xz file? "
-                          "is the file gone? is xz on your PATH?")
-            self._seek_offsets = None
+            index = None
+            if index_cache:
+                cache_path = _index_cache_path(self._filename, index_cache)
+                cache_key = _index_cache_key(self._fp, self._filename)
+                index = _load_cached_index(cache_path, cache_key)
+            if index is None:
+                self._fp.seek(0, 0)
+                if self._fp.read(len(_XZ_MAGIC)) != _XZ_MAGIC:
+                    return
+                index = XZIndex.from_file(self._fp)
+                if index_cache:
+                    _save_cached_index(cache_path, cache_key, index)
+        except (LZMAError, ValueError):
+            warnings.warn("LZMAFile: can't read the index, "
+                          "the xz index is missing or corrupt")
+            return
+        finally:
+            self._fp.seek(saved_pos, 0)
+        if not index:
             return
-        # TODO support multiple streams: save stream_offsets
-        stream_descriptions = [line.split("\t") for line in xz_list if line.startswith("stream\t")]
-        assert int(stream_descriptions[0][3]) == 0, "First stream doesn't start at 0?"
-        STREAM_NUMBER, BLOCK_NUMBER_IN_STREAM, BLOCK_NUMBER_IN_FILE, \
-            COMPRESSED_OFFSET, UNCOMPRESSED_OFFSET, \
-            COMPRESSED_BLOCK_SIZE, UNCOMPRESSED_BLOCK_SIZE, RATIO, INTEGRITY = range(1, 10)
-        block_descriptions = [line.split("\t") for line in xz_list if line.startswith("block\t")]
-        # TODO use bisect module for _seek_offsets
-        self._seek_offsets = {int(line[UNCOMPRESSED_OFFSET]): int(line[COMPRESSED_OFFSET]) \
-            for line in block_descriptions if line[STREAM_NUMBER] == '1'}
-        assert self._seek_offsets, ("Couldn't parse xz --list", xz_list)
-        self._dont_read_past = int(block_descriptions[-1][COMPRESSED_OFFSET]) + int(block_descriptions[-1][COMPRESSED_BLOCK_SIZE])
-        self._size = sum(int(line[UNCOMPRESSED_BLOCK_SIZE]) for line in block_descriptions)
+        self._index = index
+        # A decompressor re-synced by _rewind_to() never sees the index of
+        # its stream, so it has to be stopped at the end of the blocks.
+        last = index.block(-1)
+        self._blocks_end = self._dont_read_past = \
+            last.compressed_offset + last.compressed_size
+        self._size = index.uncompressed_size
 
     def close(self):
         """Flush and close the file.
@@ -195,9 +1108,16 @@ class LZMAFile(io.BufferedIOBase):
             if self._mode in (_MODE_READ, _MODE_READ_EOF):
                 self._decompressor = None
                 self._buffer = None
+                self._blocks = None
+                if self._pool is not None:
+                    self._pool.terminate()
+                    self._pool = None
             elif self._mode == _MODE_WRITE:
-                self._fp.write(self._compressor.flush())
+                tail = self._compressor.flush()
+                self._fp.write(tail)
                 self._compressor = None
+                if self._write_format == FORMAT_XZ:
+                    self._index = _index_from_stream_tail(tail)
         finally:
             try:
                 if self._closefp:
@@ -255,57 +1175,144 @@ class LZMAFile(io.BufferedIOBase):
 
     # Fill the readahead buffer if it is empty. Returns False on EOF.
     def _fill_buffer(self):
+        if self._blocks is not None:
+            return self._fill_buffer_from_blocks()
         # Depending on the input data, our call to the decompressor may not
         # return any data. In this case, try again after reading another block.
-        while True:
-            if self._buffer:
-                return True
+        while self._buffer_offset == len(self._buffer):
+            rawblock = self._next_input()
+            if rawblock is None:
+                return False
+            self._buffer = self._decompressor.decompress(
+                rawblock, self._readahead_size)
+            self._buffer_offset = 0
+        return True
+
+    # Return the next chunk of compressed data to give the decompressor,
+    # moving on to the next stream where needed, or None on EOF.
+    def _next_input(self):
+        if not (self._decompressor.eof or self._decompressor.needs_input):
+            # The decompressor still holds input from an earlier call.
+            return b""
 
-            if self._decompressor.unused_data:
-                rawblock = self._decompressor.unused_data
-            elif self._dont_read_past:
-                rawblock = self._fp.read(min(_BUFFER_SIZE, self._dont_read_past - self._fp.tell()))
-            else:
-                rawblock = self._fp.read(_BUFFER_SIZE)
+        if self._index is not None and (
+                self._decompressor.eof or
+                self._blocks_end != self._fp.tell() == self._dont_read_past):
+            # Use the index to move on to the next stream, which also
+            # skips any stream padding.
+            end = self._fp.tell() - len(self._decompressor.unused_data)
+            self._next_stream(end)
 
-            if not rawblock:
-                if self._decompressor.eof or self._fp.tell() == self._dont_read_past:
-                    self._mode = _MODE_READ_EOF
-                    self._size = self._pos
-                    return False
-                else:
-                    raise EOFError("Compressed file ended before the "
-                                   "end-of-stream marker was reached")
+        if self._decompressor.unused_data:
+            rawblock = self._decompressor.unused_data
+        else:
+            rawblock = self._read_raw()
 
-            # Continue to next stream.
-            if self._decompressor.eof:
-                self._decompressor = LZMADecompressor(**self._init_args)
+        if not rawblock:
+            if self._decompressor.eof or self._fp.tell() == self._dont_read_past:
+                self._mode = _MODE_READ_EOF
+                self._size = self._pos
+                return None
+            else:
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
 
-            self._buffer = self._decompressor.decompress(rawblock)
+        # Continue to next stream.
+        if self._decompressor.eof:
+            self._decompressor = LZMADecompressor(**self._init_args)
+        return rawblock
+
+    # Read the next chunk of compressed data from the file, stopping at
+    # _dont_read_past.
+    def _read_raw(self):
+        size = self._read_size
+        if self._dont_read_past:
+            size = min(size, self._dont_read_past - self._fp.tell())
+        rawblock = self._fp.read(size)
+        if self._read_size < self._max_read_size:
+            self._adapt_read_size(len(rawblock))
+        return rawblock
+
+    def _set_read_size(self, size):
+        self._read_size = size
+        self._readahead_size = max(_READAHEAD_SIZE, 8 * size)
+
+    # Time the reads made at the current read size, counting the time
+    # spent decompressing and consuming their data as well as reading it.
+    # After _ADAPT_READS reads, double the size if that was faster than
+    # the last size tried, or stop adapting if not.
+    def _adapt_read_size(self, nbytes):
+        now = _clock()
+        if self._adapt_start is not None:
+            if self._adapt_reads < _ADAPT_READS:
+                self._adapt_reads += 1
+                self._adapt_bytes += nbytes
+                return
+            elapsed = now - self._adapt_start
+            if elapsed > 0:
+                rate = self._adapt_bytes / elapsed
+                if rate < self._adapt_rate * _ADAPT_GAIN:
+                    self._max_read_size = self._read_size
+                    return
+                self._adapt_rate = rate
+            self._set_read_size(min(2 * self._read_size,
+                                    self._max_read_size))
+        self._adapt_start = now
+        self._adapt_reads = 1
+        self._adapt_bytes = nbytes
+
+    # Fill the readahead buffer with the next whole block decompressed by
+    # the thread pool. Returns False on EOF.
+    def _fill_buffer_from_blocks(self):
+        while self._buffer_offset == len(self._buffer):
+            try:
+                self._buffer = next(self._blocks)
+                self._buffer_offset = 0
+            except StopIteration:
+                self._mode = _MODE_READ_EOF
+                self._size = self._pos
+                return False
+        return True
 
     # Read data until EOF.
     # If return_data is false, consume the data without returning it.
     def _read_all(self, return_data=True):
+        # The loop assumes that _buffer_offset is 0. Ensure that this is true.
+        self._buffer = self._buffer[self._buffer_offset:]
+        self._buffer_offset = 0
+
         blocks = []
         while self._fill_buffer():
             if return_data:
                 blocks.append(self._buffer)
             self._pos += len(self._buffer)
-            self._buffer = None
+            self._buffer = b""
         if return_data:
             return b"".join(blocks)
 
     # Read a block of up to n bytes.
     # If return_data is false, consume the data without returning it.
     def _read_block(self, n, return_data=True):
+        # If we have enough data buffered, return immediately.
+        end = self._buffer_offset + n
+        if end <= len(self._buffer):
+            data = self._buffer[self._buffer_offset:end]
+            self._buffer_offset = end
+            self._pos += len(data)
+            return data if return_data else None
+
+        # The loop assumes that _buffer_offset is 0. Ensure that this is true.
+        self._buffer = self._buffer[self._buffer_offset:]
+        self._buffer_offset = 0
+
         blocks = []
         while n > 0 and self._fill_buffer():
             if n < len(self._buffer):
                 data = self._buffer[:n]
-                self._buffer = self._buffer[n:]
+                self._buffer_offset = n
             else:
                 data = self._buffer
-                self._buffer = None
+                self._buffer = b""
             if return_data:
                 blocks.append(data)
             self._pos += len(data)
@@ -322,7 +1329,9 @@ class LZMAFile(io.BufferedIOBase):
         self._check_can_read()
         if self._mode == _MODE_READ_EOF or not self._fill_buffer():
             return b""
-        return self._buffer
+        if self._buffer_offset == 0:
+            return self._buffer
+        return self._buffer[self._buffer_offset:]
 
     def read(self, size=-1):
         """Read up to size uncompressed bytes from the file.
@@ -359,15 +1368,404 @@ class LZMAFile(io.BufferedIOBase):
         if (size == 0 or self._mode == _MODE_READ_EOF or
             not self._fill_buffer()):
             return b""
-        if 0 < size < len(self._buffer):
-            data = self._buffer[:size]
-            self._buffer = self._buffer[size:]
+        if size > 0:
+            data = self._buffer[self._buffer_offset:
+                                self._buffer_offset + size]
+            self._buffer_offset += len(data)
         else:
-            data = self._buffer
-            self._buffer = None
+            data = self._buffer[self._buffer_offset:]
+            self._buffer = b""
+            self._buffer_offset = 0
         self._pos += len(data)
         return data
 
+    def readline(self, size=-1):
+        """Read a line of uncompressed bytes from the file.
+
+        The terminating newline (if present) is retained. If size is
+        non-negative, no more than size bytes will be read (in which
+        case the line may be incomplete). Returns b'' if already at EOF.
+        """
+        self._check_can_read()
+        if size is None:
+            size = -1
+        # Shortcut for the common case - the whole line is in the buffer.
+        start = self._buffer_offset
+        end = self._buffer.find(b"\n", start) + 1
+        if end > 0 and (size < 0 or end - start <= size):
+            line = self._buffer[start:end]
+            self._buffer_offset = end
+            self._pos += end - start
+            return line
+
+        parts = []
+        length = 0
+        while (length != size and self._mode != _MODE_READ_EOF and
+               self._fill_buffer()):
+            buf, start = self._buffer, self._buffer_offset
+            end = newline = buf.find(b"\n", start) + 1
+            if not end:
+                end = len(buf)
+            if size >= 0:
+                end = min(end, start + size - length)
+            parts.append(buf[start:end])
+            length += end - start
+            self._buffer_offset = end
+            self._pos += end - start
+            if newline and end == newline:
+                break
+        return b"".join(parts)
+
+    def __next__(self):
+        # Split all the whole lines in the buffer at once, and hand them
+        # out one per call - unless a read or seek moved the position in
+        # the meantime, in which case the buffer is split again from there.
+        if self._mode == _MODE_READ:
+            buf, start = self._buffer, self._buffer_offset
+            split = self._split
+            if split is None or split[0] is not buf or split[1] != start:
+                split = self._split = _split_lines(buf, start)
+            if split is not None:
+                lines = split[2]
+                line = lines.pop()
+                if not lines:
+                    self._split = None
+                split[1] = self._buffer_offset = start + len(line)
+                self._pos += len(line)
+                return line
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    # Python 2 calls it next().
+    next = __next__
+
+    def readlines(self, hint=-1):
+        """Read and return a list of lines from the file.
+
+        If hint is given and positive, no more lines are read once their
+        total size reaches hint bytes.
+        """
+        if hint is not None and hint > 0:
+            return self.readlines_batch(hint)
+        lines = []
+        while True:
+            batch = self.readlines_batch(_READAHEAD_SIZE)
+            if not batch:
+                return lines
+            lines.extend(batch)
+
+    def readlines_batch(self, max_bytes=_READAHEAD_SIZE):
+        """Read and return a list of lines from the file, until their total
+        size reaches max_bytes.
+
+        Lines are always returned whole, so the last line may take the
+        total past max_bytes. Returns [] if the file is at EOF.
+        """
+        self._check_can_read()
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        lines = []
+        total = 0
+        while (total < max_bytes and self._mode != _MODE_READ_EOF and
+               self._fill_buffer()):
+            buf, start = self._buffer, self._buffer_offset
+            # Take all the whole lines in the buffer that fit, at once.
+            limit = min(len(buf), start + max_bytes - total)
+            end = buf.rfind(b"\n", start, limit) + 1
+            if end <= start:
+                # The next line doesn't fit, or goes on past the buffer.
+                line = self.readline()
+                lines.append(line)
+                total += len(line)
+                continue
+            chunk = buf[start:end]
+            if b"\r" in chunk:
+                # splitlines() would also split the lines at these.
+                pos = 0
+                while pos < len(chunk):
+                    newline = chunk.index(b"\n", pos) + 1
+                    lines.append(chunk[pos:newline])
+                    pos = newline
+            else:
+                lines.extend(chunk.splitlines(True))
+            self._buffer_offset = end
+            self._pos += end - start
+            total += end - start
+        return lines
+
+    def readinto(self, b):
+        """Read up to len(b) uncompressed bytes into the writable
+        bytes-like object b.
+
+        Data is decompressed straight into b, rather than into an
+        intermediate bytes object. Returns the number of bytes read,
+        which is 0 at EOF. Under Python 2, b must be a buffer of bytes,
+        such as a bytearray.
+        """
+        return self._readinto(b, read1=False)
+
+    def readinto1(self, b):
+        """Read up to len(b) uncompressed bytes into the writable
+        bytes-like object b, while trying to avoid making multiple reads
+        from the underlying stream.
+
+        Returns the number of bytes read, which is 0 at EOF.
+        """
+        return self._readinto(b, read1=True)
+
+    def _readinto(self, b, read1):
+        self._check_can_read()
+        view = _byte_view(b)
+        size = len(view)
+        n = 0
+        while n < size and self._mode != _MODE_READ_EOF:
+            if read1 and n > 0:
+                break
+            if self._buffer_offset < len(self._buffer):
+                # Hand out the readahead buffer before decompressing more.
+                start = self._buffer_offset
+                count = min(len(self._buffer) - start, size - n)
+                view[n:n + count] = \
+                    memoryview(self._buffer)[start:start + count]
+                self._buffer_offset += count
+            elif self._blocks is not None:
+                if not self._fill_buffer_from_blocks():
+                    break
+                continue
+            else:
+                rawblock = self._next_input()
+                if rawblock is None:
+                    break
+                count = self._decompressor.decompress_into(view[n:], rawblock)
+            n += count
+            self._pos += count
+        return n
+
+    def pread(self, offset, size):
+        """Read up to size uncompressed bytes starting at offset, without
+        using or changing the file position.
+
+        Only the blocks holding the requested data are decompressed, each
+        by a decompressor of its own, so pread() may be called from many
+        threads at once. This requires a seekable .xz file. pread() calls
+        on a file object without a file name (such as a BytesIO) read it
+        under a lock, and must not overlap with other reads.
+
+        Returns b"" if offset is at or past the end of the file.
+        """
+        self._check_can_read()
+        if offset < 0:
+            raise ValueError("Offset must not be negative")
+        if size < 0:
+            raise ValueError("Size must not be negative")
+        index = self._index
+        if index is None:
+            with self._pread_lock:
+                index = self.index
+            if index is None:
+                raise io.UnsupportedOperation("pread() requires an "
+                                              "indexed .xz file")
+        end = min(offset + size, index.uncompressed_size)
+        if offset >= end:
+            return b""
+        blocks = []
+        block = index.locate(offset)
+        while offset < end:
+            block_offset = index._u_offsets[block]
+            stop = min(end - block_offset, index._u_sizes[block])
+            if offset < block_offset + stop:
+                blocks.append(self._pread_block(block, offset - block_offset,
+                                                stop))
+                offset = block_offset + stop
+            block += 1
+        return b"".join(blocks)
+
+    # Decompress bytes start to stop of a block, with a new decompressor.
+    def _pread_block(self, block, start, stop):
+        if self._block_cache is not None:
+            data = self._cached_block(block)
+            if start == 0 and stop == len(data):
+                return data
+            return data[start:stop]
+        header, data = self._block_input(block)
+        decomp = LZMADecompressor(FORMAT_XZ)
+        decomp.decompress(header)
+        data = decomp.decompress(data, stop)
+        if len(data) < stop:
+            raise LZMAError("Corrupt input data")
+        return data[start:] if start else data
+
+    # Return the header of the stream holding a block, and the compressed
+    # block itself.
+    def _block_input(self, block):
+        index = self._index
+        stream = index._stream_of(block)
+        header = self._pread_headers.get(stream)
+        if header is None:
+            header = bytes(self._read_at(index._s_offsets[stream],
+                                         STREAM_HEADER_SIZE))
+            self._pread_headers[stream] = header
+        data = self._read_at(index._c_offsets[block], index._c_sizes[block])
+        if len(data) < index._c_sizes[block]:
+            raise EOFError("Compressed file ended before the "
+                           "end-of-stream marker was reached")
+        return header, data
+
+    # Return the decompressed contents of a block.
+    def _block_data(self, block):
+        if self._block_cache is not None:
+            return self._cached_block(block)
+        header, data = self._block_input(block)
+        return _decompress_block(header, data, self._index._u_sizes[block])
+
+    # Return the decompressed contents of a block, from the block cache if
+    # it is there, or decompressing it and adding it to the cache if not.
+    def _cached_block(self, block):
+        key = (self._cache_id, block)
+        data = self._block_cache._get(key)
+        if data is None:
+            header, data = self._block_input(block)
+            data = _decompress_block(header, data, self._index._u_sizes[block])
+            self._block_cache._put(key, data)
+        return data
+
+    # Return an iterator over the decompressed contents of the blocks of
+    # the file, from block to the end, for reading whole blocks at a time.
+    def _iter_blocks(self, block):
+        if self._pool is not None:
+            return _decompress_blocks(self._fp, self._index, block,
+                                      self._pool, self._readahead,
+                                      self._block_cache, self._cache_id)
+        return (self._cached_block(i) for i in range(block, len(self._index)))
+
+    # Identify the file in the block cache: named files by where they are
+    # on disk, their size and modification time, so that their blocks are
+    # found again when they are reopened, and others by a unique token.
+    def _file_identity(self):
+        if self._filename is None:
+            return object()
+        st = os.fstat(self._fp.fileno())
+        return (self._filename, st.st_dev, st.st_ino, st.st_size,
+                st.st_mtime)
+
+    # Read size bytes at offset in the underlying file, leaving its
+    # position alone, as far as other pread() calls can tell.
+    def _read_at(self, offset, size):
+        fp = self._fp
+        if isinstance(fp, _MemoryFile):
+            return fp.pread(offset, size)
+        if self._pread_fd is not None:
+            chunks = []
+            while size > 0:
+                data = os.pread(self._pread_fd, size, offset)
+                if not data:
+                    break
+                chunks.append(data)
+                offset += len(data)
+                size -= len(data)
+            return b"".join(chunks)
+        with self._pread_lock:
+            pos = fp.tell()
+            try:
+                fp.seek(offset, 0)
+                return fp.read(size)
+            finally:
+                fp.seek(pos, 0)
+
+    @property
+    def line_index(self):
+        """The LineIndex used by seek_line() and read_lines().
+
+        Unless build_line_index() was called first, it is built (without
+        checkpoints) the first time it is needed.
+        """
+        if self._line_index is None:
+            self.build_line_index()
+        return self._line_index
+
+    def build_line_index(self, checkpoint_interval=0, workers=None):
+        """Build the line index of the file, and return it.
+
+        This requires a seekable .xz file. The blocks of the file are
+        scanned by workers threads, as for LineIndex.from_file(). If the
+        file was opened with index_cache, a cached line index with the
+        same checkpoint_interval is used instead, when there is one.
+        """
+        self._check_can_seek()
+        cache_path = None
+        if self._index_cache and self._filename is not None:
+            cache_path = _index_cache_path(self._filename, self._index_cache,
+                                           _LINE_CACHE_SUFFIX)
+            with self._pread_lock:
+                pos = self._fp.tell()
+                try:
+                    cache_key = _index_cache_key(self._fp, self._filename)
+                finally:
+                    self._fp.seek(pos, 0)
+            lines = _load_cached_index(cache_path, cache_key, LineIndex)
+            if (lines is not None and
+                lines.checkpoint_interval == checkpoint_interval):
+                self._line_index = lines
+                return lines
+        lines = LineIndex.from_file(self, checkpoint_interval, workers)
+        if cache_path is not None:
+            _save_cached_index(cache_path, cache_key, lines)
+        self._line_index = lines
+        return lines
+
+    def seek_line(self, n):
+        """Move to the start of line n, counting from 0.
+
+        Using the file's line_index, only the block holding the start of
+        the line is decompressed. Seeking past the last line moves to the
+        end of the file. Returns the new file position.
+        """
+        self._check_can_seek()
+        if n < 0:
+            raise ValueError("Line number must not be negative")
+        lines = self.line_index
+        if n == 0:
+            return self.seek(0)
+        if n > lines._block_lines[-1]:
+            return self.seek(0, 2)
+        block, offset, skip = lines._locate(n)
+        self.seek(self._index._u_offsets[block] + offset)
+        self._skip_lines(skip)
+        return self._pos
+
+    def read_lines(self, start, stop):
+        """Return lines start to stop - 1 of the file, as a list.
+
+        The file is left positioned after the last line returned.
+        """
+        self.seek_line(start)
+        lines = []
+        while len(lines) < stop - start:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+    # Move past the next count line ends.
+    def _skip_lines(self, count):
+        while (count > 0 and self._mode != _MODE_READ_EOF and
+               self._fill_buffer()):
+            buf = self._buffer
+            start = end = self._buffer_offset
+            newlines = buf.count(b"\n", start)
+            if newlines < count:
+                end = len(buf)
+                count -= newlines
+            else:
+                for i in range(count):
+                    end = buf.index(b"\n", end) + 1
+                count = 0
+            self._pos += end - start
+            self._buffer_offset = end
+
     def write(self, data):
         """Write a bytes object to the file.
 
@@ -381,33 +1779,54 @@ class LZMAFile(io.BufferedIOBase):
         self._pos += len(data)
         return len(data)
 
+    # Start decompressing from the first stream beginning at or after
+    # the compressed offset end.
+    def _next_stream(self, end):
+        stream = self._index._stream_at_or_after(end)
+        if stream is None:
+            return
+        self._fp.seek(self._index._s_offsets[stream], 0)
+        self._dont_read_past = self._blocks_end
+        self._decompressor = LZMADecompressor(**self._init_args)
+
     # Rewind the file to the beginning of the data stream.
     def _rewind(self):
         self._fp.seek(0, 0)
         self._mode = _MODE_READ
         self._pos = 0
+        self._dont_read_past = self._blocks_end
         self._decompressor = LZMADecompressor(**self._init_args)
-        self._buffer = None
-
-    def _rewind_to(self, block_begin_point):
-        target_offset = self._seek_offsets[block_begin_point]
-        if target_offset is None:
-            self._rewind()
+        self._buffer = b""
+        self._buffer_offset = 0
+        if self._blocks is not None:
+            self._blocks = self._iter_blocks(0)
+
+    def _rewind_to(self, block):
+        index = self._index
+        stream = index._stream_of(block)
+        if self._blocks is not None:
+            self._mode = _MODE_READ
+            self._pos = index._u_offsets[block]
+            self._buffer = b""
+            self._buffer_offset = 0
+            self._blocks = self._iter_blocks(block)
             return
-        self._fp.seek(0, 0)
         self._mode = _MODE_READ
         self._pos = 0
         self._decompressor = LZMADecompressor(**self._init_args)
-        self._buffer = None
+        self._buffer = b""
+        self._buffer_offset = 0
         try:
-            # trick the decompressor: read the stream header,
+            # trick the decompressor: read the header of the block's stream,
             # then the block header of the block we want, then the block
+            self._fp.seek(index._s_offsets[stream], 0)
             xz_header = self._fp.read(STREAM_HEADER_SIZE)
             if len(xz_header) < STREAM_HEADER_SIZE:
                 raise EOFError("Can't find xz header")
             self._decompressor.decompress(xz_header)
-            self._fp.seek(target_offset, 0)
-            self._pos = block_begin_point
+            self._fp.seek(index._c_offsets[block], 0)
+            self._pos = index._u_offsets[block]
+            self._dont_read_past = index._s_index_offsets[stream]
         except:
             warnings.warn("LZMAFile: can't _rewind_to, seeking may be "
                           "very slow")
@@ -448,10 +1867,14 @@ class LZMAFile(io.BufferedIOBase):
             #This is not needed on Python 3 where the comparison to self._pos
             #will fail with a TypeError.
             raise TypeError("Seek offset should be an integer, not None")
-        if offset < self._pos and self._seek_offsets:
-            # smart rewind
-            block_begin_point = max(x for x in self._seek_offsets if x <= offset)
-            self._rewind_to(block_begin_point)
+        # Seeking before the start of the file moves to the start.
+        offset = max(offset, 0)
+        if self._index is not None:
+            # smart seek: jump straight to the start of the block holding
+            # offset, unless we are already inside it
+            block = self._index.locate(offset)
+            if offset < self._pos or self._index._u_offsets[block] > self._pos:
+                self._rewind_to(block)
         elif offset < self._pos:
             # plain rewind
             self._rewind()
@@ -471,7 +1894,9 @@ class LZMAFile(io.BufferedIOBase):
 
 def open(filename, mode="rb",
          format=None, check=-1, preset=None, filters=None,
-         encoding=None, errors=None, newline=None):
+         encoding=None, errors=None, newline=None, index_cache=None,
+         threads=1, block_size=0, buffer_size=None, max_buffer_size=None,
+         mmap=False, block_cache=None):
     """Open an LZMA-compressed file in binary or text mode.
 
     filename can be either an actual file name (given as a str or bytes object),
@@ -484,6 +1909,12 @@ def open(filename, mode="rb",
     The format, check, preset and filters arguments specify the compression
     settings, as for LZMACompressor, LZMADecompressor and LZMAFile.
 
+    The index_cache, threads and block_size arguments enable caching of
+    the file's block table and parallel (de)compression, as for LZMAFile.
+    The buffer_size and max_buffer_size arguments set how much compressed
+    data is read at a time, mmap maps the file into memory for reading,
+    and block_cache caches decompressed blocks, as for LZMAFile.
+
     For binary mode, this function is equivalent to the LZMAFile constructor:
     LZMAFile(filename, mode, ...). In this case, the encoding, errors and
     newline arguments must not be provided.
@@ -506,7 +1937,11 @@ def open(filename, mode="rb",
 
     lz_mode = mode.replace("t", "")
     binary_file = LZMAFile(filename, lz_mode, format=format, check=check,
-                           preset=preset, filters=filters)
+                           preset=preset, filters=filters,
+                           index_cache=index_cache, threads=threads,
+                           block_size=block_size, buffer_size=buffer_size,
+                           max_buffer_size=max_buffer_size, mmap=mmap,
+                           block_cache=block_cache)
 
     if "t" in mode:
         return io.TextIOWrapper(binary_file, encoding, errors, newline)
@@ -514,26 +1949,159 @@ def open(filename, mode="rb",
         return binary_file
 
 
-def compress(data, format=FORMAT_XZ, check=-1, preset=None, filters=None):
+def compress(data, format=FORMAT_XZ, check=-1, preset=None, filters=None,
+             threads=1, block_size=0, workers=None):
     """Compress a block of data.
 
     Refer to LZMACompressor's docstring for a description of the
-    optional arguments *format*, *check*, *preset* and *filters*.
+    optional arguments *format*, *check*, *preset*, *filters*, *threads*
+    and *block_size*.
+
+    If workers is given, data is instead split into blocks of block_size
+    bytes, which are compressed in parallel by a pool of that many
+    threads (or one per CPU, if workers is 0), and joined into a single
+    .xz stream. This does not depend on liblzma's multithreaded encoder.
+    By default, the data is split evenly between the workers, in blocks
+    of at least 1 MiB. workers can only be used with FORMAT_XZ, and
+    cannot be combined with threads.
 
     For incremental compression, use an LZMACompressor object instead.
     """
-    comp = LZMACompressor(format, check, preset, filters)
+    if workers is not None:
+        if format != FORMAT_XZ:
+            raise ValueError("workers is only supported by FORMAT_XZ")
+        if threads != 1:
+            raise ValueError("Cannot specify both threads and workers")
+        return _parallel_compress(data, check, preset, filters, workers,
+                                  block_size)
+    if format == FORMAT_XZ and threads == 1 and not block_size:
+        # Encode the whole stream in a single call.
+        return _compress_buffer(data, check, preset, filters)
+    comp = LZMACompressor(format, check, preset, filters, threads, block_size)
     return comp.compress(data) + comp.flush()
 
 
+_MIN_PARALLEL_BLOCK_SIZE = 1 << 20
+
+
+def _compress_chunk(data, check, preset, filters):
+    # Compress data as a single .xz stream, and split it into its header,
+    # blocks, index and footer.
+    comp = LZMACompressor(FORMAT_XZ, check, preset, filters)
+    stream = comp.compress(data) + comp.flush()
+    footer = stream[-STREAM_HEADER_SIZE:]
+    backward_size, check = _decode_stream_footer(footer)
+    index_start = len(stream) - STREAM_HEADER_SIZE - backward_size
+    return (stream[:STREAM_HEADER_SIZE],
+            stream[STREAM_HEADER_SIZE:index_start],
+            stream[index_start:-STREAM_HEADER_SIZE], check)
+
+
+def _parallel_compress(data, check, preset, filters, workers, block_size):
+    if workers == 0:
+        workers = _cpu_count()
+    if not block_size:
+        block_size = max(-(-len(data) // workers), _MIN_PARALLEL_BLOCK_SIZE)
+    if len(data) <= block_size:
+        comp = LZMACompressor(FORMAT_XZ, check, preset, filters)
+        return comp.compress(data) + comp.flush()
+    pool = _thread_pool(workers)
+    try:
+        chunks = pool.map(
+            lambda start: _compress_chunk(data[start:start + block_size],
+                                          check, preset, filters),
+            range(0, len(data), block_size))
+    finally:
+        pool.terminate()
+    # Every chunk is a stream with the same header; keep the first one,
+    # and replace the indexes of the chunks with a single merged index.
+    index = _merge_indexes([chunk[2] for chunk in chunks])
+    footer = _encode_stream_footer(len(index), chunks[0][3])
+    return b"".join([chunks[0][0]] + [chunk[1] for chunk in chunks] +
+                    [index, footer])
+
+
+# Largest valid properties byte of a .lzma header: lc=8, lp=4, pb=4.
+_ALONE_MAX_PROPERTIES = (4 * 5 + 4) * 9 + 8
+_ALONE_UNKNOWN_SIZE = 2 ** 64 - 1
+
+# The recorded size of the data is trusted to allocate the output up
+# front only up to this many times the size of the compressed data, or
+# _SIZED_MIN_LIMIT bytes if that is more; a forged header or index can
+# claim any size at all. Data beyond that is decompressed incrementally.
+_SIZED_MAX_RATIO = 64
+_SIZED_MIN_LIMIT = 1 << 20
+
+
+def _decompressed_size(data, format):
+    # Return the total size of the data held by data, as recorded by the
+    # indexes of .xz streams, or by the header of a single .lzma stream.
+    # Returns None if the size can't be found this way.
+    if data[:len(_XZ_MAGIC)] == _XZ_MAGIC:
+        if format not in (FORMAT_AUTO, FORMAT_XZ):
+            return None
+        try:
+            return XZIndex.from_file(_MemoryFile(data)).uncompressed_size
+        except LZMAError:
+            return None
+    if format in (FORMAT_AUTO, FORMAT_ALONE) and len(data) >= 13:
+        properties = bytearray(data[:1])[0]
+        size = struct.unpack("<Q", bytes(data[5:13]))[0]
+        if properties <= _ALONE_MAX_PROPERTIES and size != _ALONE_UNKNOWN_SIZE:
+            return size
+    return None
+
+
+def parallel_decompress(source, workers=None):
+    """Decompress a whole .xz file, decoding its blocks in parallel.
+
+    source can be either a file name (given as a str or bytes object), or
+    a seekable file object, holding one or more .xz streams.
+
+    workers is the number of threads used; by default, one per CPU. Only
+    files made of several blocks benefit from parallel decompression.
+
+    Returns the decompressed data, as a bytes object.
+    """
+    if isinstance(source, (str, bytes)):
+        with io.open(source, "rb") as fp:
+            return parallel_decompress(fp, workers)
+    if workers is None:
+        workers = _cpu_count()
+    index = XZIndex.from_file(source)
+    pool = _thread_pool(workers)
+    try:
+        return b"".join(_decompress_blocks(source, index, 0, pool,
+                                           2 * workers))
+    finally:
+        pool.terminate()
+
+
 def decompress(data, format=FORMAT_AUTO, memlimit=None, filters=None):
     """Decompress a block of data.
 
     Refer to LZMADecompressor's docstring for a description of the
     optional arguments *format*, *check* and *filters*.
 
+    data can be any bytes-like object, including an mmap of a compressed
+    file, which is decompressed without being copied.
+
     For incremental decompression, use a LZMADecompressor object instead.
     """
+    if filters is None and format != FORMAT_RAW:
+        # When the size of the output is recorded in the data, decompress
+        # everything into a single buffer of that size.
+        size = _decompressed_size(data, format)
+        limit = max(len(data) * _SIZED_MAX_RATIO, _SIZED_MIN_LIMIT)
+        if size is not None and size <= limit:
+            args = (data, format, size)
+            if memlimit is not None:
+                args += (memlimit,)
+            try:
+                return _decompress_sized(*args)
+            except (LZMAError, MemoryError, OverflowError):
+                # Leave it to the incremental decoder to report any problem.
+                pass
     results = []
     while True:
         decomp = LZMADecompressor(format, memlimit, filters)
@@ -545,3 +2113,242 @@ def decompress(data, format=FORMAT_AUTO, memlimit=None, filters=None):
             return b"".join(results)
         # There is unused data left over. Proceed to next stream.
         data = decomp.unused_data
+
+
+def _map_batches(func, buffers, workers):
+    # Apply func, which maps a list of buffers to a list of results, to
+    # the list buffers. If workers is given, split the list into batches
+    # and spread them over a pool of that many threads (or one per CPU,
+    # if workers is 0).
+    if workers == 0:
+        workers = _cpu_count()
+    if workers is None or workers == 1 or len(buffers) < 2:
+        return func(buffers)
+    # A few batches per thread even out the load between them.
+    size = -(-len(buffers) // (4 * workers))
+    pool = _thread_pool(workers)
+    try:
+        batches = pool.map(func, [buffers[start:start + size]
+                                  for start in range(0, len(buffers), size)])
+    finally:
+        pool.terminate()
+    return [result for batch in batches for result in batch]
+
+
+def compress_many(buffers, format=FORMAT_XZ, check=-1, preset=None,
+                  filters=None, workers=None):
+    """Compress each of a sequence of bytes-like objects separately.
+
+    Returns a list holding the compressed form of each buffer. This is
+    much faster than calling compress() for each of many small buffers:
+    with FORMAT_XZ or FORMAT_RAW, a single encoder is reused for all of
+    them, and the GIL is released for the whole batch. Unless filters
+    is given, the dictionary used for each buffer is cut down to fit
+    it, which makes no difference to the compressed data besides the
+    dictionary size recorded in its header, but makes setting up the
+    encoder much cheaper (and decompressing the data takes less memory).
+
+    If workers is given, the buffers are compressed in batches by a pool
+    of that many threads (or one per CPU, if workers is 0).
+
+    Refer to LZMACompressor's docstring for a description of the
+    optional arguments *format*, *check*, *preset* and *filters*.
+    """
+    buffers = list(buffers)
+    if format in (FORMAT_XZ, FORMAT_RAW):
+        func = lambda batch: _compress_many(batch, format, check, preset,
+                                            filters)
+    else:
+        func = lambda batch: [compress(data, format, check, preset, filters)
+                              for data in batch]
+    return _map_batches(func, buffers, workers)
+
+
+def decompress_many(buffers, format=FORMAT_AUTO, memlimit=None, filters=None,
+                    workers=None):
+    """Decompress each of a sequence of bytes-like objects separately.
+
+    Returns a list holding the decompressed form of each buffer, the same
+    as decompress() would give for it; if any buffer is not valid
+    compressed data, raises LZMAError. A single decoder is reused for
+    all the buffers, and the GIL is only held to create the results.
+
+    If workers is given, the buffers are decompressed in batches by a
+    pool of that many threads (or one per CPU, if workers is 0).
+
+    Refer to LZMADecompressor's docstring for a description of the
+    optional arguments *format*, *memlimit* and *filters*.
+    """
+    buffers = list(buffers)
+    func = lambda batch: _decompress_many(batch, format, memlimit, filters)
+    return _map_batches(func, buffers, workers)
+
+
+# The default size of the dictionaries built by build_preset_dict(); the
+# pieces of sample data it builds them from; and the length of the
+# substrings it scores those pieces by.
+_PRESET_DICT_SIZE = 16 * 1024
+_DICT_SEGMENT_SIZE = 256
+_DICT_GRAM_SIZE = 8
+
+
+def _grams(data):
+    # Return the set of distinct substrings of data that
+    # build_preset_dict() scores it by.
+    k = _DICT_GRAM_SIZE
+    return set(data[i:i + k] for i in range(len(data) - k + 1))
+
+
+def build_preset_dict(samples, size=_PRESET_DICT_SIZE):
+    """Build a preset dictionary for compressing data like the samples.
+
+    samples is an iterable of bytes-like objects, typical of the records
+    to be compressed. Returns a bytes object of at most size bytes, to
+    be given as the "preset_dict" of an LZMA1 or LZMA2 filter specifier
+    (whose dict_size must be at least as large) with FORMAT_RAW. The
+    same filter chain must be used to decompress the data.
+
+    The dictionary is made of the pieces of the samples that have the
+    most in common with other samples, the most useful last, where they
+    are cheapest to refer to. A larger dictionary can improve compression
+    further, but the encoder has to process all of it at the start of
+    every record, which can easily cost more than compressing a small
+    record.
+    """
+    if size <= 0:
+        raise ValueError("size must be positive")
+    samples = [_byte_view(data).tobytes() for data in samples]
+    # The number of samples each substring occurs in.
+    counts = {}
+    for data in samples:
+        for gram in _grams(data):
+            counts[gram] = counts.get(gram, 0) + 1
+    overlap = _DICT_GRAM_SIZE - 1
+    segments = [data[start:start + _DICT_SEGMENT_SIZE + overlap]
+                for data in samples
+                for start in range(0, len(data), _DICT_SEGMENT_SIZE)]
+
+    def score(segment):
+        # Substrings occurring in a single sample don't help with others.
+        grams = _grams(segment)
+        return sum(n for n in map(counts.get, grams) if n > 1), grams
+
+    # Pick the best segment again and again. Scores only go down as
+    # segments are picked, so one whose current score is at least the
+    # old score of every other segment is the best.
+    heap = [(-score(segment)[0], i) for i, segment in enumerate(segments)]
+    heapq.heapify(heap)
+    picked = []
+    length = 0
+    while heap and length < size:
+        i = heapq.heappop(heap)[1]
+        value, grams = score(segments[i])
+        if heap and value < -heap[0][0]:
+            heapq.heappush(heap, (-value, i))
+            continue
+        if value == 0:
+            break
+        picked.append(segments[i])
+        length += len(segments[i])
+        # Make what the dictionary already holds count for less, but not
+        # for nothing: frequent content is worth repeating.
+        for gram in grams:
+            counts[gram] //= 2
+    picked.reverse()
+    return b"".join(picked)[-size:]
+
+
+def _iter_buffers(source, read_size):
+    # Yield the contents of a file object, read_size bytes at a time, or
+    # the items of an iterable of bytes-like objects. Empty buffers are
+    # skipped.
+    if hasattr(source, "read"):
+        while True:
+            data = source.read(read_size)
+            if not data:
+                return
+            yield data
+    else:
+        for data in source:
+            if len(data):
+                yield data
+
+
+def _split(data, size):
+    # Yield data in pieces of at most size bytes, or nothing if it's empty.
+    if len(data) <= size:
+        if data:
+            yield data
+        return
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def iter_compress(source, chunk_size=_READAHEAD_SIZE, format=FORMAT_XZ,
+                  check=-1, preset=None, filters=None, threads=1,
+                  block_size=0):
+    """Compress data from an iterable of buffers, yielding compressed data.
+
+    source can be an iterable of bytes-like objects, or a file object,
+    which is read chunk_size bytes at a time. Its data is compressed into
+    a single stream, yielded in chunks of at most chunk_size bytes. Large
+    input buffers are fed to the compressor chunk_size bytes at a time,
+    so memory use does not grow with the size of the data.
+
+    Refer to LZMACompressor's docstring for a description of the optional
+    arguments *format*, *check*, *preset*, *filters*, *threads* and
+    *block_size*.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    comp = LZMACompressor(format, check, preset, filters, threads, block_size)
+    for data in _iter_buffers(source, chunk_size):
+        view = _byte_view(data)
+        for start in range(0, len(view), chunk_size):
+            for chunk in _split(comp.compress(view[start:start + chunk_size]),
+                                chunk_size):
+                yield chunk
+    for chunk in _split(comp.flush(), chunk_size):
+        yield chunk
+
+
+def iter_decompress(source, chunk_size=_READAHEAD_SIZE, format=FORMAT_AUTO,
+                    memlimit=None, filters=None):
+    """Decompress data from an iterable of buffers, yielding the result.
+
+    source can be an iterable of bytes-like objects, or a file object,
+    which is read chunk_size bytes at a time. The decompressed data is
+    yielded in chunks of at most chunk_size bytes, so memory use does not
+    grow with the size of the data. As with decompress(), the data may
+    be made of several concatenated streams.
+
+    Refer to LZMADecompressor's docstring for a description of the
+    optional arguments *format*, *memlimit* and *filters*.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    decomp = LZMADecompressor(format, memlimit, filters)
+    for data in _iter_buffers(source, chunk_size):
+        if decomp.eof:
+            decomp = LZMADecompressor(format, memlimit, filters)
+        while True:
+            chunk = decomp.decompress(data, chunk_size)
+            data = b""
+            if chunk:
+                yield chunk
+            if decomp.eof:
+                # Proceed to the next stream, if there is more data.
+                data = decomp.unused_data
+                if not data:
+                    break
+                decomp = LZMADecompressor(format, memlimit, filters)
+            elif decomp.needs_input:
+                break
+    if not decomp.eof:
+        raise LZMAError("Compressed data ended before the "
+                        "end-of-stream marker was reached")
+
+
+if sys.version_info >= (3, 6):
+    from ._aio import AsyncLZMAFile, async_decompress_stream
+    __all__ += ["AsyncLZMAFile", "async_decompress_stream"]
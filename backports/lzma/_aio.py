@@ -0,0 +1,247 @@
+"""asyncio support for the lzma module.
+
+The classes and functions here run all of liblzma's work in an executor,
+so that (de)compressing large amounts of data never blocks the event
+loop. This module needs Python 3.6 or later, and is only imported by the
+lzma package on those versions.
+"""
+
+import asyncio
+
+from . import (FORMAT_AUTO, LZMADecompressor, LZMAError, LZMAFile,
+               _byte_view)
+
+
+# The most uncompressed data (de)compressed by a single executor call.
+_CHUNK_SIZE = 64 * 1024
+# How much compressed data async_decompress_stream() reads at a time.
+_READ_SIZE = 64 * 1024
+
+
+class AsyncLZMAFile:
+
+    """An LZMAFile for use with asyncio.
+
+    The filename, mode and keyword arguments are passed to the LZMAFile
+    constructor. Each read or write then runs in executor (by default,
+    the event loop's default executor), handling at most chunk_size
+    uncompressed bytes per call, so the event loop is never blocked for
+    long. When reading, the next chunk is decompressed while the current
+    one is being consumed.
+
+    An AsyncLZMAFile supports async iteration over its lines, and can be
+    used as an async context manager.
+    """
+
+    def __init__(self, filename=None, mode="r", *, executor=None,
+                 chunk_size=_CHUNK_SIZE, **kwargs):
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self._file = LZMAFile(filename, mode, **kwargs)
+        self._executor = executor
+        self._chunk_size = chunk_size
+        # Decompressed data not yet returned, and where it starts.
+        self._buffer = b""
+        self._offset = 0
+        self._pos = 0
+        # The executor call decompressing the next chunk, if any.
+        self._pending = None
+        self._eof = False
+        # Created on first use, so that it belongs to the running loop.
+        self._lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+    @property
+    def closed(self):
+        """True if this file is closed."""
+        return self._file.closed
+
+    def tell(self):
+        """Return the current file position."""
+        if self._file.readable():
+            return self._pos
+        return self._file.tell()
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, func, *args)
+
+    # Return the next chunk of decompressed data, or b"" at EOF, and start
+    # decompressing the chunk after it.
+    async def _next_chunk(self):
+        if self._eof:
+            return b""
+        if self._pending is None:
+            self._pending = self._run(self._file.read, self._chunk_size)
+        chunk = await self._pending
+        if chunk:
+            self._pending = self._run(self._file.read, self._chunk_size)
+        else:
+            self._pending = None
+            self._eof = True
+        return chunk
+
+    async def read(self, size=-1):
+        """Read up to size uncompressed bytes from the file.
+
+        If size is negative or omitted, read until EOF is reached.
+        Returns b"" if the file is already at EOF.
+        """
+        if size is None:
+            size = -1
+        async with self._get_lock():
+            parts = []
+            length = 0
+            while size < 0 or length < size:
+                buf, start = self._buffer, self._offset
+                end = len(buf)
+                if size >= 0:
+                    end = min(end, start + size - length)
+                if end > start:
+                    parts.append(buf[start:end])
+                    length += end - start
+                    self._offset = end
+                if length == size:
+                    break
+                chunk = await self._next_chunk()
+                if not chunk:
+                    break
+                self._buffer = chunk
+                self._offset = 0
+            self._pos += length
+            return b"".join(parts)
+
+    async def readline(self, size=-1):
+        """Read a line of uncompressed bytes from the file.
+
+        The terminating newline (if present) is retained. If size is
+        non-negative, no more than size bytes will be read (in which
+        case the line may be incomplete). Returns b"" if already at EOF.
+        """
+        if size is None:
+            size = -1
+        async with self._get_lock():
+            parts = []
+            length = 0
+            while True:
+                buf, start = self._buffer, self._offset
+                end = newline = buf.find(b"\n", start) + 1
+                if not end:
+                    end = len(buf)
+                if size >= 0:
+                    end = min(end, start + size - length)
+                parts.append(buf[start:end])
+                length += end - start
+                self._offset = end
+                if (newline and end == newline) or length == size:
+                    break
+                chunk = await self._next_chunk()
+                if not chunk:
+                    break
+                self._buffer = chunk
+                self._offset = 0
+            self._pos += length
+            return b"".join(parts)
+
+    async def write(self, data):
+        """Write a bytes-like object to the file.
+
+        Returns the number of uncompressed bytes written, which is
+        always len(data).
+        """
+        view = _byte_view(data)
+        async with self._get_lock():
+            for start in range(0, len(view), self._chunk_size):
+                await self._run(self._file.write,
+                                view[start:start + self._chunk_size])
+        return len(view)
+
+    async def aclose(self):
+        """Flush and close the file.
+
+        May be called more than once without error.
+        """
+        async with self._get_lock():
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                # Wait for the readahead to finish with the file; nobody
+                # asked for its data, so any error it ran into is moot.
+                try:
+                    await pending
+                except Exception:
+                    pass
+            await self._run(self._file.close)
+            self._buffer = b""
+            self._offset = 0
+
+
+async def async_decompress_stream(reader, format=FORMAT_AUTO, memlimit=None,
+                                  filters=None, *, executor=None,
+                                  chunk_size=_CHUNK_SIZE,
+                                  read_size=_READ_SIZE):
+    """Decompress the data read from an asyncio stream, as it arrives.
+
+    reader can be an asyncio.StreamReader, or any object with a coroutine
+    method read(n) returning b"" at EOF. Up to read_size bytes are read
+    at a time; the next read is started before decompressing the data
+    from the last one. Decompression runs in executor (by default, the
+    event loop's default executor).
+
+    This is an async generator, yielding chunks of decompressed data of
+    at most chunk_size bytes. As with decompress(), the input can hold
+    several concatenated streams; format, memlimit and filters are as
+    for LZMADecompressor.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    loop = asyncio.get_event_loop()
+    decomp = LZMADecompressor(format, memlimit, filters)
+    pending = asyncio.ensure_future(reader.read(read_size))
+    try:
+        while True:
+            data = await pending
+            if not data:
+                pending = None
+                break
+            pending = asyncio.ensure_future(reader.read(read_size))
+            if decomp.eof:
+                decomp = LZMADecompressor(format, memlimit, filters)
+            while True:
+                chunk = await loop.run_in_executor(
+                    executor, decomp.decompress, data, chunk_size)
+                data = b""
+                if chunk:
+                    yield chunk
+                if decomp.eof:
+                    # Proceed to the next stream, if the data holds more.
+                    data = decomp.unused_data
+                    if not data:
+                        break
+                    decomp = LZMADecompressor(format, memlimit, filters)
+                elif decomp.needs_input:
+                    break
+        if not decomp.eof:
+            raise LZMAError("Compressed data ended before the "
+                            "end-of-stream marker was reached")
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -144,11 +144,24 @@ enum {
 
 #define LZMA_CHECK_UNKNOWN (LZMA_CHECK_ID_MAX + 1)
 
+/* liblzma 5.2.0 added the multithreaded .xz encoder, and 5.4.0 added the
+   multithreaded .xz decoder. */
+#if LZMA_VERSION >= 50020002UL
+#define HAVE_ENCODER_MT 1
+#endif
+#if LZMA_VERSION >= 50040002UL
+#define HAVE_DECODER_MT 1
+#endif
+
 
 typedef struct {
     PyObject_HEAD
     lzma_stream lzs;
     int flushed;
+    /* When non-zero, compress() ends a block after every block_size bytes
+       of input, of which block_remaining are left in the current block. */
+    uint64_t block_size;
+    uint64_t block_remaining;
 #ifdef WITH_THREAD
     PyThread_type_lock lock;
 #endif
@@ -160,6 +173,10 @@ typedef struct {
     int check;
     char eof;
     PyObject *unused_data;
+    char needs_input;
+    /* Input left over by an earlier call, when lzs.next_in points into it. */
+    uint8_t *input_buffer;
+    size_t input_buffer_size;
 #ifdef WITH_THREAD
     PyThread_type_lock lock;
 #endif
@@ -213,17 +230,90 @@ catch_lzma_error(lzma_ret lzret)
     }
 }
 
-#if BUFSIZ < 8192
-#define INITIAL_BUFFER_SIZE 8192
-#else
-#define INITIAL_BUFFER_SIZE BUFSIZ
-#endif
 
+/* Output buffers.
+
+   Output is written to a single bytes object, which doubles in size each
+   time it fills up, and is trimmed once the output is complete. Where
+   realloc() has to copy, this copies no more than the size of the output
+   in total; where it can remap large blocks instead (as glibc does), the
+   data written so far is not copied at all. A size hint lets output of a
+   known size be written without resizing. */
+
+#define OUTPUT_BUFFER_MIN_SIZE (32 * 1024)
+
+typedef struct {
+    PyObject *result;
+    Py_ssize_t max_length;
+} OutputBuffer;
+
+/* Start an output buffer, holding at most max_length bytes if max_length is
+   not negative. It initially holds size_hint bytes if size_hint is
+   positive, or OUTPUT_BUFFER_MIN_SIZE bytes otherwise. Points *next_out
+   and *avail_out at its free space. Returns -1 on error. */
+static int
+OutputBuffer_Init(OutputBuffer *buffer, Py_ssize_t size_hint,
+                  Py_ssize_t max_length, uint8_t **next_out, size_t *avail_out)
+{
+    Py_ssize_t size = size_hint > 0 ? size_hint : OUTPUT_BUFFER_MIN_SIZE;
+
+    if (max_length >= 0 && size > max_length)
+        size = max_length;
+    buffer->result = PyBytes_FromStringAndSize(NULL, size);
+    if (buffer->result == NULL)
+        return -1;
+    buffer->max_length = max_length;
+    *next_out = (uint8_t *)PyBytes_AS_STRING(buffer->result);
+    *avail_out = size;
+    return 0;
+}
+
+/* Grow an output buffer whose space is used up. Returns -1 on error. */
 static int
-grow_buffer(PyObject **buf)
+OutputBuffer_Grow(OutputBuffer *buffer, uint8_t **next_out, size_t *avail_out)
+{
+    Py_ssize_t size = PyBytes_GET_SIZE(buffer->result);
+    Py_ssize_t newsize;
+
+    if (size > PY_SSIZE_T_MAX / 2) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    newsize = size < OUTPUT_BUFFER_MIN_SIZE ? OUTPUT_BUFFER_MIN_SIZE : size * 2;
+    if (buffer->max_length >= 0 && newsize > buffer->max_length)
+        newsize = buffer->max_length;
+    if (_PyBytes_Resize(&buffer->result, newsize) == -1)
+        return -1;
+    *next_out = (uint8_t *)PyBytes_AS_STRING(buffer->result) + size;
+    *avail_out = newsize - size;
+    return 0;
+}
+
+/* Return the number of bytes written to an output buffer. */
+static Py_ssize_t
+OutputBuffer_Size(OutputBuffer *buffer, size_t avail_out)
+{
+    return PyBytes_GET_SIZE(buffer->result) - (Py_ssize_t)avail_out;
+}
+
+/* Release an output buffer, and return its contents as a bytes object. */
+static PyObject *
+OutputBuffer_Finish(OutputBuffer *buffer, size_t avail_out)
+{
+    PyObject *result = buffer->result;
+
+    buffer->result = NULL;
+    if (avail_out > 0 &&
+        _PyBytes_Resize(&result, PyBytes_GET_SIZE(result) - avail_out) == -1)
+        return NULL;
+    return result;
+}
+
+/* Release an output buffer after an error. */
+static void
+OutputBuffer_OnError(OutputBuffer *buffer)
 {
-    size_t size = PyBytes_GET_SIZE(*buf);
-    return _PyBytes_Resize(buf, size + (size >> 3) + 6);
+    Py_CLEAR(buffer->result);
 }
 
 
@@ -270,7 +360,10 @@ grow_buffer(PyObject **buf)
         \
         if (PyInt_Check(obj)) val = (unsigned PY_LONG_LONG)PyInt_AsLong(obj); \
         else if (PyLong_Check(obj)) val = PyLong_AsUnsignedLongLong(obj); \
-        else return 0; \
+        else { \
+            PyErr_SetString(PyExc_TypeError, "an integer is required"); \
+            return 0; \
+        } \
         if (PyErr_Occurred()) \
             return 0; \
         if ((unsigned PY_LONG_LONG)(TYPE)val != val) { \
@@ -284,6 +377,7 @@ grow_buffer(PyObject **buf)
 #endif
 
 INT_TYPE_CONVERTER_FUNC(uint32_t, uint32_converter)
+INT_TYPE_CONVERTER_FUNC(uint64_t, uint64_converter)
 INT_TYPE_CONVERTER_FUNC(lzma_vli, lzma_vli_converter)
 INT_TYPE_CONVERTER_FUNC(lzma_mode, lzma_mode_converter)
 INT_TYPE_CONVERTER_FUNC(lzma_match_finder, lzma_mf_converter)
@@ -296,13 +390,48 @@ INT_TYPE_CONVERTER_FUNC(lzma_match_finder, lzma_mf_converter)
    This code handles converting filter specifiers (Python dicts) into
    the C lzma_filter structs expected by liblzma. */
 
+/* Copy the preset dictionary held by dict_obj to the end of options, in
+   the same block of memory, so that free_filter_chain() frees it along
+   with them. Frees options, and returns NULL, on failure. */
+static lzma_options_lzma *
+add_preset_dict(lzma_options_lzma *options, PyObject *dict_obj)
+{
+    Py_buffer dict;
+    lzma_options_lzma *grown;
+
+    if (PyObject_GetBuffer(dict_obj, &dict, PyBUF_SIMPLE) == -1) {
+        PyMem_Free(options);
+        return NULL;
+    }
+    if ((size_t)dict.len > UINT32_MAX) {
+        PyErr_SetString(PyExc_ValueError, "Preset dictionary is too large");
+        grown = NULL;
+    } else {
+        grown = (lzma_options_lzma *)PyMem_Realloc(options,
+                                                   sizeof *options + dict.len);
+        if (grown == NULL)
+            PyErr_NoMemory();
+    }
+    if (grown == NULL) {
+        PyMem_Free(options);
+    } else if (dict.len > 0) {
+        memcpy(grown + 1, dict.buf, dict.len);
+        grown->preset_dict = (uint8_t *)(grown + 1);
+        grown->preset_dict_size = (uint32_t)dict.len;
+    }
+    PyBuffer_Release(&dict);
+    return grown;
+}
+
 static void *
 parse_filter_spec_lzma(PyObject *spec)
 {
     static char *optnames[] = {"id", "preset", "dict_size", "lc", "lp",
-                               "pb", "mode", "nice_len", "mf", "depth", NULL};
+                               "pb", "mode", "nice_len", "mf", "depth",
+                               "preset_dict", NULL};
     PyObject *id;
     PyObject *preset_obj;
+    PyObject *preset_dict_obj = Py_None;
     uint32_t preset = LZMA_PRESET_DEFAULT;
     lzma_options_lzma *options;
 
@@ -334,7 +463,7 @@ parse_filter_spec_lzma(PyObject *spec)
     }
 
     if (!PyArg_ParseTupleAndKeywords(empty_tuple, spec,
-                                     "|OOO&O&O&O&O&O&O&O&", optnames,
+                                     "|OOO&O&O&O&O&O&O&O&O", optnames,
                                      &id, &preset_obj,
                                      uint32_converter, &options->dict_size,
                                      uint32_converter, &options->lc,
@@ -343,12 +472,15 @@ parse_filter_spec_lzma(PyObject *spec)
                                      lzma_mode_converter, &options->mode,
                                      uint32_converter, &options->nice_len,
                                      lzma_mf_converter, &options->mf,
-                                     uint32_converter, &options->depth)) {
+                                     uint32_converter, &options->depth,
+                                     &preset_dict_obj)) {
         PyErr_SetString(PyExc_ValueError,
                         "Invalid filter specifier for LZMA filter");
         PyMem_Free(options);
-        options = NULL;
+        return NULL;
     }
+    if (preset_dict_obj != Py_None)
+        options = add_preset_dict(options, preset_dict_obj);
     return options;
 }
 
@@ -464,6 +596,45 @@ free_filter_chain(lzma_filter filters[])
         PyMem_Free(filters[i].options);
 }
 
+/* Raise ValueError if any filter specifier in filterspecs (a sequence
+   of mappings, or None) has a preset dictionary. Neither .xz nor .lzma
+   files can record one, so these are only allowed with FORMAT_RAW. */
+static int
+check_no_preset_dict(PyObject *filterspecs)
+{
+    Py_ssize_t i, num_filters;
+
+    if (filterspecs == Py_None)
+        return 0;
+    num_filters = PySequence_Length(filterspecs);
+    if (num_filters == -1)
+        return -1;
+    for (i = 0; i < num_filters; i++) {
+        PyObject *spec, *dict_obj = NULL;
+
+        spec = PySequence_GetItem(filterspecs, i);
+        if (spec == NULL)
+            return -1;
+        if (PyMapping_Check(spec))
+            dict_obj = PyMapping_GetItemString(spec, "preset_dict");
+        Py_DECREF(spec);
+        if (dict_obj == NULL) {
+            /* Anything else wrong with the spec is reported when parsing
+               it. */
+            PyErr_Clear();
+            continue;
+        }
+        Py_DECREF(dict_obj);
+        if (dict_obj != Py_None) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Preset dictionaries are only supported by "
+                            "FORMAT_RAW");
+            return -1;
+        }
+    }
+    return 0;
+}
+
 static int
 parse_filter_chain_spec(lzma_filter filters[], PyObject *filterspecs)
 {
@@ -592,42 +763,68 @@ error:
 static PyObject *
 compress(Compressor *c, uint8_t *data, size_t len, lzma_action action)
 {
-    size_t data_size = 0;
-    PyObject *result;
-
-    result = PyBytes_FromStringAndSize(NULL, INITIAL_BUFFER_SIZE);
-    if (result == NULL)
+    OutputBuffer buffer;
+    /* Compressing a little input usually gives little output, so start
+       small; the buffer grows if more comes out. */
+    Py_ssize_t size_hint = 0;
+
+    if (len > 0 && len < OUTPUT_BUFFER_MIN_SIZE)
+        size_hint = len;
+    if (OutputBuffer_Init(&buffer, size_hint, -1,
+                          &c->lzs.next_out, &c->lzs.avail_out) == -1)
         return NULL;
     c->lzs.next_in = data;
     c->lzs.avail_in = len;
-    c->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result);
-    c->lzs.avail_out = PyBytes_GET_SIZE(result);
     for (;;) {
         lzma_ret lzret;
+        lzma_action step_action = action;
+        size_t held_back = 0;
+        size_t avail_in;
+
+        /* To end a block by hand, hold back the input beyond the end of
+           the block, and do a full flush once the block is complete. */
+        if (c->block_size != 0 && action == LZMA_RUN) {
+            if (c->block_remaining == 0 && c->lzs.avail_in > 0) {
+                step_action = LZMA_FULL_FLUSH;
+                held_back = c->lzs.avail_in;
+            } else if (c->lzs.avail_in > c->block_remaining) {
+                held_back = c->lzs.avail_in - (size_t)c->block_remaining;
+            }
+            c->lzs.avail_in -= held_back;
+        }
+        avail_in = c->lzs.avail_in;
 
         Py_BEGIN_ALLOW_THREADS
-        lzret = lzma_code(&c->lzs, action);
-        data_size = (char *)c->lzs.next_out - PyBytes_AS_STRING(result);
+        lzret = lzma_code(&c->lzs, step_action);
         Py_END_ALLOW_THREADS
+        if (c->block_size != 0)
+            c->block_remaining -= avail_in - c->lzs.avail_in;
+        c->lzs.avail_in += held_back;
         if (catch_lzma_error(lzret))
             goto error;
+        if (step_action == LZMA_FULL_FLUSH) {
+            if (lzret == LZMA_STREAM_END)
+                c->block_remaining = c->block_size;
+            else if (c->lzs.avail_out == 0) {
+                if (OutputBuffer_Grow(&buffer, &c->lzs.next_out,
+                                      &c->lzs.avail_out) == -1)
+                    goto error;
+            }
+            continue;
+        }
         if ((action == LZMA_RUN && c->lzs.avail_in == 0) ||
             (action == LZMA_FINISH && lzret == LZMA_STREAM_END)) {
             break;
         } else if (c->lzs.avail_out == 0) {
-            if (grow_buffer(&result) == -1)
+            if (OutputBuffer_Grow(&buffer, &c->lzs.next_out,
+                                  &c->lzs.avail_out) == -1)
                 goto error;
-            c->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
-            c->lzs.avail_out = PyBytes_GET_SIZE(result) - data_size;
         }
     }
-    if (data_size != PyBytes_GET_SIZE(result))
-        if (_PyBytes_Resize(&result, data_size) == -1)
-            goto error;
-    return result;
+    return OutputBuffer_Finish(&buffer, c->lzs.avail_out);
 
 error:
-    Py_XDECREF(result);
+    OutputBuffer_OnError(&buffer);
     return NULL;
 }
 
@@ -691,10 +888,44 @@ Compressor_flush(Compressor *self, PyObject *noargs)
 
 static int
 Compressor_init_xz(lzma_stream *lzs, int check, uint32_t preset,
-                   PyObject *filterspecs)
+                   PyObject *filterspecs, uint32_t threads,
+                   uint64_t block_size)
 {
     lzma_ret lzret;
 
+#ifdef HAVE_ENCODER_MT
+    if (threads != 1 || block_size != 0) {
+        lzma_mt mt_options;
+        lzma_filter filters[LZMA_FILTERS_MAX + 1];
+
+        memset(&mt_options, 0, sizeof mt_options);
+        mt_options.threads = threads;
+        if (threads == 0) {
+            mt_options.threads = lzma_cputhreads();
+            if (mt_options.threads == 0)
+                mt_options.threads = 1;
+        }
+        mt_options.block_size = block_size;
+        mt_options.preset = preset;
+        mt_options.check = check;
+        if (filterspecs != Py_None) {
+            if (parse_filter_chain_spec(filters, filterspecs) == -1)
+                return -1;
+            mt_options.filters = filters;
+        }
+        lzret = lzma_stream_encoder_mt(lzs, &mt_options);
+        if (filterspecs != Py_None)
+            free_filter_chain(filters);
+        if (catch_lzma_error(lzret))
+            return -1;
+        else
+            return 0;
+    }
+#endif
+
+    /* Without the multithreaded encoder, fall back to the single-threaded
+       one. The output is still valid; LZMACompressor ends each block
+       itself if block_size is given. */
     if (filterspecs == Py_None) {
         lzret = lzma_easy_encoder(lzs, preset, check);
     } else {
@@ -770,17 +1001,22 @@ Compressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
 static int
 Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
 {
-    static char *arg_names[] = {"format", "check", "preset", "filters", NULL};
+    static char *arg_names[] = {"format", "check", "preset", "filters",
+                                "threads", "block_size", NULL};
     int format = FORMAT_XZ;
     int check = -1;
     uint32_t preset = LZMA_PRESET_DEFAULT;
     PyObject *preset_obj = Py_None;
     PyObject *filterspecs = Py_None;
+    uint32_t threads = 1;
+    uint64_t block_size = 0;
 
     if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|iiOO:LZMACompressor", arg_names,
+                                     "|iiOOO&O&:LZMACompressor", arg_names,
                                      &format, &check, &preset_obj,
-                                     &filterspecs))
+                                     &filterspecs,
+                                     uint32_converter, &threads,
+                                     lzma_vli_converter, &block_size))
         return -1;
 
     if (format != FORMAT_XZ && check != -1 && check != LZMA_CHECK_NONE) {
@@ -789,6 +1025,13 @@ Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
         return -1;
     }
 
+    if (format != FORMAT_XZ && (threads != 1 || block_size != 0)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Multithreaded compression and block sizes are "
+                        "only supported by FORMAT_XZ");
+        return -1;
+    }
+
     if (preset_obj != Py_None && filterspecs != Py_None) {
         PyErr_SetString(PyExc_ValueError,
                         "Cannot specify both preset and filter chain");
@@ -799,6 +1042,9 @@ Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
         if (!uint32_converter(preset_obj, &preset))
             return -1;
 
+    if (format != FORMAT_RAW && check_no_preset_dict(filterspecs) == -1)
+        return -1;
+
 #ifdef WITH_THREAD
     self->lock = PyThread_allocate_lock();
     if (self->lock == NULL) {
@@ -808,11 +1054,17 @@ Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
 #endif
 
     self->flushed = 0;
+    self->block_size = 0;
     switch (format) {
         case FORMAT_XZ:
             if (check == -1)
                 check = LZMA_CHECK_CRC64;
-            if (Compressor_init_xz(&self->lzs, check, preset, filterspecs) != 0)
+#ifndef HAVE_ENCODER_MT
+            /* Without the multithreaded encoder, end blocks by hand. */
+            self->block_size = self->block_remaining = block_size;
+#endif
+            if (Compressor_init_xz(&self->lzs, check, preset, filterspecs,
+                                   threads, block_size) != 0)
                 break;
             return 0;
 
@@ -859,7 +1111,8 @@ static PyMethodDef Compressor_methods[] = {
 };
 
 PyDoc_STRVAR(Compressor_doc,
-"LZMACompressor(format=FORMAT_XZ, check=-1, preset=None, filters=None)\n"
+"LZMACompressor(format=FORMAT_XZ, check=-1, preset=None, filters=None,\n"
+"               threads=1, block_size=0)\n"
 "\n"
 "Create a compressor object for compressing data incrementally.\n"
 "\n"
@@ -882,7 +1135,19 @@ PyDoc_STRVAR(Compressor_doc,
 "\n"
 "filters (if provided) should be a sequence of dicts. Each dict should\n"
 "have an entry for \"id\" indicating the ID of the filter, plus\n"
-"additional entries for options to the filter.\n"
+"additional entries for options to the filter. With FORMAT_RAW, the\n"
+"options of an LZMA1 or LZMA2 filter can include \"preset_dict\", a\n"
+"bytes-like object to prime the dictionary with; the same dictionary\n"
+"must then be given to the decompressor.\n"
+"\n"
+"threads and block_size are only supported by FORMAT_XZ. threads is the\n"
+"number of threads used to compress the input, or 0 for one per CPU\n"
+"core. block_size is the uncompressed size of each block in the output;\n"
+"by default, liblzma picks a size based on the compression settings.\n"
+"If threads is not 1, or block_size is given, the input is split into\n"
+"independent blocks, which are compressed in parallel. When the linked\n"
+"liblzma has no multithreaded encoder, the input is compressed by a\n"
+"single thread, and is only split into blocks if block_size is given.\n"
 "\n"
 "For one-shot compression, use the compress() function instead.\n");
 
@@ -930,94 +1195,272 @@ static PyTypeObject Compressor_type = {
 
 /* LZMADecompressor class. */
 
+/* Decompress the input set up by set_input(), until it is all consumed,
+   the end of the stream is reached, or max_length bytes have been output
+   (if max_length is not negative). */
 static PyObject *
-decompress(Decompressor *d, uint8_t *data, size_t len)
+decompress_buf(Decompressor *d, Py_ssize_t max_length)
 {
-    size_t data_size = 0;
-    PyObject *result;
-
-    result = PyBytes_FromStringAndSize(NULL, INITIAL_BUFFER_SIZE);
-    if (result == NULL)
+    OutputBuffer buffer;
+    /* Size the buffer for a few times as much output as there is input,
+       so that decompressing a little data allocates little; the buffer
+       grows if more comes out. */
+    Py_ssize_t size_hint = 0;
+
+    if (d->lzs.avail_in > 0 && d->lzs.avail_in < OUTPUT_BUFFER_MIN_SIZE / 4)
+        size_hint = 4 * d->lzs.avail_in;
+    if (OutputBuffer_Init(&buffer, size_hint, max_length,
+                          &d->lzs.next_out, &d->lzs.avail_out) == -1)
         return NULL;
-    d->lzs.next_in = data;
-    d->lzs.avail_in = len;
-    d->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result);
-    d->lzs.avail_out = PyBytes_GET_SIZE(result);
     for (;;) {
         lzma_ret lzret;
 
         Py_BEGIN_ALLOW_THREADS
         lzret = lzma_code(&d->lzs, LZMA_RUN);
-        data_size = (char *)d->lzs.next_out - PyBytes_AS_STRING(result);
         Py_END_ALLOW_THREADS
+        if (lzret == LZMA_BUF_ERROR && d->lzs.avail_in == 0 &&
+            d->lzs.avail_out > 0)
+            lzret = LZMA_OK; /* No more input to process; not an error. */
         if (catch_lzma_error(lzret))
             goto error;
         if (lzret == LZMA_GET_CHECK || lzret == LZMA_NO_CHECK)
             d->check = lzma_get_check(&d->lzs);
         if (lzret == LZMA_STREAM_END) {
             d->eof = 1;
-            if (d->lzs.avail_in > 0) {
-                Py_CLEAR(d->unused_data);
-                d->unused_data = PyBytes_FromStringAndSize(
-                        (char *)d->lzs.next_in, d->lzs.avail_in);
-                if (d->unused_data == NULL)
-                    goto error;
-            }
-            break;
-        } else if (d->lzs.avail_in == 0) {
             break;
         } else if (d->lzs.avail_out == 0) {
-            if (grow_buffer(&result) == -1)
+            if (OutputBuffer_Size(&buffer, 0) == max_length)
+                break;
+            if (OutputBuffer_Grow(&buffer, &d->lzs.next_out,
+                                  &d->lzs.avail_out) == -1)
                 goto error;
-            d->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
-            d->lzs.avail_out = PyBytes_GET_SIZE(result) - data_size;
+        } else if (d->lzs.avail_in == 0) {
+            break;
         }
     }
-    if (data_size != PyBytes_GET_SIZE(result))
-        if (_PyBytes_Resize(&result, data_size) == -1)
-            goto error;
-    return result;
+    return OutputBuffer_Finish(&buffer, d->lzs.avail_out);
 
 error:
-    Py_XDECREF(result);
+    OutputBuffer_OnError(&buffer);
     return NULL;
 }
 
+/* Decompress the input set up by set_input() into a caller's buffer, until
+   the buffer is full, the input is all consumed, or the end of the stream
+   is reached. Returns the number of bytes written, or -1 on error. */
+static Py_ssize_t
+decompress_into_buf(Decompressor *d, uint8_t *out, size_t size)
+{
+    d->lzs.next_out = out;
+    d->lzs.avail_out = size;
+    while (d->lzs.avail_out > 0) {
+        lzma_ret lzret;
+
+        Py_BEGIN_ALLOW_THREADS
+        lzret = lzma_code(&d->lzs, LZMA_RUN);
+        Py_END_ALLOW_THREADS
+        if (lzret == LZMA_BUF_ERROR && d->lzs.avail_in == 0)
+            lzret = LZMA_OK; /* No more input to process; not an error. */
+        if (catch_lzma_error(lzret))
+            return -1;
+        if (lzret == LZMA_GET_CHECK || lzret == LZMA_NO_CHECK)
+            d->check = lzma_get_check(&d->lzs);
+        if (lzret == LZMA_STREAM_END) {
+            d->eof = 1;
+            break;
+        } else if (d->lzs.avail_in == 0) {
+            break;
+        }
+    }
+    return size - d->lzs.avail_out;
+}
+
+/* Point the decoder at its input for this call: the input left over by an
+   earlier call, if any, followed by data. Returns 1 if the input was put
+   together in d->input_buffer, 0 if it is data itself, or -1 on error. */
+static int
+set_input(Decompressor *d, uint8_t *data, size_t len)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    if (lzs->next_in == NULL) {
+        lzs->next_in = data;
+        lzs->avail_in = len;
+        return 0;
+    }
+    if (d->input_buffer_size - lzs->avail_in < len) {
+        size_t offset = lzs->next_in - d->input_buffer;
+        uint8_t *tmp = PyMem_Realloc(d->input_buffer, offset + lzs->avail_in + len);
+
+        if (tmp == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        d->input_buffer = tmp;
+        d->input_buffer_size = offset + lzs->avail_in + len;
+        lzs->next_in = d->input_buffer + offset;
+    } else if ((size_t)(d->input_buffer + d->input_buffer_size -
+                        (lzs->next_in + lzs->avail_in)) < len) {
+        memmove(d->input_buffer, lzs->next_in, lzs->avail_in);
+        lzs->next_in = d->input_buffer;
+    }
+    memcpy((uint8_t *)lzs->next_in + lzs->avail_in, data, len);
+    lzs->avail_in += len;
+    return 1;
+}
+
+/* Deal with the input the decoder has not consumed: at the end of the
+   stream, it is saved in unused_data; otherwise, it is kept for the next
+   call, copying it into d->input_buffer if it is still in the caller's
+   data. Returns -1 on error. */
+static int
+keep_input(Decompressor *d, int input_buffer_in_use)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    if (d->eof) {
+        d->needs_input = 0;
+        if (lzs->avail_in > 0) {
+            Py_CLEAR(d->unused_data);
+            d->unused_data = PyBytes_FromStringAndSize(
+                    (char *)lzs->next_in, lzs->avail_in);
+            if (d->unused_data == NULL)
+                return -1;
+        }
+    } else if (lzs->avail_in == 0) {
+        lzs->next_in = NULL;
+        /* If the output filled up, the decoder may still have some output
+           to give without more input. */
+        d->needs_input = lzs->avail_out > 0;
+    } else {
+        d->needs_input = 0;
+        if (!input_buffer_in_use) {
+            if (d->input_buffer_size < lzs->avail_in) {
+                uint8_t *tmp = PyMem_Realloc(d->input_buffer, lzs->avail_in);
+
+                if (tmp == NULL) {
+                    lzs->next_in = NULL;
+                    PyErr_NoMemory();
+                    return -1;
+                }
+                d->input_buffer = tmp;
+                d->input_buffer_size = lzs->avail_in;
+            }
+            memcpy(d->input_buffer, lzs->next_in, lzs->avail_in);
+            lzs->next_in = d->input_buffer;
+        }
+    }
+    return 0;
+}
+
 PyDoc_STRVAR(Decompressor_decompress_doc,
-"decompress(data) -> bytes\n"
+"decompress(data, max_length=-1) -> bytes\n"
 "\n"
 "Provide data to the decompressor object. Returns a chunk of\n"
 "decompressed data if possible, or b\"\" otherwise.\n"
 "\n"
+"If max_length is non-negative, returns at most max_length bytes of\n"
+"decompressed data. If this limit is reached and further output can be\n"
+"produced, the needs_input attribute is set to False, and the rest of\n"
+"the input is kept by the decompressor. In this case, the next call to\n"
+"decompress() may provide data as b\"\" to obtain more of the output.\n"
+"\n"
 "Attempting to decompress data after the end of the stream is\n"
 "reached raises an EOFError. Any data found after the end of the\n"
 "stream is ignored, and saved in the unused_data attribute.\n");
 
 static PyObject *
-Decompressor_decompress(Decompressor *self, PyObject *args)
+Decompressor_decompress(Decompressor *self, PyObject *args, PyObject *kwargs)
 {
+    static char *arg_names[] = {"data", "max_length", NULL};
     Py_buffer buffer;
+    Py_ssize_t max_length = -1;
     PyObject *result = NULL;
+    int input_buffer_in_use;
 
 #if PY_MAJOR_VERSION >= 3  
     /* Type code 'y' for bytes on Python 3 */
-    if (!PyArg_ParseTuple(args, "y*:decompress", &buffer))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|n:decompress",
+                                     arg_names, &buffer, &max_length))
 #else
     /* Type code 's' for string on Python 2 */
-    if (!PyArg_ParseTuple(args, "s*:decompress", &buffer))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|n:decompress",
+                                     arg_names, &buffer, &max_length))
 #endif
         return NULL;
 
     ACQUIRE_LOCK(self);
-    if (self->eof)
+    if (self->eof) {
         PyErr_SetString(PyExc_EOFError, "Already at end of stream");
-    else
-        result = decompress(self, buffer.buf, buffer.len);
+        goto done;
+    }
+    input_buffer_in_use = set_input(self, buffer.buf, buffer.len);
+    if (input_buffer_in_use == -1)
+        goto done;
+    result = decompress_buf(self, max_length);
+    if (result == NULL)
+        self->lzs.next_in = NULL;
+    else if (keep_input(self, input_buffer_in_use) == -1)
+        Py_CLEAR(result);
+done:
     RELEASE_LOCK(self);
     PyBuffer_Release(&buffer);
     return result;
 }
 
+PyDoc_STRVAR(Decompressor_decompress_into_doc,
+"decompress_into(buffer, data=b\"\") -> int\n"
+"\n"
+"Provide data to the decompressor object, and decompress as much as\n"
+"fits into buffer, a writable bytes-like object. Returns the number of\n"
+"bytes written to the start of buffer.\n"
+"\n"
+"Input that is not consumed because buffer is full is kept by the\n"
+"decompressor, and decompressed by the next call, ahead of any new data.\n"
+"needs_input is False while this is the case, or while the decompressor\n"
+"may have more output to give without further input.\n"
+"\n"
+"Attempting to decompress data after the end of the stream is\n"
+"reached raises an EOFError. Any data found after the end of the\n"
+"stream is ignored, and saved in the unused_data attribute.\n");
+
+static PyObject *
+Decompressor_decompress_into(Decompressor *self, PyObject *args)
+{
+    Py_buffer out, data;
+    Py_ssize_t written = -1;
+    int input_buffer_in_use;
+
+    memset(&data, 0, sizeof(data));
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "w*|y*:decompress_into", &out, &data))
+#else
+    if (!PyArg_ParseTuple(args, "w*|s*:decompress_into", &out, &data))
+#endif
+        return NULL;
+
+    ACQUIRE_LOCK(self);
+    if (self->eof) {
+        PyErr_SetString(PyExc_EOFError, "Already at end of stream");
+        goto done;
+    }
+    input_buffer_in_use = set_input(self, data.buf, data.len);
+    if (input_buffer_in_use == -1)
+        goto done;
+    written = decompress_into_buf(self, out.buf, out.len);
+    if (written == -1)
+        self->lzs.next_in = NULL;
+    else if (keep_input(self, input_buffer_in_use) == -1)
+        written = -1;
+done:
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&data);
+    if (written == -1)
+        return NULL;
+    return PyLong_FromSsize_t(written);
+}
+
 static int
 Decompressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
 {
@@ -1034,21 +1477,85 @@ Decompressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
         return 0;
 }
 
+static int
+Decompressor_init_xz(lzma_stream *lzs, uint64_t memlimit, uint32_t flags,
+                     uint32_t threads, PyObject *memlimit_threading_obj)
+{
+    lzma_ret lzret;
+    uint64_t memlimit_threading = 0;
+
+    /* Check the argument even where the multithreaded decoder is missing
+       and it goes unused. */
+    if (memlimit_threading_obj != Py_None &&
+        !lzma_vli_converter(memlimit_threading_obj, &memlimit_threading))
+        return -1;
+
+#ifdef HAVE_DECODER_MT
+    if (threads != 1) {
+        lzma_mt mt_options;
+
+        memset(&mt_options, 0, sizeof mt_options);
+        mt_options.flags = flags;
+        mt_options.threads = threads;
+        if (threads == 0) {
+            mt_options.threads = lzma_cputhreads();
+            if (mt_options.threads == 0)
+                mt_options.threads = 1;
+        }
+        mt_options.memlimit_stop = memlimit;
+        if (memlimit_threading_obj != Py_None) {
+            mt_options.memlimit_threading = memlimit_threading;
+        } else {
+            /* The starting point suggested by liblzma's documentation. */
+            mt_options.memlimit_threading = lzma_physmem() / 4;
+            if (mt_options.memlimit_threading == 0)
+                mt_options.memlimit_threading = memlimit;
+        }
+        lzret = lzma_stream_decoder_mt(lzs, &mt_options);
+        if (catch_lzma_error(lzret))
+            return -1;
+        else
+            return 0;
+    }
+#endif
+
+    /* Without the multithreaded decoder, fall back to the single-threaded
+       one, which gives the same output. */
+    lzret = lzma_stream_decoder(lzs, memlimit, flags);
+    if (catch_lzma_error(lzret))
+        return -1;
+    else
+        return 0;
+}
+
 static int
 Decompressor_init(Decompressor *self, PyObject *args, PyObject *kwargs)
 {
-    static char *arg_names[] = {"format", "memlimit", "filters", NULL};
+    static char *arg_names[] = {"format", "memlimit", "filters", "threads",
+                                "memlimit_threading", NULL};
     const uint32_t decoder_flags = LZMA_TELL_ANY_CHECK | LZMA_TELL_NO_CHECK;
     int format = FORMAT_AUTO;
     uint64_t memlimit = UINT64_MAX;
     PyObject *memlimit_obj = Py_None;
     PyObject *filterspecs = Py_None;
+    uint32_t threads = 1;
+    PyObject *memlimit_threading_obj = Py_None;
     lzma_ret lzret;
 
     if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|iOO:LZMADecompressor", arg_names,
-                                     &format, &memlimit_obj, &filterspecs))
+                                     "|iOOO&O:LZMADecompressor", arg_names,
+                                     &format, &memlimit_obj, &filterspecs,
+                                     uint32_converter, &threads,
+                                     &memlimit_threading_obj))
+        return -1;
+
+    if (format != FORMAT_XZ &&
+        (threads != 1 || memlimit_threading_obj != Py_None)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Multithreaded decompression is only supported "
+                        "by FORMAT_XZ");
         return -1;
+    }
 
     if (memlimit_obj != Py_None) {
         if (format == FORMAT_RAW) {
@@ -1089,6 +1596,7 @@ Decompressor_init(Decompressor *self, PyObject *args, PyObject *kwargs)
 #endif
 
     self->check = LZMA_CHECK_UNKNOWN;
+    self->needs_input = 1;
     self->unused_data = PyBytes_FromStringAndSize(NULL, 0);
     if (self->unused_data == NULL)
         goto error;
@@ -1101,8 +1609,8 @@ Decompressor_init(Decompressor *self, PyObject *args, PyObject *kwargs)
             return 0;
 
         case FORMAT_XZ:
-            lzret = lzma_stream_decoder(&self->lzs, memlimit, decoder_flags);
-            if (catch_lzma_error(lzret))
+            if (Decompressor_init_xz(&self->lzs, memlimit, decoder_flags,
+                                     threads, memlimit_threading_obj) == -1)
                 break;
             return 0;
 
@@ -1139,6 +1647,8 @@ Decompressor_dealloc(Decompressor *self)
 {
     lzma_end(&self->lzs);
     Py_CLEAR(self->unused_data);
+    if (self->input_buffer != NULL)
+        PyMem_Free(self->input_buffer);
 #ifdef WITH_THREAD
     if (self->lock != NULL)
         PyThread_free_lock(self->lock);
@@ -1147,8 +1657,10 @@ Decompressor_dealloc(Decompressor *self)
 }
 
 static PyMethodDef Decompressor_methods[] = {
-    {"decompress", (PyCFunction)Decompressor_decompress, METH_VARARGS,
-     Decompressor_decompress_doc},
+    {"decompress", (PyCFunction)Decompressor_decompress,
+     METH_VARARGS | METH_KEYWORDS, Decompressor_decompress_doc},
+    {"decompress_into", (PyCFunction)Decompressor_decompress_into,
+     METH_VARARGS, Decompressor_decompress_into_doc},
     {NULL}
 };
 
@@ -1161,6 +1673,10 @@ PyDoc_STRVAR(Decompressor_eof_doc,
 PyDoc_STRVAR(Decompressor_unused_data_doc,
 "Data found after the end of the compressed stream.");
 
+PyDoc_STRVAR(Decompressor_needs_input_doc,
+"False if decompress() or decompress_into() can give more output\n"
+"before being provided with more input.");
+
 static PyMemberDef Decompressor_members[] = {
     {"check", T_INT, offsetof(Decompressor, check), READONLY,
      Decompressor_check_doc},
@@ -1168,11 +1684,14 @@ static PyMemberDef Decompressor_members[] = {
      Decompressor_eof_doc},
     {"unused_data", T_OBJECT_EX, offsetof(Decompressor, unused_data), READONLY,
      Decompressor_unused_data_doc},
+    {"needs_input", T_BOOL, offsetof(Decompressor, needs_input), READONLY,
+     Decompressor_needs_input_doc},
     {NULL}
 };
 
 PyDoc_STRVAR(Decompressor_doc,
-"LZMADecompressor(format=FORMAT_AUTO, memlimit=None, filters=None)\n"
+"LZMADecompressor(format=FORMAT_AUTO, memlimit=None, filters=None,\n"
+"                 threads=1, memlimit_threading=None)\n"
 "\n"
 "Create a decompressor object for decompressing data incrementally.\n"
 "\n"
@@ -1190,6 +1709,16 @@ PyDoc_STRVAR(Decompressor_doc,
 "this should be a sequence of dicts, each indicating the ID and options\n"
 "for a single filter.\n"
 "\n"
+"threads and memlimit_threading are only supported by FORMAT_XZ.\n"
+"threads is the number of threads used to decompress the input, or 0 for\n"
+"one per CPU core. Only streams made of several blocks, with their sizes\n"
+"stored in the block headers, are decompressed in parallel.\n"
+"memlimit_threading is the memory usage above which the decompressor\n"
+"reduces the number of threads, down to a single thread; it defaults to\n"
+"a quarter of the physical memory. When the linked liblzma has no\n"
+"multithreaded decoder, both are ignored, and the input is decompressed\n"
+"by a single thread.\n"
+"\n"
 "For one-shot decompression, use the decompress() function instead.\n");
 
 static PyTypeObject Decompressor_type = {
@@ -1341,6 +1870,833 @@ _decode_filter_properties(PyObject *self, PyObject *args)
 }
 
 
+PyDoc_STRVAR(_decode_stream_footer_doc,
+"_decode_stream_footer(footer) -> (backward_size, check)\n"
+"\n"
+"Decode the STREAM_HEADER_SIZE-byte footer found at the end of an .xz\n"
+"stream. Returns the size of the stream's index (in bytes), and the ID\n"
+"of the integrity check used by the stream.\n");
+
+static PyObject *
+_decode_stream_footer(PyObject *self, PyObject *args)
+{
+    Py_buffer footer;
+    lzma_stream_flags flags;
+    lzma_ret lzret;
+
+#if PY_MAJOR_VERSION >= 3
+    /* Type code 'y' for bytes on Python 3 */
+    if (!PyArg_ParseTuple(args, "y*:_decode_stream_footer", &footer))
+#else
+    /* Type code 's' for string on Python 2 */
+    if (!PyArg_ParseTuple(args, "s*:_decode_stream_footer", &footer))
+#endif
+        return NULL;
+
+    if (footer.len != LZMA_STREAM_HEADER_SIZE) {
+        PyBuffer_Release(&footer);
+        PyErr_Format(PyExc_ValueError,
+                     "Stream footer must be %d bytes long",
+                     LZMA_STREAM_HEADER_SIZE);
+        return NULL;
+    }
+    lzret = lzma_stream_footer_decode(&flags, footer.buf);
+    PyBuffer_Release(&footer);
+    if (catch_lzma_error(lzret))
+        return NULL;
+
+    return Py_BuildValue("Ki", (unsigned PY_LONG_LONG)flags.backward_size,
+                         (int)flags.check);
+}
+
+
+PyDoc_STRVAR(_decode_index_doc,
+"_decode_index(index) -> (stream_size, uncompressed_size, blocks)\n"
+"\n"
+"Decode the index field of a single .xz stream, as located using the\n"
+"stream footer.\n"
+"\n"
+"stream_size is the total size of the stream, from the start of its\n"
+"header to the end of its footer (excluding any stream padding).\n"
+"blocks is a list of (compressed_offset, uncompressed_offset,\n"
+"compressed_size, uncompressed_size) tuples, one per block, with\n"
+"offsets relative to the start of the stream.\n");
+
+static PyObject *
+_decode_index(PyObject *self, PyObject *args)
+{
+    Py_buffer index_data;
+    lzma_index *index = NULL;
+    lzma_index_iter iter;
+    uint64_t memlimit = UINT64_MAX;
+    size_t in_pos = 0;
+    lzma_ret lzret;
+    PyObject *blocks = NULL;
+    PyObject *result = NULL;
+
+#if PY_MAJOR_VERSION >= 3
+    /* Type code 'y' for bytes on Python 3 */
+    if (!PyArg_ParseTuple(args, "y*:_decode_index", &index_data))
+#else
+    /* Type code 's' for string on Python 2 */
+    if (!PyArg_ParseTuple(args, "s*:_decode_index", &index_data))
+#endif
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    lzret = lzma_index_buffer_decode(&index, &memlimit, NULL,
+                                     index_data.buf, &in_pos, index_data.len);
+    Py_END_ALLOW_THREADS
+    if (catch_lzma_error(lzret))
+        goto done;
+    if (in_pos != (size_t)index_data.len) {
+        PyErr_SetString(Error, "Corrupt input data");
+        goto done;
+    }
+
+    blocks = PyList_New(0);
+    if (blocks == NULL)
+        goto done;
+    lzma_index_iter_init(&iter, index);
+    while (!lzma_index_iter_next(&iter, LZMA_INDEX_ITER_BLOCK)) {
+        int ok;
+        PyObject *block = Py_BuildValue(
+                "KKKK",
+                (unsigned PY_LONG_LONG)iter.block.compressed_stream_offset,
+                (unsigned PY_LONG_LONG)iter.block.uncompressed_stream_offset,
+                (unsigned PY_LONG_LONG)iter.block.total_size,
+                (unsigned PY_LONG_LONG)iter.block.uncompressed_size);
+        if (block == NULL)
+            goto done;
+        ok = PyList_Append(blocks, block);
+        Py_DECREF(block);
+        if (ok == -1)
+            goto done;
+    }
+
+    result = Py_BuildValue("KKO",
+                           (unsigned PY_LONG_LONG)lzma_index_stream_size(index),
+                           (unsigned PY_LONG_LONG)lzma_index_uncompressed_size(index),
+                           blocks);
+
+done:
+    Py_XDECREF(blocks);
+    if (index != NULL)
+        lzma_index_end(index, NULL);
+    PyBuffer_Release(&index_data);
+    return result;
+}
+
+
+PyDoc_STRVAR(_merge_indexes_doc,
+"_merge_indexes(indexes) -> bytes\n"
+"\n"
+"Merge the index fields of several .xz streams into the index field of\n"
+"a single stream, holding all of their blocks in order.\n");
+
+static PyObject *
+_merge_indexes(PyObject *self, PyObject *args)
+{
+    PyObject *indexes, *seq;
+    lzma_index *merged = NULL;
+    Py_ssize_t i;
+    size_t out_pos = 0;
+    lzma_ret lzret;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "O:_merge_indexes", &indexes))
+        return NULL;
+    seq = PySequence_Fast(indexes, "indexes must be a sequence");
+    if (seq == NULL)
+        return NULL;
+
+    merged = lzma_index_init(NULL);
+    if (merged == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++) {
+        Py_buffer index_data;
+        lzma_index *index = NULL;
+        lzma_index_iter iter;
+        uint64_t memlimit = UINT64_MAX;
+        size_t in_pos = 0;
+
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i),
+                               &index_data, PyBUF_SIMPLE) == -1)
+            goto done;
+        lzret = lzma_index_buffer_decode(&index, &memlimit, NULL,
+                                         index_data.buf, &in_pos,
+                                         index_data.len);
+        if (lzret == LZMA_OK && in_pos != (size_t)index_data.len) {
+            lzma_index_end(index, NULL);
+            lzret = LZMA_DATA_ERROR;
+        }
+        PyBuffer_Release(&index_data);
+        if (catch_lzma_error(lzret))
+            goto done;
+
+        lzma_index_iter_init(&iter, index);
+        while (!lzma_index_iter_next(&iter, LZMA_INDEX_ITER_BLOCK)) {
+            lzret = lzma_index_append(merged, NULL, iter.block.unpadded_size,
+                                      iter.block.uncompressed_size);
+            if (lzret != LZMA_OK)
+                break;
+        }
+        lzma_index_end(index, NULL);
+        if (catch_lzma_error(lzret))
+            goto done;
+    }
+
+    result = PyBytes_FromStringAndSize(NULL, lzma_index_size(merged));
+    if (result == NULL)
+        goto done;
+    lzret = lzma_index_buffer_encode(merged, (uint8_t *)PyBytes_AS_STRING(result),
+                                     &out_pos, PyBytes_GET_SIZE(result));
+    if (catch_lzma_error(lzret))
+        Py_CLEAR(result);
+
+done:
+    if (merged != NULL)
+        lzma_index_end(merged, NULL);
+    Py_DECREF(seq);
+    return result;
+}
+
+
+PyDoc_STRVAR(_encode_stream_footer_doc,
+"_encode_stream_footer(backward_size, check) -> bytes\n"
+"\n"
+"Encode the footer of an .xz stream whose index field is backward_size\n"
+"bytes long, and which uses the integrity check with the given ID.\n");
+
+static PyObject *
+_encode_stream_footer(PyObject *self, PyObject *args)
+{
+    lzma_stream_flags flags;
+    int check;
+    lzma_ret lzret;
+    PyObject *result;
+
+    memset(&flags, 0, sizeof(flags));
+    if (!PyArg_ParseTuple(args, "O&i:_encode_stream_footer",
+                          lzma_vli_converter, &flags.backward_size, &check))
+        return NULL;
+    flags.check = check;
+
+    result = PyBytes_FromStringAndSize(NULL, LZMA_STREAM_HEADER_SIZE);
+    if (result == NULL)
+        return NULL;
+    lzret = lzma_stream_footer_encode(&flags, (uint8_t *)PyBytes_AS_STRING(result));
+    if (catch_lzma_error(lzret)) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    return result;
+}
+
+
+PyDoc_STRVAR(_decompress_sized_doc,
+"_decompress_sized(data, format, size, memlimit=None) -> bytes\n"
+"\n"
+"Decompress data, a sequence of complete FORMAT_XZ or FORMAT_ALONE\n"
+"streams holding size bytes of data in total, into a single bytes\n"
+"object allocated up front.\n"
+"\n"
+"Raises LZMAError if data does not decompress to exactly size bytes.\n");
+
+static PyObject *
+_decompress_sized(PyObject *self, PyObject *args)
+{
+    Py_buffer data;
+    int format;
+    Py_ssize_t size;
+    uint64_t memlimit = UINT64_MAX;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    lzma_ret lzret = LZMA_OK;
+    size_t in_pos = 0, out_pos = 0;
+    uint8_t *out;
+    PyObject *result = NULL;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y*in|O&:_decompress_sized", &data, &format,
+                          &size, uint64_converter, &memlimit))
+#else
+    if (!PyArg_ParseTuple(args, "s*in|O&:_decompress_sized", &data, &format,
+                          &size, uint64_converter, &memlimit))
+#endif
+        return NULL;
+    if (format != FORMAT_AUTO && format != FORMAT_XZ && format != FORMAT_ALONE) {
+        PyErr_Format(PyExc_ValueError, "Invalid container format: %d", format);
+        goto done;
+    }
+    if (size < 0) {
+        PyErr_SetString(PyExc_ValueError, "size must not be negative");
+        goto done;
+    }
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (result == NULL)
+        goto done;
+    out = (uint8_t *)PyBytes_AS_STRING(result);
+
+    Py_BEGIN_ALLOW_THREADS
+    /* Decode one stream after another, each straight after the last. */
+    while (in_pos < (size_t)data.len) {
+        switch (format) {
+            case FORMAT_AUTO:
+                lzret = lzma_auto_decoder(&lzs, memlimit, 0);
+                break;
+            case FORMAT_XZ:
+                lzret = lzma_stream_decoder(&lzs, memlimit, 0);
+                break;
+            case FORMAT_ALONE:
+                lzret = lzma_alone_decoder(&lzs, memlimit);
+                break;
+        }
+        if (lzret != LZMA_OK)
+            break;
+        lzs.next_in = (uint8_t *)data.buf + in_pos;
+        lzs.avail_in = data.len - in_pos;
+        lzs.next_out = out + out_pos;
+        lzs.avail_out = size - out_pos;
+        do {
+            lzret = lzma_code(&lzs, LZMA_FINISH);
+        } while (lzret == LZMA_OK);
+        in_pos = (uint8_t *)lzs.next_in - (uint8_t *)data.buf;
+        out_pos = lzs.next_out - out;
+        if (lzret != LZMA_STREAM_END)
+            break;
+    }
+    lzma_end(&lzs);
+    Py_END_ALLOW_THREADS
+
+    if (lzret != LZMA_STREAM_END && lzret != LZMA_OK) {
+        /* Running out of room means size was wrong, not the buffer. */
+        catch_lzma_error(lzret == LZMA_BUF_ERROR ? LZMA_DATA_ERROR : lzret);
+        Py_CLEAR(result);
+    } else if (out_pos != (size_t)size || data.len == 0) {
+        PyErr_SetString(Error, "Corrupt input data");
+        Py_CLEAR(result);
+    }
+
+done:
+    PyBuffer_Release(&data);
+    return result;
+}
+
+
+PyDoc_STRVAR(_compress_buffer_doc,
+"_compress_buffer(data, check=-1, preset=None, filters=None) -> bytes\n"
+"\n"
+"Compress data into a single FORMAT_XZ stream in one call, writing it\n"
+"to a buffer sized for the worst case, which is shrunk to fit. The\n"
+"arguments are as for LZMACompressor, and so is the output.\n");
+
+static PyObject *
+_compress_buffer(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"data", "check", "preset", "filters", NULL};
+    Py_buffer data;
+    int check = -1;
+    uint32_t preset = LZMA_PRESET_DEFAULT;
+    PyObject *preset_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    OutputBuffer buffer;
+    size_t bound;
+    lzma_ret lzret;
+    PyObject *result = NULL;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|iOO:_compress_buffer",
+                                     arg_names, &data, &check, &preset_obj,
+                                     &filterspecs))
+#else
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|iOO:_compress_buffer",
+                                     arg_names, &data, &check, &preset_obj,
+                                     &filterspecs))
+#endif
+        return NULL;
+
+    if (preset_obj != Py_None && filterspecs != Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify both preset and filter chain");
+        goto done;
+    }
+    if (preset_obj != Py_None)
+        if (!uint32_converter(preset_obj, &preset))
+            goto done;
+    if (check == -1)
+        check = LZMA_CHECK_CRC64;
+    if (check_no_preset_dict(filterspecs) == -1)
+        goto done;
+
+    /* liblzma's own buffer encoder records the size of each block in its
+       header, so its output differs from LZMACompressor's; use the stream
+       encoder instead, and have it do all its work in a single call. */
+    bound = lzma_stream_buffer_bound(data.len);
+    if (bound == 0 || bound > PY_SSIZE_T_MAX) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (Compressor_init_xz(&lzs, check, preset, filterspecs, 1, 0) == -1)
+        goto done;
+    if (OutputBuffer_Init(&buffer, (Py_ssize_t)bound, -1,
+                          &lzs.next_out, &lzs.avail_out) == -1)
+        goto done;
+    lzs.next_in = data.buf;
+    lzs.avail_in = data.len;
+    for (;;) {
+        Py_BEGIN_ALLOW_THREADS
+        lzret = lzma_code(&lzs, LZMA_FINISH);
+        Py_END_ALLOW_THREADS
+        if (catch_lzma_error(lzret)) {
+            OutputBuffer_OnError(&buffer);
+            goto done;
+        }
+        if (lzret == LZMA_STREAM_END)
+            break;
+        if (lzs.avail_out == 0 &&
+            OutputBuffer_Grow(&buffer, &lzs.next_out, &lzs.avail_out) == -1) {
+            OutputBuffer_OnError(&buffer);
+            goto done;
+        }
+    }
+    result = OutputBuffer_Finish(&buffer, lzs.avail_out);
+
+done:
+    lzma_end(&lzs);
+    PyBuffer_Release(&data);
+    return result;
+}
+
+
+/* Memory for output written with the GIL released; before Python 3.4,
+   only the C library's allocator can be used without the GIL. */
+#if PY_VERSION_HEX >= 0x03040000
+#define RAW_REALLOC(p, n) PyMem_RawRealloc((p), (n))
+#define RAW_FREE(p) PyMem_RawFree(p)
+#else
+#define RAW_REALLOC(p, n) realloc((p), (n))
+#define RAW_FREE(p) free(p)
+#endif
+
+/* Get a simple buffer for each item of seq, which holds n items. On
+   failure, releases any buffers it got and returns -1. */
+static int
+get_item_buffers(PyObject *seq, Py_ssize_t n, Py_buffer *views)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < n; i++) {
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i),
+                               &views[i], PyBUF_SIMPLE) == -1) {
+            while (--i >= 0)
+                PyBuffer_Release(&views[i]);
+            return -1;
+        }
+    }
+    return 0;
+}
+
+static void
+release_item_buffers(Py_buffer *views, Py_ssize_t n)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < n; i++)
+        PyBuffer_Release(&views[i]);
+}
+
+
+PyDoc_STRVAR(_compress_many_doc,
+"_compress_many(buffers, format=FORMAT_XZ, check=-1, preset=None,\n"
+"               filters=None) -> list\n"
+"\n"
+"Compress each item of the sequence buffers into its own FORMAT_XZ or\n"
+"FORMAT_RAW stream, as LZMACompressor would. The encoder is set up\n"
+"again for each item, reusing its memory, and the GIL is released for\n"
+"the whole batch. Unless filters are given, the dictionary of each\n"
+"stream is cut down to fit its data.\n");
+
+/* The dictionary size to use for compressing size bytes: the smallest
+   power of two that holds them, but no more than max_size. Setting up an
+   encoder costs time in proportion to its dictionary size, which for
+   small inputs dwarfs the cost of compressing them; and keeping to
+   powers of two lets inputs of similar sizes share the encoder's memory.
+   A dictionary bigger than the input makes no difference to the
+   compressed data, only to the size recorded in its header. */
+static uint32_t
+fit_dict_size(size_t size, uint32_t max_size)
+{
+    uint32_t dict_size = LZMA_DICT_SIZE_MIN;
+
+    while (dict_size < size && dict_size < max_size)
+        dict_size <<= 1;
+    return dict_size < max_size ? dict_size : max_size;
+}
+
+static PyObject *
+_compress_many(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"buffers", "format", "check", "preset",
+                                "filters", NULL};
+    PyObject *buffers, *seq;
+    int format = FORMAT_XZ;
+    int check = -1;
+    uint32_t preset = LZMA_PRESET_DEFAULT;
+    PyObject *preset_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    lzma_filter filters[LZMA_FILTERS_MAX + 1];
+    int have_filters = 0;
+    lzma_options_lzma options;
+    uint32_t max_dict_size = 0;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    lzma_ret lzret = LZMA_STREAM_END;
+    Py_buffer *views = NULL;
+    PyObject **outputs = NULL;
+    size_t *sizes = NULL;
+    Py_ssize_t i, n;
+    int resume = 0;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iiOO:_compress_many",
+                                     arg_names, &buffers, &format, &check,
+                                     &preset_obj, &filterspecs))
+        return NULL;
+    seq = PySequence_Fast(buffers, "buffers must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+
+    if (format != FORMAT_XZ && format != FORMAT_RAW) {
+        PyErr_Format(PyExc_ValueError, "Invalid container format: %d", format);
+        goto done;
+    }
+    if (format == FORMAT_RAW) {
+        if (check != -1 && check != LZMA_CHECK_NONE) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Integrity checks are only supported by FORMAT_XZ");
+            goto done;
+        }
+        if (filterspecs == Py_None) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Must specify filters for FORMAT_RAW");
+            goto done;
+        }
+    } else if (check_no_preset_dict(filterspecs) == -1) {
+        goto done;
+    }
+    if (preset_obj != Py_None && filterspecs != Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify both preset and filter chain");
+        goto done;
+    }
+    if (preset_obj != Py_None)
+        if (!uint32_converter(preset_obj, &preset))
+            goto done;
+    if (check == -1)
+        check = LZMA_CHECK_CRC64;
+    if (filterspecs != Py_None) {
+        if (parse_filter_chain_spec(filters, filterspecs) == -1)
+            goto done;
+        have_filters = 1;
+    } else {
+        /* The filter chain lzma_easy_encoder() would use. */
+        if (lzma_lzma_preset(&options, preset)) {
+            catch_lzma_error(LZMA_OPTIONS_ERROR);
+            goto done;
+        }
+        max_dict_size = options.dict_size;
+        filters[0].id = LZMA_FILTER_LZMA2;
+        filters[0].options = &options;
+        filters[1].id = LZMA_VLI_UNKNOWN;
+    }
+
+    views = PyMem_New(Py_buffer, n ? n : 1);
+    outputs = PyMem_New(PyObject *, n ? n : 1);
+    sizes = PyMem_New(size_t, n ? n : 1);
+    if (views == NULL || outputs == NULL || sizes == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (get_item_buffers(seq, n, views) == -1)
+        goto done;
+    /* Allocate every output up front, sized for the worst case of the
+       .xz format, which is more than enough for a raw stream. */
+    for (i = 0; i < n; i++) {
+        size_t bound = lzma_stream_buffer_bound(views[i].len);
+
+        if (bound == 0 || bound > PY_SSIZE_T_MAX)
+            outputs[i] = PyErr_NoMemory();
+        else
+            outputs[i] = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)bound);
+        if (outputs[i] == NULL) {
+            n = i;
+            goto error;
+        }
+    }
+
+    i = 0;
+    while (i < n) {
+        Py_BEGIN_ALLOW_THREADS
+        for (; i < n; i++) {
+            if (!resume) {
+                /* Setting up the same encoder again reuses its memory. */
+                if (format == FORMAT_RAW) {
+                    lzret = lzma_raw_encoder(&lzs, filters);
+                } else {
+                    if (!have_filters)
+                        options.dict_size = fit_dict_size(views[i].len,
+                                                          max_dict_size);
+                    lzret = lzma_stream_encoder(&lzs, filters, check);
+                }
+                if (lzret != LZMA_OK)
+                    break;
+                lzs.next_in = views[i].buf;
+                lzs.avail_in = views[i].len;
+                lzs.next_out = (uint8_t *)PyBytes_AS_STRING(outputs[i]);
+                lzs.avail_out = PyBytes_GET_SIZE(outputs[i]);
+            }
+            resume = 0;
+            do {
+                lzret = lzma_code(&lzs, LZMA_FINISH);
+            } while (lzret == LZMA_OK && lzs.avail_out > 0);
+            if (lzret != LZMA_STREAM_END)
+                break;
+            sizes[i] = (size_t)lzs.total_out;
+        }
+        Py_END_ALLOW_THREADS
+
+        if (i < n) {
+            Py_ssize_t size = PyBytes_GET_SIZE(outputs[i]);
+
+            if (lzret != LZMA_OK) {
+                catch_lzma_error(lzret);
+                goto error;
+            }
+            /* Out of room, despite the bound; grow the output and carry on
+               where the encoder left off. */
+            if (_PyBytes_Resize(&outputs[i], size + (size >> 1) + 1024) == -1)
+                goto error;
+            lzs.next_out = (uint8_t *)PyBytes_AS_STRING(outputs[i]) + size;
+            lzs.avail_out = PyBytes_GET_SIZE(outputs[i]) - size;
+            resume = 1;
+        }
+    }
+
+    result = PyList_New(n);
+    if (result == NULL)
+        goto error;
+    for (i = 0; i < n; i++) {
+        if (_PyBytes_Resize(&outputs[i], (Py_ssize_t)sizes[i]) == -1) {
+            Py_CLEAR(result);
+            goto error;
+        }
+        PyList_SET_ITEM(result, i, outputs[i]);
+        outputs[i] = NULL;
+    }
+    goto release;
+
+error:
+    for (i = 0; i < n; i++)
+        Py_XDECREF(outputs[i]);
+release:
+    release_item_buffers(views, PySequence_Fast_GET_SIZE(seq));
+done:
+    if (have_filters)
+        free_filter_chain(filters);
+    lzma_end(&lzs);
+    PyMem_Free(views);
+    PyMem_Free(outputs);
+    PyMem_Free(sizes);
+    Py_DECREF(seq);
+    return result;
+}
+
+
+/* How much output _decompress_many() collects with the GIL released,
+   before turning it into bytes objects. */
+#define MANY_FLUSH_SIZE (4 * 1024 * 1024)
+
+PyDoc_STRVAR(_decompress_many_doc,
+"_decompress_many(buffers, format=FORMAT_AUTO, memlimit=None,\n"
+"                 filters=None) -> list\n"
+"\n"
+"Decompress each item of the sequence buffers, as decompress() would.\n"
+"The decoder is set up again for each stream, reusing its memory, and\n"
+"the GIL is only taken to turn each few MiB of output into bytes\n"
+"objects.\n");
+
+static PyObject *
+_decompress_many(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"buffers", "format", "memlimit", "filters",
+                                NULL};
+    PyObject *buffers, *seq;
+    int format = FORMAT_AUTO;
+    uint64_t memlimit = UINT64_MAX;
+    PyObject *memlimit_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    lzma_filter filters[LZMA_FILTERS_MAX + 1];
+    int have_filters = 0;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    lzma_ret lzret = LZMA_STREAM_END;
+    Py_buffer *views = NULL;
+    size_t *ends = NULL;
+    uint8_t *scratch = NULL, *grown;
+    size_t capacity = 0, used, in_pos;
+    Py_ssize_t i, j, first, n;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iOO:_decompress_many",
+                                     arg_names, &buffers, &format,
+                                     &memlimit_obj, &filterspecs))
+        return NULL;
+    seq = PySequence_Fast(buffers, "buffers must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+
+    if (format < FORMAT_AUTO || format > FORMAT_RAW) {
+        PyErr_Format(PyExc_ValueError, "Invalid container format: %d", format);
+        goto done;
+    }
+    if (memlimit_obj != Py_None) {
+        if (format == FORMAT_RAW) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Cannot specify memory limit with FORMAT_RAW");
+            goto done;
+        }
+        if (!uint64_converter(memlimit_obj, &memlimit))
+            goto done;
+    }
+    if (format == FORMAT_RAW && filterspecs == Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Must specify filters for FORMAT_RAW");
+        goto done;
+    } else if (format != FORMAT_RAW && filterspecs != Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify filters except with FORMAT_RAW");
+        goto done;
+    }
+    if (filterspecs != Py_None) {
+        if (parse_filter_chain_spec(filters, filterspecs) == -1)
+            goto done;
+        have_filters = 1;
+    }
+
+    views = PyMem_New(Py_buffer, n ? n : 1);
+    ends = PyMem_New(size_t, n ? n : 1);
+    if (views == NULL || ends == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (get_item_buffers(seq, n, views) == -1)
+        goto done;
+    result = PyList_New(n);
+    if (result == NULL)
+        goto release;
+
+    i = 0;
+    while (i < n) {
+        first = i;
+        used = 0;
+        Py_BEGIN_ALLOW_THREADS
+        for (; i < n && used < MANY_FLUSH_SIZE; i++) {
+            const uint8_t *in = views[i].buf;
+
+            /* Like decompress(), reject empty input, and decode one
+               stream after another until the input is used up. */
+            if (views[i].len == 0)
+                lzret = LZMA_BUF_ERROR;
+            for (in_pos = 0; in_pos < (size_t)views[i].len;
+                 in_pos = lzs.next_in - in) {
+                switch (format) {
+                    case FORMAT_AUTO:
+                        lzret = lzma_auto_decoder(&lzs, memlimit, 0);
+                        break;
+                    case FORMAT_XZ:
+                        lzret = lzma_stream_decoder(&lzs, memlimit, 0);
+                        break;
+                    case FORMAT_ALONE:
+                        lzret = lzma_alone_decoder(&lzs, memlimit);
+                        break;
+                    case FORMAT_RAW:
+                        lzret = lzma_raw_decoder(&lzs, filters);
+                        break;
+                }
+                if (lzret != LZMA_OK)
+                    break;
+                lzs.next_in = in + in_pos;
+                lzs.avail_in = views[i].len - in_pos;
+                do {
+                    if (used == capacity) {
+                        size_t new_capacity = capacity ? capacity * 2
+                                                       : 64 * 1024;
+
+                        grown = NULL;
+                        if (new_capacity > capacity)
+                            grown = RAW_REALLOC(scratch, new_capacity);
+                        if (grown == NULL) {
+                            lzret = LZMA_MEM_ERROR;
+                            break;
+                        }
+                        scratch = grown;
+                        capacity = new_capacity;
+                    }
+                    lzs.next_out = scratch + used;
+                    lzs.avail_out = capacity - used;
+                    lzret = lzma_code(&lzs, LZMA_FINISH);
+                    used = lzs.next_out - scratch;
+                } while (lzret == LZMA_OK);
+                if (lzret != LZMA_STREAM_END)
+                    break;
+            }
+            if (lzret != LZMA_STREAM_END)
+                break;
+            ends[i] = used;
+        }
+        Py_END_ALLOW_THREADS
+
+        for (j = first; j < i; j++) {
+            size_t start = j > first ? ends[j - 1] : 0;
+            PyObject *item = PyBytes_FromStringAndSize(
+                    (char *)scratch + start, ends[j] - start);
+
+            if (item == NULL) {
+                Py_CLEAR(result);
+                goto release;
+            }
+            PyList_SET_ITEM(result, j, item);
+        }
+        if (lzret != LZMA_STREAM_END) {
+            /* With all the input used, running out of buffer space means
+               the data was cut short. */
+            if (lzret == LZMA_BUF_ERROR)
+                PyErr_SetString(Error, "Compressed data ended before the "
+                                "end-of-stream marker was reached");
+            else
+                catch_lzma_error(lzret);
+            Py_CLEAR(result);
+            goto release;
+        }
+    }
+
+release:
+    release_item_buffers(views, n);
+done:
+    if (have_filters)
+        free_filter_chain(filters);
+    lzma_end(&lzs);
+    RAW_FREE(scratch);
+    PyMem_Free(views);
+    PyMem_Free(ends);
+    Py_DECREF(seq);
+    return result;
+}
+
+
 /* Module initialization. */
 
 static PyMethodDef module_methods[] = {
@@ -1350,6 +2706,22 @@ static PyMethodDef module_methods[] = {
      METH_VARARGS, _encode_filter_properties_doc},
     {"_decode_filter_properties", (PyCFunction)_decode_filter_properties,
      METH_VARARGS, _decode_filter_properties_doc},
+    {"_decode_stream_footer", (PyCFunction)_decode_stream_footer,
+     METH_VARARGS, _decode_stream_footer_doc},
+    {"_decode_index", (PyCFunction)_decode_index,
+     METH_VARARGS, _decode_index_doc},
+    {"_merge_indexes", (PyCFunction)_merge_indexes,
+     METH_VARARGS, _merge_indexes_doc},
+    {"_encode_stream_footer", (PyCFunction)_encode_stream_footer,
+     METH_VARARGS, _encode_stream_footer_doc},
+    {"_decompress_sized", (PyCFunction)_decompress_sized,
+     METH_VARARGS, _decompress_sized_doc},
+    {"_compress_buffer", (PyCFunction)_compress_buffer,
+     METH_VARARGS | METH_KEYWORDS, _compress_buffer_doc},
+    {"_compress_many", (PyCFunction)_compress_many,
+     METH_VARARGS | METH_KEYWORDS, _compress_many_doc},
+    {"_decompress_many", (PyCFunction)_decompress_many,
+     METH_VARARGS | METH_KEYWORDS, _decompress_many_doc},
     {NULL}
 };
 
@@ -1,7 +1,12 @@
 from io import BytesIO, UnsupportedOperation
+import hashlib
+import mmap
 import os
+import shutil
+import struct
 import sys
 import random
+import tempfile
 import unittest
 
 try:
@@ -90,6 +95,40 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         self.assertRaises(ValueError, LZMACompressor,
                           filters=[{"id": lzma.FILTER_X86, "foo": 0}])
 
+    def test_preset_dict(self):
+        data = INPUT[1000:3000]
+        for filter_id in (lzma.FILTER_LZMA1, lzma.FILTER_LZMA2):
+            filters = [{"id": filter_id, "preset_dict": INPUT[:2000]}]
+            lzc = LZMACompressor(lzma.FORMAT_RAW, filters=filters)
+            cdata = lzc.compress(data) + lzc.flush()
+            lzd = LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+            self.assertEqual(lzd.decompress(cdata), data)
+            plain = lzma.compress(data, lzma.FORMAT_RAW,
+                                  filters=[{"id": filter_id}])
+            self.assertLess(len(cdata), len(plain) // 2)
+            # The data refers back into the dictionary.
+            self.assertRaises(LZMAError, lzma.decompress, cdata,
+                              lzma.FORMAT_RAW, filters=[{"id": filter_id}])
+            for preset_dict in (bytearray(INPUT[:2000]),
+                                memoryview(INPUT)[:2000]):
+                filters = [{"id": filter_id, "preset_dict": preset_dict}]
+                self.assertEqual(lzma.compress(data, lzma.FORMAT_RAW,
+                                               filters=filters), cdata)
+        for preset_dict in (None, b""):
+            filters = [{"id": lzma.FILTER_LZMA2, "preset_dict": preset_dict}]
+            self.assertEqual(lzma.compress(data, lzma.FORMAT_RAW,
+                                           filters=filters), plain)
+
+    def test_preset_dict_bad_args(self):
+        filters = [{"id": lzma.FILTER_LZMA2, "preset_dict": INPUT[:100]}]
+        for format in (lzma.FORMAT_XZ, lzma.FORMAT_ALONE):
+            self.assertRaises(ValueError, LZMACompressor, format,
+                              filters=filters)
+        self.assertRaises(ValueError, lzma.compress, INPUT, filters=filters)
+        self.assertRaises(TypeError, LZMACompressor, lzma.FORMAT_RAW,
+                          filters=[{"id": lzma.FILTER_LZMA2,
+                                    "preset_dict": 42}])
+
     def test_decompressor_after_eof(self):
         lzd = LZMADecompressor()
         lzd.decompress(COMPRESSED_XZ)
@@ -207,6 +246,166 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         lzd = LZMADecompressor()
         self._test_decompressor(lzd, cdata, lzma.CHECK_CRC64)
 
+    def test_roundtrip_threads(self):
+        for threads in (0, 1, 3):
+            lzc = LZMACompressor(threads=threads, block_size=1000)
+            cdata = lzc.compress(INPUT) + lzc.flush()
+            lzd = LZMADecompressor()
+            self._test_decompressor(lzd, cdata, lzma.CHECK_CRC64)
+            index = lzma.XZIndex.from_file(BytesIO(cdata))
+            self.assertEqual(len(index), -(-len(INPUT) // 1000))
+
+    def test_compressor_threads_bad_args(self):
+        self.assertRaises(ValueError, LZMACompressor,
+                          format=lzma.FORMAT_ALONE, threads=2)
+        self.assertRaises(ValueError, LZMACompressor,
+                          format=lzma.FORMAT_RAW, filters=FILTERS_RAW_1,
+                          block_size=1000)
+        self.assertRaises(OverflowError, LZMACompressor, threads=-1)
+        self.assertRaises(TypeError, LZMACompressor, threads="4")
+
+    def test_decompressor_chunks_maxsize(self):
+        lzd = LZMADecompressor()
+        max_length = 100
+        out = []
+
+        # Feed first half the input
+        len_ = len(COMPRESSED_XZ) // 2
+        out.append(lzd.decompress(COMPRESSED_XZ[:len_],
+                                  max_length=max_length))
+        self.assertFalse(lzd.needs_input)
+        self.assertEqual(len(out[-1]), max_length)
+
+        # Retrieve more data without providing more input
+        out.append(lzd.decompress(b"", max_length=max_length))
+        self.assertFalse(lzd.needs_input)
+        self.assertEqual(len(out[-1]), max_length)
+
+        # Retrieve more data while providing more input
+        out.append(lzd.decompress(COMPRESSED_XZ[len_:],
+                                  max_length=max_length))
+        self.assertLessEqual(len(out[-1]), max_length)
+
+        # Retrieve remaining uncompressed data
+        while not lzd.eof:
+            out.append(lzd.decompress(b"", max_length=max_length))
+            self.assertLessEqual(len(out[-1]), max_length)
+
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertEqual(lzd.check, lzma.CHECK_CRC64)
+        self.assertEqual(lzd.unused_data, b"")
+
+    def test_decompressor_large_output(self):
+        # Output spanning several resizes of the output buffer.
+        data = INPUT * (300000 // len(INPUT) + 1)
+        cdata = lzma.compress(data)
+        self.assertEqual(LZMADecompressor().decompress(cdata), data)
+        lzd = LZMADecompressor()
+        out = [lzd.decompress(cdata, 100000)]
+        while not lzd.eof:
+            out.append(lzd.decompress(b"", 100000))
+        self.assertTrue(all(len(chunk) == 100000 for chunk in out[:-1]))
+        self.assertEqual(b"".join(out), data)
+        # Little input at a time makes for a small buffer to start with.
+        lzd = LZMADecompressor()
+        out = [lzd.decompress(cdata[i:i + 1]) for i in range(len(cdata))]
+        self.assertEqual(b"".join(out), data)
+
+    def test_decompressor_inputbuf(self):
+        # Test reusing input buffer after moving existing
+        # contents to beginning
+        lzd = LZMADecompressor()
+        out = []
+
+        # Create input buffer and fill it
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ[:100],
+                                        max_length=0), b"")
+
+        # Retrieve some results, freeing capacity at beginning
+        # of input buffer
+        out.append(lzd.decompress(b"", 2))
+
+        # Add more data that fits into input buffer after
+        # moving existing data to beginning
+        out.append(lzd.decompress(COMPRESSED_XZ[100:105], 15))
+
+        # Decompress rest of data
+        out.append(lzd.decompress(COMPRESSED_XZ[105:]))
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_decompressor_unused_data_maxlen(self):
+        lzd = LZMADecompressor()
+        unused_data = b"Some unused data"
+        out = []
+        out.append(lzd.decompress(COMPRESSED_XZ + unused_data, 10))
+        while not lzd.eof:
+            out.append(lzd.decompress(b"", 10))
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertEqual(lzd.unused_data, unused_data)
+
+    def test_decompressor_max_length_bad_args(self):
+        lzd = LZMADecompressor()
+        self.assertRaises(TypeError, lzd.decompress, COMPRESSED_XZ, "10")
+        self.assertRaises(TypeError, lzd.decompress, COMPRESSED_XZ,
+                          max_length=None)
+
+    def test_decompress_into(self):
+        lzd = LZMADecompressor()
+        compressed = COMPRESSED_XZ + b"extra"
+        out = bytearray(1000)
+        chunks = []
+        pos = 0
+        while not lzd.eof:
+            data = b""
+            if lzd.needs_input:
+                data = compressed[pos:pos+100]
+                pos += 100
+            n = lzd.decompress_into(out, data)
+            chunks.append(bytes(out[:n]))
+        self.assertEqual(b"".join(chunks), INPUT)
+        self.assertEqual(lzd.unused_data, compressed[len(COMPRESSED_XZ):pos])
+        self.assertRaises(EOFError, lzd.decompress_into, out, b"abc")
+
+    def test_decompress_into_then_decompress(self):
+        lzd = LZMADecompressor()
+        out = bytearray(10)
+        n = lzd.decompress_into(out, COMPRESSED_XZ[:len(COMPRESSED_XZ) // 2])
+        self.assertEqual(n, 10)
+        self.assertFalse(lzd.needs_input)
+        rest = lzd.decompress(COMPRESSED_XZ[len(COMPRESSED_XZ) // 2:])
+        self.assertEqual(bytes(out) + rest, INPUT)
+        self.assertTrue(lzd.eof)
+
+    def test_decompress_into_bad_args(self):
+        lzd = LZMADecompressor()
+        self.assertRaises(TypeError, lzd.decompress_into)
+        self.assertRaises(TypeError, lzd.decompress_into, b"immutable", b"")
+        self.assertRaises(TypeError, lzd.decompress_into, bytearray(10), [])
+
+    def test_decompressor_threads(self):
+        cdata = lzma.compress(INPUT * 10, threads=2, block_size=1000)
+        for threads in (0, 1, 4):
+            lzd = LZMADecompressor(lzma.FORMAT_XZ, threads=threads)
+            out = []
+            for i in range(0, len(cdata), 100):
+                out.append(lzd.decompress(cdata[i:i+100]))
+            self.assertEqual(b"".join(out), INPUT * 10)
+            self.assertTrue(lzd.eof)
+        lzd = LZMADecompressor(lzma.FORMAT_XZ, threads=2,
+                               memlimit_threading=1 << 20)
+        self.assertEqual(lzd.decompress(cdata), INPUT * 10)
+
+    def test_decompressor_threads_bad_args(self):
+        self.assertRaises(ValueError, LZMADecompressor, threads=2)
+        self.assertRaises(ValueError, LZMADecompressor,
+                          lzma.FORMAT_ALONE, threads=2)
+        self.assertRaises(ValueError, LZMADecompressor,
+                          memlimit_threading=1 << 20)
+        self.assertRaises(OverflowError, LZMADecompressor,
+                          lzma.FORMAT_XZ, threads=-1)
+        self.assertRaises(TypeError, LZMADecompressor,
+                          lzma.FORMAT_XZ, threads=2, memlimit_threading="1")
+
     # LZMADecompressor intentionally does not handle concatenated streams.
 
     def test_decompressor_multistream(self):
@@ -359,11 +558,266 @@ class CompressDecompressFunctionTestCase(unittest.TestCase):
         ddata = lzma.decompress(cdata, lzma.FORMAT_RAW, filters=FILTERS_RAW_4)
         self.assertEqual(ddata, INPUT)
 
+        cdata = lzma.compress(INPUT, threads=2, block_size=500)
+        ddata = lzma.decompress(cdata)
+        self.assertEqual(ddata, INPUT)
+
     # Unlike LZMADecompressor, decompress() *does* handle concatenated streams.
 
     def test_decompress_multistream(self):
         ddata = lzma.decompress(COMPRESSED_XZ + COMPRESSED_ALONE)
         self.assertEqual(ddata, INPUT * 2)
+        ddata = lzma.decompress(COMPRESSED_XZ * 3)
+        self.assertEqual(ddata, INPUT * 3)
+
+    def test_decompress_known_size(self):
+        # A .lzma header recording the size of the data.
+        alone = (COMPRESSED_ALONE[:5] + struct.pack("<Q", len(INPUT)) +
+                 COMPRESSED_ALONE[13:])
+        self.assertEqual(lzma._decompressed_size(alone, lzma.FORMAT_AUTO),
+                         len(INPUT))
+        self.assertEqual(lzma.decompress(alone), INPUT)
+        self.assertEqual(lzma.decompress(alone, lzma.FORMAT_ALONE), INPUT)
+        self.assertIsNone(lzma._decompressed_size(COMPRESSED_ALONE,
+                                                  lzma.FORMAT_AUTO))
+        self.assertEqual(lzma._decompressed_size(COMPRESSED_XZ * 2,
+                                                 lzma.FORMAT_XZ),
+                         len(INPUT) * 2)
+        self.assertIsNone(lzma._decompressed_size(COMPRESSED_XZ,
+                                                  lzma.FORMAT_ALONE))
+        # A wrong recorded size is caught by the incremental decoder.
+        wrong = alone[:5] + struct.pack("<Q", len(INPUT) - 1) + alone[13:]
+        self.assertRaises(LZMAError, lzma.decompress, wrong)
+        self.assertRaises(LZMAError, lzma.decompress, COMPRESSED_XZ + b"\0")
+
+    def test_decompress_known_size_limit(self):
+        calls = []
+        saved = lzma._decompress_sized
+        def decompress_sized(*args):
+            calls.append(args[2])
+            return saved(*args)
+        lzma._decompress_sized = decompress_sized
+        try:
+            self.assertEqual(lzma.decompress(COMPRESSED_XZ), INPUT)
+            self.assertEqual(calls, [len(INPUT)])
+            # A forged size is not allocated up front.
+            for size in (2 ** 40, 2 ** 63):
+                forged = (COMPRESSED_ALONE[:5] + struct.pack("<Q", size) +
+                          COMPRESSED_ALONE[13:])
+                self.assertRaises(LZMAError, lzma.decompress, forged)
+            # Highly compressible data is still decompressed in full.
+            data = b"\0" * (4 << 20)
+            self.assertEqual(lzma.decompress(lzma.compress(data)), data)
+            self.assertEqual(calls, [len(INPUT)])
+        finally:
+            lzma._decompress_sized = saved
+
+    def test_decompress_mmap(self):
+        data = COMPRESSED_XZ * 2 + COMPRESSED_ALONE
+        self.assertEqual(lzma.decompress(bytearray(data)), INPUT * 3)
+        self.assertEqual(lzma.decompress(memoryview(data)), INPUT * 3)
+        with TempFile(TESTFN, data):
+            with open(TESTFN, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self.assertEqual(lzma.decompress(m), INPUT * 3)
+                finally:
+                    m.close()
+
+    def test_iter_decompress(self):
+        data = COMPRESSED_XZ * 2 + COMPRESSED_ALONE
+        pieces = [data[i:i + 7] for i in range(0, len(data), 7)]
+        chunks = list(lzma.iter_decompress(pieces, chunk_size=100))
+        self.assertEqual(b"".join(chunks), INPUT * 3)
+        self.assertLessEqual(max(map(len, chunks)), 100)
+        chunks = list(lzma.iter_decompress(
+            [b"", bytearray(data), memoryview(b"")], chunk_size=50))
+        self.assertEqual(b"".join(chunks), INPUT * 3)
+        self.assertLessEqual(max(map(len, chunks)), 50)
+        chunks = list(lzma.iter_decompress(BytesIO(data), chunk_size=10))
+        self.assertEqual(b"".join(chunks), INPUT * 3)
+        self.assertLessEqual(max(map(len, chunks)), 10)
+        chunks = lzma.iter_decompress([COMPRESSED_RAW_1],
+                                      format=lzma.FORMAT_RAW,
+                                      filters=FILTERS_RAW_1)
+        self.assertEqual(b"".join(chunks), INPUT)
+
+    def test_iter_decompress_bad_data(self):
+        for data in ([], [COMPRESSED_XZ[:-20]], [COMPRESSED_XZ, b"\0" * 20],
+                     [b"not compressed data"]):
+            self.assertRaises(LZMAError, list, lzma.iter_decompress(data))
+        self.assertRaises(ValueError, list,
+                          lzma.iter_decompress([COMPRESSED_XZ], 0))
+
+    def test_iter_compress(self):
+        pieces = [INPUT[:10], b"", bytearray(INPUT[10:500]),
+                  memoryview(INPUT[500:])]
+        chunks = list(lzma.iter_compress(pieces, chunk_size=64))
+        self.assertLessEqual(max(map(len, chunks)), 64)
+        self.assertEqual(b"".join(chunks), lzma.compress(INPUT))
+        chunks = lzma.iter_compress(BytesIO(INPUT), format=lzma.FORMAT_ALONE,
+                                    preset=1)
+        self.assertEqual(lzma.decompress(b"".join(chunks)), INPUT)
+        chunks = lzma.iter_compress(iter([INPUT] * 3), format=lzma.FORMAT_RAW,
+                                    filters=FILTERS_RAW_1)
+        self.assertEqual(lzma.decompress(b"".join(chunks), lzma.FORMAT_RAW,
+                                         filters=FILTERS_RAW_1), INPUT * 3)
+        self.assertEqual(b"".join(lzma.iter_decompress(
+            lzma.iter_compress([INPUT] * 5, chunk_size=100))), INPUT * 5)
+        self.assertRaises(ValueError, list, lzma.iter_compress([INPUT], 0))
+
+    def test_parallel_decompress(self):
+        data = COMPRESSED_XZ * 3 + b"\0" * 8 + COMPRESSED_XZ
+        self.assertEqual(lzma.parallel_decompress(BytesIO(data), workers=3),
+                         INPUT * 4)
+        with TempFile(TESTFN, data):
+            self.assertEqual(lzma.parallel_decompress(TESTFN), INPUT * 4)
+        self.assertRaises(LZMAError, lzma.parallel_decompress,
+                          BytesIO(COMPRESSED_ALONE))
+        damaged = bytearray(COMPRESSED_XZ)
+        damaged[100:110] = b"\xff" * 10
+        self.assertRaises(LZMAError, lzma.parallel_decompress,
+                          BytesIO(bytes(damaged)), workers=2)
+
+    def test_compress_workers(self):
+        cdata = lzma.compress(INPUT, workers=3, block_size=1000,
+                              check=lzma.CHECK_SHA256)
+        index = lzma.XZIndex.from_file(BytesIO(cdata))
+        self.assertEqual(index.stream_count, 1)
+        self.assertEqual(len(index), (len(INPUT) + 999) // 1000)
+        self.assertEqual(next(index.streams()).check, lzma.CHECK_SHA256)
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+        self.assertEqual(lzma.parallel_decompress(BytesIO(cdata)), INPUT)
+        self.assertEqual(lzma.decompress(lzma.compress(INPUT, workers=0)),
+                         INPUT)
+        self.assertEqual(lzma.decompress(lzma.compress(b"", workers=2)), b"")
+        self.assertRaises(ValueError, lzma.compress, INPUT, workers=2,
+                          format=lzma.FORMAT_ALONE)
+        self.assertRaises(ValueError, lzma.compress, INPUT, workers=2,
+                          threads=2)
+
+    def test_compress_many(self):
+        records = [INPUT[i:i + 50 * i] for i in range(0, 60, 3)] + [b""]
+        for workers in (None, 0, 3):
+            cdata = lzma.compress_many(records, workers=workers)
+            self.assertEqual(len(cdata), len(records))
+            self.assertEqual([lzma.decompress(c) for c in cdata], records)
+        # The dictionary is cut down to the power of two fitting a record.
+        dict_size = 4096
+        while dict_size < len(INPUT):
+            dict_size *= 2
+        self.assertEqual(
+            lzma.compress_many([INPUT]),
+            [lzma.compress(INPUT, filters=[{"id": lzma.FILTER_LZMA2,
+                                            "preset": lzma.PRESET_DEFAULT,
+                                            "dict_size": dict_size}])])
+        # With an explicit filter chain, the output is as from compress().
+        filters = [{"id": lzma.FILTER_DELTA, "dist": 2},
+                   {"id": lzma.FILTER_LZMA2, "preset": 1}]
+        self.assertEqual(
+            lzma.compress_many(iter(records), check=lzma.CHECK_SHA256,
+                               filters=filters),
+            [lzma.compress(r, check=lzma.CHECK_SHA256, filters=filters)
+             for r in records])
+        self.assertEqual(
+            lzma.compress_many(records, lzma.FORMAT_ALONE, preset=1),
+            [lzma.compress(r, lzma.FORMAT_ALONE, preset=1) for r in records])
+        self.assertEqual(lzma.compress_many([]), [])
+        self.assertEqual(
+            lzma.compress_many([bytearray(INPUT), memoryview(INPUT)],
+                               preset=0),
+            [lzma.compress_many([INPUT], preset=0)[0]] * 2)
+        self.assertRaises(TypeError, lzma.compress_many, [INPUT, 1])
+        self.assertRaises(LZMAError, lzma.compress_many, [INPUT], preset=99)
+        self.assertRaises(ValueError, lzma.compress_many, [INPUT], preset=1,
+                          filters=filters)
+
+    def test_decompress_many(self):
+        cdata = [COMPRESSED_XZ, COMPRESSED_ALONE, COMPRESSED_XZ * 2,
+                 lzma.compress(b"")]
+        expected = [INPUT, INPUT, INPUT * 2, b""]
+        for workers in (None, 0, 3):
+            self.assertEqual(lzma.decompress_many(cdata, workers=workers),
+                             expected)
+        self.assertEqual(lzma.decompress_many([COMPRESSED_XZ] * 300),
+                         [INPUT] * 300)
+        self.assertEqual(lzma.decompress_many(iter([bytearray(COMPRESSED_XZ),
+                                                    memoryview(COMPRESSED_XZ)])),
+                         [INPUT] * 2)
+        self.assertEqual(lzma.decompress_many([COMPRESSED_RAW_2] * 2,
+                                              lzma.FORMAT_RAW,
+                                              filters=FILTERS_RAW_2),
+                         [INPUT] * 2)
+        self.assertEqual(lzma.decompress_many([]), [])
+
+    def test_decompress_many_bad_input(self):
+        for bad in (b"", COMPRESSED_XZ[:128], COMPRESSED_XZ + b"\0" * 20,
+                    COMPRESSED_RAW_1):
+            self.assertRaises(LZMAError, lzma.decompress_many,
+                              [COMPRESSED_XZ, bad, COMPRESSED_XZ])
+        self.assertRaises(LZMAError, lzma.decompress_many, [COMPRESSED_XZ],
+                          lzma.FORMAT_ALONE)
+        self.assertRaises(LZMAError, lzma.decompress_many, [COMPRESSED_XZ],
+                          memlimit=1024)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          lzma.FORMAT_RAW)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          filters=FILTERS_RAW_1)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          format=42)
+        self.assertRaises(TypeError, lzma.decompress_many, [None])
+
+    def test_many_raw(self):
+        records = [INPUT[i:i + 500] for i in range(0, len(INPUT), 500)]
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": 1,
+                    "preset_dict": INPUT[:1000]}]
+        cdata = lzma.compress_many(records, lzma.FORMAT_RAW, filters=filters)
+        self.assertEqual(cdata, [lzma.compress(r, lzma.FORMAT_RAW,
+                                               filters=filters)
+                                 for r in records])
+        self.assertEqual(lzma.decompress_many(cdata, lzma.FORMAT_RAW,
+                                              filters=filters, workers=2),
+                         records)
+        self.assertRaises(ValueError, lzma.compress_many, records,
+                          lzma.FORMAT_RAW)
+        self.assertRaises(ValueError, lzma.compress_many, records,
+                          lzma.FORMAT_RAW, check=lzma.CHECK_CRC32,
+                          filters=filters)
+        self.assertRaises(ValueError, lzma.compress_many, records,
+                          filters=filters)
+
+    def test_build_preset_dict(self):
+        lines = INPUT.splitlines(True)
+        samples = [b"".join(lines[i:i + 4]) for i in range(0, len(lines), 4)]
+        train, test = samples[::2], samples[1::2]
+        preset_dict = lzma.build_preset_dict(iter(train), 1000)
+        self.assertTrue(0 < len(preset_dict) <= 1000)
+        self.assertLessEqual(len(lzma.build_preset_dict(train, 300)), 300)
+        filters = [{"id": lzma.FILTER_LZMA2, "preset_dict": preset_dict}]
+        cdata = lzma.compress_many(test, lzma.FORMAT_RAW, filters=filters)
+        self.assertEqual(lzma.decompress_many(cdata, lzma.FORMAT_RAW,
+                                              filters=filters), test)
+        plain = lzma.compress_many(test, lzma.FORMAT_RAW,
+                                   filters=[{"id": lzma.FILTER_LZMA2}])
+        self.assertLess(sum(map(len, cdata)), sum(map(len, plain)))
+        # Nothing in common between the samples: nothing to put in.
+        self.assertEqual(lzma.build_preset_dict([b"abcdefghij",
+                                                 b"klmnopqrst"]), b"")
+        self.assertEqual(lzma.build_preset_dict([]), b"")
+        self.assertRaises(ValueError, lzma.build_preset_dict, train, 0)
+
+
+class Unseekable(object):
+    """Wraps a file object, hiding its ability to seek."""
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def seekable(self):
+        return False
 
 
 class TempFile:
@@ -669,6 +1123,13 @@ class FileTestCase(unittest.TestCase):
                       format=lzma.FORMAT_RAW, filters=FILTERS_RAW_3) as f:
             self.assertEqual(f.read(), INPUT * 4)
 
+    def test_read_bounded_readahead(self):
+        cdata = lzma.compress(b"\0" * (lzma._READAHEAD_SIZE * 20))
+        with LZMAFile(BytesIO(cdata)) as f:
+            self.assertEqual(f.read(10), b"\0" * 10)
+            self.assertLessEqual(len(f._buffer), lzma._READAHEAD_SIZE)
+            self.assertEqual(len(f.read()), lzma._READAHEAD_SIZE * 20 - 10)
+
     def test_read_multistream_buffer_size_aligned(self):
         # Test the case where a stream boundary coincides with the end
         # of the raw read buffer.
@@ -680,6 +1141,157 @@ class FileTestCase(unittest.TestCase):
         finally:
             lzma._BUFFER_SIZE = saved_buffer_size
 
+    def _read_sizes(self, cdata, clock_step=None, **kwargs):
+        # Read cdata through an LZMAFile, returning the data and the sizes
+        # of the reads it made from the underlying file. If clock_step is
+        # given, each read advances lzma's clock by clock_step(size).
+        sizes = []
+        now = [0.0]
+        class Reader(BytesIO):
+            def read(self, size=-1):
+                sizes.append(size)
+                data = BytesIO.read(self, size)
+                if clock_step is not None:
+                    now[0] += clock_step(len(data))
+                return data
+        saved_clock = lzma._clock
+        if clock_step is not None:
+            lzma._clock = lambda: now[0]
+        try:
+            with LZMAFile(Reader(cdata), **kwargs) as f:
+                data = f.read()
+        finally:
+            lzma._clock = saved_clock
+        return data, sizes
+
+    def test_read_buffer_size(self):
+        data, sizes = self._read_sizes(COMPRESSED_XZ, buffer_size=100)
+        self.assertEqual(data, INPUT)
+        self.assertEqual(max(sizes), 100)
+        with lzma.open(BytesIO(COMPRESSED_XZ), buffer_size=100) as f:
+            self.assertEqual(f.read(), INPUT)
+
+    def test_read_buffer_size_adaptive(self):
+        # Reads that take a fixed time get faster as they get bigger,
+        # so the read size grows until it reaches max_buffer_size.
+        data, sizes = self._read_sizes(COMPRESSED_XZ * 50,
+                                       clock_step=lambda n: 1.0,
+                                       buffer_size=64, max_buffer_size=1024)
+        self.assertEqual(data, INPUT * 50)
+        self.assertEqual(sizes[:lzma._ADAPT_READS], [64] * lzma._ADAPT_READS)
+        self.assertEqual(max(sizes), 1024)
+        self.assertIn(512, sizes)
+
+    def test_read_buffer_size_adaptive_no_gain(self):
+        # Reads that take time proportional to their size don't get faster,
+        # so the read size stops growing after the first doubling.
+        data, sizes = self._read_sizes(COMPRESSED_XZ * 50,
+                                       clock_step=lambda n: n * 1e-6,
+                                       buffer_size=64, max_buffer_size=1024)
+        self.assertEqual(data, INPUT * 50)
+        self.assertEqual(max(sizes), 128)
+
+    def test_read_buffer_size_adaptive_indexed(self):
+        # Growing reads must still stop at the end of each stream's blocks,
+        # so that the index can be used to skip stream padding.
+        cdata = (COMPRESSED_XZ + b"\0" * 4) * 20
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN, buffer_size=16,
+                          max_buffer_size=1 << 20) as f:
+                self.assertIsNotNone(f.index)
+                self.assertEqual(f.read(), INPUT * 20)
+                f.seek(len(INPUT) * 10 + 5)
+                self.assertEqual(f.read(), (INPUT * 10)[5:])
+
+    def test_read_mmap(self):
+        cdata = (COMPRESSED_XZ + b"\0" * 4) * 3 + COMPRESSED_XZ
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN, mmap=True) as f:
+                self.assertIsInstance(f._fp, lzma._MemoryFile)
+                self.assertEqual(f.fileno(), f._fp._fp.fileno())
+                self.assertEqual(f.read(), INPUT * 4)
+                f.seek(len(INPUT) + 10)
+                buf = bytearray(100)
+                self.assertEqual(f.readinto(buf), 100)
+                self.assertEqual(bytes(buf), INPUT[10:110])
+                fp = f._fp._fp
+            self.assertTrue(fp.closed)
+            with lzma.open(TESTFN, "rt", encoding="ascii", mmap=True) as f:
+                self.assertEqual(f.read(), (INPUT * 4).decode("ascii"))
+
+    def test_read_mmap_threads(self):
+        with TempFile(TESTFN, COMPRESSED_XZ * 4):
+            with LZMAFile(TESTFN, mmap=True, threads=2) as f:
+                self.assertEqual(f.read(), INPUT * 4)
+                f.seek(len(INPUT) * 2 + 3)
+                self.assertEqual(f.read(10), INPUT[3:13])
+
+    def test_read_mmap_empty(self):
+        with TempFile(TESTFN):
+            with LZMAFile(TESTFN, mmap=True) as f:
+                self.assertRaises(EOFError, f.read)
+
+    def test_mmap_bad_args(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          mmap=True)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w", mmap=True)
+
+    def _check_pread(self, f, data):
+        f.read(5)
+        for offset, size in [(0, 10), (0, len(data)), (499, 2), (700, 1000),
+                             (1, len(data) * 2), (len(data) - 1, 5),
+                             (len(data), 5), (len(data) + 10, 5), (30, 0)]:
+            self.assertEqual(f.pread(offset, size),
+                             data[offset:offset + size])
+        self.assertEqual(f.tell(), 5)
+        self.assertEqual(f.read(), data[5:])
+
+    def test_pread(self):
+        cdata = lzma.compress(INPUT, block_size=500)
+        cdata = cdata + b"\0" * 4 + cdata
+        with LZMAFile(BytesIO(cdata)) as f:
+            self._check_pread(f, INPUT * 2)
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN) as f:
+                self._check_pread(f, INPUT * 2)
+            with LZMAFile(TESTFN, mmap=True) as f:
+                self._check_pread(f, INPUT * 2)
+
+    def test_pread_threads(self):
+        from multiprocessing.pool import ThreadPool
+        data = INPUT * 20
+        ranges = [(i * 97, 1000) for i in range(len(data) // 97)]
+        with TempFile(TESTFN, lzma.compress(data, block_size=1000)):
+            with LZMAFile(TESTFN) as f:
+                pool = ThreadPool(4)
+                try:
+                    results = pool.map(lambda r: f.pread(*r), ranges)
+                finally:
+                    pool.terminate()
+        self.assertEqual(results, [data[o:o + n] for o, n in ranges])
+
+    def test_pread_bad_args(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertRaises(ValueError, f.pread, -1, 10)
+            self.assertRaises(ValueError, f.pread, 0, -1)
+        with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
+            self.assertRaises(UnsupportedOperation, f.pread, 0, 10)
+        with LZMAFile(BytesIO(), "w") as f:
+            self.assertRaises(UnsupportedOperation, f.pread, 0, 10)
+        f = LZMAFile(BytesIO(COMPRESSED_XZ))
+        f.close()
+        self.assertRaises(ValueError, f.pread, 0, 10)
+
+    def test_buffer_size_bad_args(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          buffer_size=0)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          buffer_size=1024, max_buffer_size=512)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          buffer_size=1024)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          max_buffer_size=1024)
+
     def test_read_from_file(self):
         with TempFile(TESTFN, COMPRESSED_XZ):
             with LZMAFile(TESTFN) as f:
@@ -720,6 +1332,68 @@ class FileTestCase(unittest.TestCase):
             self.assertEqual(b"".join(blocks), INPUT)
             self.assertEqual(f.read1(), b"")
 
+    def test_readinto(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2)) as f:
+            out = bytearray(len(INPUT) * 2 + 100)
+            self.assertEqual(f.readinto(out), len(INPUT) * 2)
+            self.assertEqual(bytes(out[:len(INPUT) * 2]), INPUT * 2)
+            self.assertEqual(f.readinto(out), 0)
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            out = bytearray(333)
+            chunks = []
+            n = f.readinto(memoryview(out))
+            while n:
+                chunks.append(bytes(out[:n]))
+                n = f.readinto(out)
+            self.assertEqual(b"".join(chunks), INPUT)
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            # Mix readinto() with the other read methods.
+            out = bytearray(100)
+            self.assertEqual(f.readinto(out), 100)
+            self.assertEqual(f.read(50), INPUT[100:150])
+            self.assertEqual(f.readinto(out), 100)
+            self.assertEqual(bytes(out), INPUT[150:250])
+            self.assertEqual(f.read(), INPUT[250:])
+
+    def test_readinto_non_byte_buffer(self):
+        from array import array
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            out = array("I", [0] * 10)
+            if sys.version_info < (3,):
+                # Python 2's memoryview cannot be cast to bytes.
+                self.assertRaises(TypeError, f.readinto, out)
+                return
+            self.assertEqual(f.readinto(out), 10 * out.itemsize)
+            self.assertEqual(bytes(memoryview(out).cast("B")),
+                             INPUT[:10 * out.itemsize])
+
+    def test_readinto_seek(self):
+        data = (COMPRESSED_XZ + b"\0" * 4) * 2 + COMPRESSED_XZ
+        with TempFile(TESTFN, data):
+            with LZMAFile(TESTFN) as f:
+                f.seek(len(INPUT) + 10)
+                out = bytearray(len(INPUT))
+                self.assertEqual(f.readinto(out), len(INPUT))
+                self.assertEqual(bytes(out), INPUT[10:] + INPUT[:10])
+                self.assertEqual(f.tell(), len(INPUT) * 2 + 10)
+            with LZMAFile(TESTFN, threads=2) as f:
+                f.seek(5)
+                out = bytearray(len(INPUT) * 3)
+                self.assertEqual(f.readinto(out), len(INPUT) * 3 - 5)
+                self.assertEqual(bytes(out[:-5]), INPUT[5:] + INPUT * 2)
+
+    def test_readinto1(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2)) as f:
+            out = bytearray(len(INPUT) * 2)
+            chunks = []
+            n = f.readinto1(out)
+            while n:
+                self.assertLessEqual(n, len(out))
+                chunks.append(bytes(out[:n]))
+                n = f.readinto1(out)
+            self.assertEqual(b"".join(chunks), INPUT * 2)
+            self.assertEqual(f.readinto1(out), 0)
+
     def test_read1_0(self):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             self.assertEqual(f.read1(0), b"")
@@ -767,6 +1441,25 @@ class FileTestCase(unittest.TestCase):
             self.assertTrue(INPUT.startswith(result))
             self.assertEqual(f.read(), INPUT)
 
+    def test_read_methods_mixed(self):
+        # Every read method picks up where the last one left the buffer.
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2)) as f:
+            self.assertEqual(f.read(3), INPUT[:3])
+            self.assertTrue(INPUT[3:].startswith(f.peek()))
+            self.assertEqual(f.read1(4), INPUT[3:7])
+            line_end = INPUT.index(b"\n", 7) + 1
+            self.assertEqual(f.readline(), INPUT[7:line_end])
+            self.assertEqual(f.readline(), b"\n")
+            line_end += 1
+            self.assertEqual(f.readline(2), INPUT[line_end:line_end + 2])
+            self.assertEqual(f.tell(), line_end + 2)
+            out = bytearray(5)
+            self.assertEqual(f.readinto(out), 5)
+            self.assertEqual(bytes(out), INPUT[line_end + 2:line_end + 7])
+            f.seek(len(INPUT) - 1)
+            self.assertEqual(f.readline(), INPUT[-1:])
+            self.assertEqual(f.read(), INPUT)
+
     def test_peek_bad_args(self):
         with LZMAFile(BytesIO(), "w") as f:
             self.assertRaises(ValueError, f.peek)
@@ -775,6 +1468,7 @@ class FileTestCase(unittest.TestCase):
         with BytesIO(INPUT) as f:
             lines = f.readlines()
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertIs(iter(f), f)
             self.assertEqual(list(iter(f)), lines)
         with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
             self.assertEqual(list(iter(f)), lines)
@@ -799,6 +1493,62 @@ class FileTestCase(unittest.TestCase):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             self.assertEqual(f.readlines(), lines)
 
+    # Lines of all lengths, crossing the boundaries of the readahead
+    # buffer, some of them holding b"\r".
+    LONG_LINES = b"".join(
+        (b"\r" if i % 5 == 0 else b"") + b"x" * (i * 37 % 10000) + b"\n"
+        for i in range(100)) + b"last line"
+
+    def test_readline_long_lines(self):
+        lines = BytesIO(self.LONG_LINES).readlines()
+        cdata = lzma.compress(self.LONG_LINES)
+        with LZMAFile(BytesIO(cdata)) as f:
+            self.assertEqual(list(f), lines)
+        with LZMAFile(BytesIO(cdata)) as f:
+            for line in lines:
+                self.assertEqual(f.readline(100), line[:100])
+                if len(line) > 100:
+                    self.assertEqual(f.readline(), line[100:])
+                self.assertEqual(f.readline(0), b"")
+            self.assertEqual(f.readline(), b"")
+            self.assertEqual(f.tell(), len(self.LONG_LINES))
+        with LZMAFile(BytesIO(cdata * 2)) as f:
+            # Reads in the middle of iterating pick up after the last line.
+            it = iter(f)
+            self.assertEqual([next(it) for i in range(3)], lines[:3])
+            self.assertEqual(f.tell(), len(b"".join(lines[:3])))
+            self.assertEqual(f.readline(), lines[3])
+            self.assertEqual(next(it), lines[4])
+            f.seek(len(self.LONG_LINES))
+            self.assertEqual(list(it), lines)
+        with LZMAFile(BytesIO(cdata)) as f:
+            self.assertEqual(next(f), lines[0])
+            self.assertEqual(f.read(10), b"".join(lines[1:])[:10])
+            self.assertEqual(f.readlines(), BytesIO(
+                b"".join(lines[1:])[10:]).readlines())
+
+    def test_readlines_batch(self):
+        lines = BytesIO(self.LONG_LINES).readlines()
+        cdata = lzma.compress(self.LONG_LINES)
+        with LZMAFile(BytesIO(cdata)) as f:
+            batches = []
+            while True:
+                batch = f.readlines_batch(20000)
+                if not batch:
+                    break
+                self.assertTrue(sum(map(len, batch[:-1])) < 20000)
+                self.assertTrue(sum(map(len, batch)) >= 20000 or
+                                batch[-1] == lines[-1])
+                batches.append(batch)
+            self.assertEqual(sum(batches, []), lines)
+            self.assertEqual(f.readlines_batch(), [])
+        with LZMAFile(BytesIO(cdata)) as f:
+            self.assertEqual(f.readlines(50000), BytesIO(
+                self.LONG_LINES).readlines(50000))
+            self.assertEqual(f.readlines_batch(1), [lines[len(
+                BytesIO(self.LONG_LINES).readlines(50000))]])
+            self.assertRaises(ValueError, f.readlines_batch, 0)
+
     def test_write(self):
         with BytesIO() as dst:
             with LZMAFile(dst, "w") as f:
@@ -831,6 +1581,41 @@ class FileTestCase(unittest.TestCase):
             expected = lzma.compress(INPUT)
             self.assertEqual(dst.getvalue(), expected)
 
+    def test_write_threads(self):
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", threads=2, block_size=1000) as f:
+                for start in range(0, len(INPUT), 300):
+                    f.write(INPUT[start:start+300])
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          block_size=1000)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          format=lzma.FORMAT_ALONE, threads=2)
+
+    def test_write_block_size(self):
+        with BytesIO() as dst:
+            f = LZMAFile(dst, "w", block_size=1000)
+            for start in range(0, len(INPUT), 300):
+                f.write(INPUT[start:start+300])
+            self.assertRaises(UnsupportedOperation, getattr, f, "index")
+            f.close()
+            written = list(f.index)
+            self.assertEqual(len(written), (len(INPUT) + 999) // 1000)
+            self.assertTrue(all(b.uncompressed_size == 1000
+                                for b in written[:-1]))
+            dst.seek(0)
+            self.assertEqual(written, list(lzma.XZIndex.from_file(dst)))
+            dst.seek(0)
+            with LZMAFile(dst) as f:
+                self.assertEqual(len(f.index), len(written))
+                f.seek(len(INPUT) - 500)
+                self.assertEqual(f.read(), INPUT[-500:])
+        with BytesIO() as dst:
+            f = LZMAFile(dst, "w", format=lzma.FORMAT_ALONE)
+            f.write(INPUT)
+            f.close()
+            self.assertRaises(ValueError, getattr, f, "index")
+
     def test_write_append(self):
         part1 = INPUT[:1024]
         part2 = INPUT[1024:1536]
@@ -948,6 +1733,21 @@ class FileTestCase(unittest.TestCase):
             f.seek(-150, 2)
             self.assertEqual(f.read(), INPUT[-150:])
 
+    def test_seek_before_start(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            f.seek(20)
+            self.assertEqual(f.seek(-30, 1), 0)
+            self.assertEqual(f.read(10), INPUT[:10])
+        with TempFile(TESTFN, COMPRESSED_XZ * 2):
+            # A named file, seeking with its index.
+            with LZMAFile(TESTFN) as f:
+                self.assertEqual(f.seek(-len(INPUT) * 2 - 7, 2), 0)
+                self.assertEqual(f.read(7), INPUT[:7])
+                self.assertEqual(f.read(3), INPUT[7:10])
+                f.seek(len(INPUT) + 5)
+                self.assertEqual(f.seek(-len(INPUT) - 10, 1), 0)
+                self.assertEqual(f.read(10), INPUT[:10])
+
     def test_seek_past_end(self):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             f.seek(len(INPUT) + 9001)
@@ -960,6 +1760,68 @@ class FileTestCase(unittest.TestCase):
             self.assertEqual(f.tell(), 0)
             self.assertEqual(f.read(), INPUT)
 
+    def test_seek_offsets(self):
+        with TempFile(TESTFN, COMPRESSED_XZ * 2):
+            with LZMAFile(TESTFN) as f:
+                self.assertEqual(f.seek_offsets(), [0, len(INPUT)])
+                f.seek(0, 2)
+                self.assertEqual(f.tell(), len(INPUT) * 2)
+        with LZMAFile(BytesIO(COMPRESSED_XZ + b"\0" * 8)) as f:
+            self.assertEqual(f.seek_offsets(), [0])
+            self.assertEqual(f.read(), INPUT)
+        with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
+            self.assertEqual(f.seek_offsets(), [])
+            self.assertEqual(f.read(), INPUT)
+
+    def test_seek_across_padded_streams(self):
+        padded = COMPRESSED_XZ + b"\0" * 4
+        with TempFile(TESTFN, padded * 2 + COMPRESSED_XZ):
+            with LZMAFile(TESTFN) as f:
+                self.assertEqual(f.read(), INPUT * 3)
+                f.seek(len(INPUT) * 2 + 100)
+                self.assertEqual(f.read(50), INPUT[100:150])
+                f.seek(len(INPUT) - 10)
+                self.assertEqual(f.read(), INPUT[-10:] + INPUT * 2)
+
+    def test_seek_skips_earlier_streams(self):
+        # Damage the first stream's block: seeking into later streams must
+        # not need to decompress it.
+        damaged = bytearray(COMPRESSED_XZ)
+        damaged[100:110] = b"\xff" * 10
+        with TempFile(TESTFN, bytes(damaged) + COMPRESSED_XZ * 2):
+            with LZMAFile(TESTFN) as f:
+                f.seek(len(INPUT) * 2 + 123)
+                self.assertEqual(f.read(), INPUT[123:])
+                f.seek(len(INPUT) + 1)
+                self.assertEqual(f.read(10), INPUT[1:11])
+
+    def test_read_threads(self):
+        data = (COMPRESSED_XZ + b"\0" * 4) * 3 + COMPRESSED_XZ
+        with TempFile(TESTFN, data):
+            with LZMAFile(TESTFN, threads=3) as f:
+                self.assertEqual(f.read(), INPUT * 4)
+                f.seek(len(INPUT) * 2 + 10)
+                self.assertEqual(f.read(20), INPUT[10:30])
+                f.seek(5)
+                chunks = []
+                while True:
+                    result = f.read(777)
+                    if not result:
+                        break
+                    chunks.append(result)
+                self.assertEqual(b"".join(chunks), INPUT[5:] + INPUT * 3)
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2), threads=2) as f:
+            self.assertEqual(f.read(), INPUT * 2)
+        # Files that can't be indexed are decompressed sequentially.
+        with LZMAFile(BytesIO(COMPRESSED_ALONE), threads=2) as f:
+            self.assertEqual(f.read(), INPUT)
+
+    def test_read_threads_unseekable(self):
+        cdata = lzma.compress(INPUT, threads=2, block_size=1000)
+        with LZMAFile(Unseekable(BytesIO(cdata * 2)),
+                      format=lzma.FORMAT_XZ, threads=2) as f:
+            self.assertEqual(f.read(), INPUT * 2)
+
     def test_seek_bad_args(self):
         f = LZMAFile(BytesIO(COMPRESSED_XZ))
         f.close()
@@ -994,6 +1856,411 @@ class FileTestCase(unittest.TestCase):
         self.assertRaises(ValueError, f.tell)
 
 
+class XZIndexTestCase(unittest.TestCase):
+
+    def test_from_file(self):
+        data = COMPRESSED_XZ + b"\0" * 8 + COMPRESSED_XZ
+        index = lzma.XZIndex.from_file(BytesIO(data))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.block_count, 2)
+        self.assertEqual(index.stream_count, 2)
+        self.assertEqual(index.uncompressed_size, len(INPUT) * 2)
+        self.assertEqual(index.compressed_size, len(data))
+
+        streams = list(index.streams())
+        self.assertEqual([s.compressed_offset for s in streams],
+                         [0, len(COMPRESSED_XZ) + 8])
+        self.assertEqual([s.padding for s in streams], [8, 0])
+        self.assertEqual([s.check for s in streams], [lzma.CHECK_CRC64] * 2)
+        self.assertEqual([s.uncompressed_size for s in streams],
+                         [len(INPUT)] * 2)
+
+        blocks = list(index)
+        self.assertEqual([b.number for b in blocks], [0, 1])
+        self.assertEqual([b.stream for b in blocks], [0, 1])
+        self.assertEqual([b.uncompressed_offset for b in blocks],
+                         [0, len(INPUT)])
+        self.assertEqual(blocks[1].compressed_offset,
+                         len(COMPRESSED_XZ) + 8 + 12)
+        self.assertEqual(index.block(-1), blocks[1])
+        self.assertRaises(IndexError, index.block, 2)
+
+    def test_from_file_bad_input(self):
+        self.assertRaises(lzma.LZMAError, lzma.XZIndex.from_file,
+                          BytesIO(COMPRESSED_ALONE))
+        self.assertRaises(lzma.LZMAError, lzma.XZIndex.from_file,
+                          BytesIO(COMPRESSED_XZ[1:]))
+        self.assertRaises(lzma.LZMAError, lzma.XZIndex.from_file,
+                          BytesIO(b"\0" * 4 + COMPRESSED_XZ))
+
+    def test_locate(self):
+        index = lzma.XZIndex.from_file(BytesIO(COMPRESSED_XZ * 3))
+        self.assertEqual(index.locate(0), 0)
+        self.assertEqual(index.locate(len(INPUT) - 1), 0)
+        self.assertEqual(index.locate(len(INPUT)), 1)
+        self.assertEqual(index.locate(len(INPUT) * 2 + 5), 2)
+        self.assertEqual(index.locate(len(INPUT) * 10), 2)
+        self.assertRaises(ValueError, index.locate, -1)
+
+    def test_tobytes_frombytes(self):
+        index = lzma.XZIndex.from_file(
+            BytesIO(COMPRESSED_XZ + b"\0" * 4 + COMPRESSED_XZ))
+        copy = lzma.XZIndex.frombytes(index.tobytes())
+        self.assertEqual(list(copy), list(index))
+        self.assertEqual(list(copy.streams()), list(index.streams()))
+        self.assertEqual(copy.compressed_size, index.compressed_size)
+        self.assertEqual(copy.uncompressed_size, index.uncompressed_size)
+        self.assertRaises(ValueError, lzma.XZIndex.frombytes,
+                          index.tobytes()[:-1])
+        self.assertRaises(ValueError, lzma.XZIndex.frombytes, b"junk")
+
+    def _check_index_cache(self, index_cache, cache_path):
+        saved_from_file = lzma.XZIndex.from_file
+        try:
+            with TempFile(TESTFN, COMPRESSED_XZ * 2):
+                with LZMAFile(TESTFN, index_cache=index_cache) as f:
+                    self.assertEqual(len(f.index), 2)
+                self.assertTrue(os.path.exists(cache_path))
+
+                # A cache hit doesn't parse the file's indexes at all.
+                def fail(fp):
+                    raise AssertionError("index should come from the cache")
+                lzma.XZIndex.from_file = staticmethod(fail)
+                with LZMAFile(TESTFN, index_cache=index_cache) as f:
+                    self.assertEqual(len(f.index), 2)
+                    f.seek(len(INPUT) + 10)
+                    self.assertEqual(f.read(10), INPUT[10:20])
+                lzma.XZIndex.from_file = saved_from_file
+
+            # A changed file invalidates the cache.
+            with TempFile(TESTFN, COMPRESSED_XZ * 3):
+                with LZMAFile(TESTFN, index_cache=index_cache) as f:
+                    self.assertEqual(len(f.index), 3)
+        finally:
+            lzma.XZIndex.from_file = saved_from_file
+            unlink(cache_path)
+
+    def test_index_cache_sidecar(self):
+        self._check_index_cache(True, TESTFN + ".xzidx")
+
+    def test_index_cache_directory(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            digest = hashlib.sha1(
+                os.path.abspath(TESTFN).encode("utf-8")).hexdigest()
+            self._check_index_cache(
+                cache_dir, os.path.join(cache_dir, digest + ".xzidx"))
+            with TempFile(TESTFN, COMPRESSED_XZ):
+                with lzma.open(TESTFN, "rt", encoding="ascii",
+                               index_cache=cache_dir) as f:
+                    self.assertEqual(f.read(), INPUT.decode("ascii"))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_index_cache_mmap(self):
+        cache_path = TESTFN + ".xzidx"
+        try:
+            with TempFile(TESTFN, COMPRESSED_XZ * 2):
+                with LZMAFile(TESTFN, mmap=True, index_cache=True) as f:
+                    self.assertEqual(len(f.index), 2)
+                    self.assertEqual(f.read(), INPUT * 2)
+                self.assertTrue(os.path.exists(cache_path))
+                # The cache is shared with files opened without mmap.
+                with open(cache_path, "rb") as cache:
+                    cached = cache.read()
+                with LZMAFile(TESTFN, index_cache=True) as f:
+                    self.assertEqual(len(f.index), 2)
+                with open(cache_path, "rb") as cache:
+                    self.assertEqual(cache.read(), cached)
+                with LZMAFile(TESTFN, mmap=True, index_cache=True) as f:
+                    f.seek(len(INPUT) + 10)
+                    self.assertEqual(f.read(10), INPUT[10:20])
+        finally:
+            unlink(cache_path)
+
+    def test_lzmafile_index(self):
+        with TempFile(TESTFN, COMPRESSED_XZ * 2):
+            with LZMAFile(TESTFN) as f:
+                self.assertEqual(len(f.index), 2)
+                self.assertEqual(f.index.uncompressed_size, len(INPUT) * 2)
+        with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
+            self.assertIsNone(f.index)
+        with LZMAFile(BytesIO(), "w") as f:
+            self.assertRaises(UnsupportedOperation, getattr, f, "index")
+
+
+class BlockCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = lzma.BlockCache(10)
+        cache._put("a", b"aaaa")
+        cache._put("b", b"bbbb")
+        self.assertEqual(cache._get("a"), b"aaaa")
+        cache._put("c", b"cccc")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+        self.assertIsNone(cache._get("b"))
+        self.assertEqual(cache._get("c"), b"cccc")
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache._put("d", b"d" * 11)
+        self.assertIsNone(cache._get("d"))
+        cache.clear()
+        self.assertEqual((len(cache), cache.size, cache.hits, cache.misses),
+                         (0, 0, 0, 0))
+
+    def test_bad_args(self):
+        self.assertRaises(ValueError, lzma.BlockCache, -1)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          block_cache=lzma.BlockCache(100))
+
+    def test_read_named_file(self):
+        cache = lzma.BlockCache(1 << 20)
+        with TempFile(TESTFN, lzma.compress(INPUT, block_size=500)):
+            with LZMAFile(TESTFN, block_cache=cache) as f:
+                self.assertEqual(f.read(), INPUT)
+            self.assertEqual((cache.hits, cache.misses), (0, 4))
+            self.assertEqual(cache.size, len(INPUT))
+            # Reopening the file finds its blocks in the cache.
+            with lzma.open(TESTFN, block_cache=cache) as f:
+                f.seek(1200)
+                self.assertEqual(f.read(100), INPUT[1200:1300])
+                f.seek(10)
+                self.assertEqual(f.read(), INPUT[10:])
+                self.assertEqual(f.pread(600, 900), INPUT[600:1500])
+            self.assertEqual((cache.hits, cache.misses), (7, 4))
+
+    def test_read_file_object(self):
+        cache = lzma.BlockCache(1 << 20)
+        cdata = lzma.compress(INPUT, block_size=500) + COMPRESSED_XZ
+        with LZMAFile(BytesIO(cdata), block_cache=cache) as f:
+            self.assertEqual(f.read(), INPUT * 2)
+            f.seek(len(INPUT) + 10)
+            buf = bytearray(100)
+            self.assertEqual(f.readinto(buf), 100)
+            self.assertEqual(bytes(buf), INPUT[10:110])
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        # Other file objects don't share entries, even with the same data.
+        with LZMAFile(BytesIO(cdata), block_cache=cache) as f:
+            self.assertEqual(f.read(), INPUT * 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 10))
+
+    def test_read_threads(self):
+        cache = lzma.BlockCache(1 << 20)
+        with TempFile(TESTFN, lzma.compress(INPUT, block_size=500)):
+            for i in range(2):
+                with LZMAFile(TESTFN, threads=2, block_cache=cache) as f:
+                    self.assertEqual(f.read(), INPUT)
+                    f.seek(700)
+                    self.assertEqual(f.read(10), INPUT[700:710])
+        # Seeking restarts the readahead from block 1, so blocks 1-3 are
+        # looked up again after each seek.
+        self.assertEqual((cache.hits, cache.misses), (10, 4))
+
+    def test_eviction(self):
+        cache = lzma.BlockCache(1000)
+        with TempFile(TESTFN, lzma.compress(INPUT, block_size=500)):
+            with LZMAFile(TESTFN, block_cache=cache) as f:
+                self.assertEqual(f.read(), INPUT)
+                self.assertLessEqual(cache.size, 1000)
+                self.assertEqual(f.pread(0, 10), INPUT[:10])
+        self.assertEqual(cache.hits, 0)
+
+    def test_not_indexed(self):
+        cache = lzma.BlockCache(1 << 20)
+        with LZMAFile(BytesIO(COMPRESSED_ALONE), block_cache=cache) as f:
+            self.assertEqual(f.read(), INPUT)
+        self.assertEqual(len(cache), 0)
+
+
+class LineIndexTestCase(unittest.TestCase):
+
+    # Lines of varying length, some empty, with no line end at the end.
+    TEXT = "".join("line %d%s\n" % (i, "x" * (i % 13)) if i % 7 else "\n"
+                   for i in range(300)).encode("ascii") + b"no newline"
+    LINES = TEXT.splitlines(True)
+
+    def _check_lines(self, f):
+        for n in range(len(self.LINES) + 2):
+            self.assertEqual(f.seek_line(n), len(b"".join(self.LINES[:n])))
+            self.assertEqual(f.readline(), (self.LINES[n:] or [b""])[0])
+        self.assertEqual(f.read_lines(10, 20), self.LINES[10:20])
+        self.assertEqual(f.tell(), len(b"".join(self.LINES[:20])))
+        self.assertEqual(f.read_lines(295, 400), self.LINES[295:])
+        self.assertEqual(f.read_lines(5, 5), [])
+
+    def test_seek_line(self):
+        cdata = lzma.compress(self.TEXT, block_size=700)
+        for interval in (0, 1, 3, 1000):
+            for workers in (1, 3):
+                with LZMAFile(BytesIO(cdata)) as f:
+                    lines = f.build_line_index(interval, workers=workers)
+                    self.assertIs(f.line_index, lines)
+                    self.assertEqual(lines.line_count, len(self.LINES))
+                    self._check_lines(f)
+
+    def test_seek_line_default_index(self):
+        cdata = lzma.compress(self.TEXT[:-10], block_size=100)
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN, block_cache=lzma.BlockCache(1 << 20)) as f:
+                self.assertEqual(f.line_index.line_count, len(self.LINES) - 1)
+                self.assertEqual(f.line_index.checkpoint_interval, 0)
+                self.assertEqual(f.read_lines(100, 102), self.LINES[100:102])
+            with LZMAFile(TESTFN, threads=2) as f:
+                self.assertEqual(f.read_lines(250, 252), self.LINES[250:252])
+
+    def test_tobytes(self):
+        cdata = lzma.compress(self.TEXT, block_size=700)
+        with LZMAFile(BytesIO(cdata)) as f:
+            lines = f.build_line_index(5)
+            data = lines.tobytes()
+        copy = lzma.LineIndex.frombytes(data)
+        self.assertEqual(copy.tobytes(), data)
+        self.assertEqual(copy.line_count, len(self.LINES))
+        self.assertEqual(copy.checkpoint_interval, 5)
+        self.assertRaises(ValueError, lzma.LineIndex.frombytes, data[:-1])
+        self.assertRaises(ValueError, lzma.LineIndex.frombytes, data + b"x")
+        self.assertRaises(ValueError, lzma.LineIndex.frombytes, b"XZIx")
+
+    def test_line_index_cache(self):
+        cache_path = TESTFN + ".xzlines"
+        cdata = lzma.compress(self.TEXT, block_size=700)
+        try:
+            with TempFile(TESTFN, cdata):
+                with LZMAFile(TESTFN, index_cache=True) as f:
+                    f.build_line_index(10)
+                self.assertTrue(os.path.exists(cache_path))
+                saved_from_file = lzma.LineIndex.from_file
+                def from_file(*args):
+                    raise AssertionError("line index rebuilt")
+                lzma.LineIndex.from_file = from_file
+                try:
+                    with LZMAFile(TESTFN, index_cache=True) as f:
+                        f.build_line_index(10)
+                        self._check_lines(f)
+                finally:
+                    lzma.LineIndex.from_file = saved_from_file
+                # A different checkpoint interval rebuilds the index.
+                with LZMAFile(TESTFN, index_cache=True) as f:
+                    self.assertEqual(f.build_line_index(0)
+                                     .checkpoint_interval, 0)
+        finally:
+            unlink(cache_path)
+
+    def test_bad_args(self):
+        with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
+            self.assertRaises(UnsupportedOperation, f.seek_line, 1)
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertRaises(ValueError, f.seek_line, -1)
+            self.assertRaises(ValueError, f.build_line_index, -1)
+        with LZMAFile(BytesIO(), "w") as f:
+            self.assertRaises(UnsupportedOperation, f.seek_line, 0)
+
+
+@unittest.skipUnless(hasattr(lzma, "AsyncLZMAFile"), "requires Python 3.6")
+class AsyncTestCase(unittest.TestCase):
+
+    # The coroutines are driven by hand, to keep this file importable on
+    # versions of Python without async syntax.
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        import asyncio
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _run(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def _collect(self, aiter):
+        items = []
+        while True:
+            try:
+                items.append(self._run(aiter.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def test_read(self):
+        f = lzma.AsyncLZMAFile(BytesIO(COMPRESSED_XZ * 2), chunk_size=100)
+        self.assertEqual(self._run(f.read(10)), INPUT[:10])
+        self.assertEqual(self._run(f.readline()), INPUT[10:].splitlines(True)[0])
+        pos = f.tell()
+        self.assertEqual(self._run(f.read(500)), INPUT[pos:pos + 500])
+        self.assertEqual(self._run(f.read(0)), b"")
+        self.assertEqual(self._run(f.read()), (INPUT * 2)[pos + 500:])
+        self.assertEqual(self._run(f.read()), b"")
+        self.assertEqual(f.tell(), len(INPUT) * 2)
+        self._run(f.aclose())
+        self.assertTrue(f.closed)
+        self._run(f.aclose())
+
+    def test_readline(self):
+        f = lzma.AsyncLZMAFile(BytesIO(COMPRESSED_XZ), chunk_size=7)
+        lines = INPUT.splitlines(True)
+        self.assertEqual(self._run(f.readline()), lines[0])
+        self.assertEqual(self._run(f.readline(5)), lines[1][:5])
+        self.assertEqual(self._run(f.readline()), lines[1][5:])
+        self.assertEqual(self._collect(f), lines[2:])
+        self.assertEqual(self._run(f.readline()), b"")
+        self._run(f.aclose())
+
+    def test_close_with_readahead(self):
+        f = lzma.AsyncLZMAFile(BytesIO(COMPRESSED_XZ), chunk_size=10)
+        self.assertEqual(self._run(f.read(5)), INPUT[:5])
+        self.assertIsNotNone(f._pending)
+        self._run(f.aclose())
+        self.assertTrue(f.closed)
+
+    def test_write(self):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(2)
+        try:
+            with BytesIO() as bio:
+                f = lzma.AsyncLZMAFile(bio, "w", executor=executor,
+                                       chunk_size=100)
+                self.assertIs(self._run(f.__aenter__()), f)
+                self.assertEqual(self._run(f.write(INPUT)), len(INPUT))
+                self.assertEqual(self._run(f.write(memoryview(INPUT))),
+                                 len(INPUT))
+                self.assertEqual(f.tell(), len(INPUT) * 2)
+                self._run(f.__aexit__(None, None, None))
+                self.assertTrue(f.closed)
+                self.assertEqual(lzma.decompress(bio.getvalue()), INPUT * 2)
+        finally:
+            executor.shutdown()
+
+    def test_bad_args(self):
+        self.assertRaises(ValueError, lzma.AsyncLZMAFile,
+                          BytesIO(COMPRESSED_XZ), chunk_size=0)
+
+    def _stream(self, data):
+        import asyncio
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def test_async_decompress_stream(self):
+        reader = self._stream(COMPRESSED_XZ * 2 + COMPRESSED_ALONE)
+        chunks = self._collect(lzma.async_decompress_stream(
+            reader, chunk_size=100, read_size=50))
+        self.assertEqual(b"".join(chunks), INPUT * 3)
+        self.assertLessEqual(max(map(len, chunks)), 100)
+        reader = self._stream(COMPRESSED_RAW_1)
+        chunks = self._collect(lzma.async_decompress_stream(
+            reader, lzma.FORMAT_RAW, filters=FILTERS_RAW_1))
+        self.assertEqual(b"".join(chunks), INPUT)
+
+    def test_async_decompress_stream_bad_data(self):
+        for data in (b"", COMPRESSED_XZ[:-20], b"not compressed data"):
+            gen = lzma.async_decompress_stream(self._stream(data))
+            self.assertRaises(LZMAError, self._collect, gen)
+
+
 class OpenTestCase(unittest.TestCase):
 
     def test_binary_modes(self):
@@ -1150,6 +2417,78 @@ class MiscellaneousTestCase(unittest.TestCase):
         spec2 = lzma._decode_filter_properties(lzma.FILTER_LZMA1, reencoded)
         self.assertEqual(spec1, spec2)
 
+    def test__decode_stream_footer(self):
+        self.assertRaises(ValueError, lzma._decode_stream_footer, b"short")
+        self.assertRaises(lzma.LZMAError, lzma._decode_stream_footer,
+                          COMPRESSED_XZ[:12])
+        backward_size, check = lzma._decode_stream_footer(COMPRESSED_XZ[-12:])
+        self.assertEqual(check, lzma.CHECK_CRC64)
+        self.assertEqual(backward_size % 4, 0)
+
+    def test__decode_index(self):
+        backward_size, _ = lzma._decode_stream_footer(COMPRESSED_XZ[-12:])
+        index = COMPRESSED_XZ[-12 - backward_size:-12]
+        stream_size, uncompressed_size, blocks = lzma._decode_index(index)
+        self.assertEqual(stream_size, len(COMPRESSED_XZ))
+        self.assertEqual(uncompressed_size, len(INPUT))
+        self.assertEqual(len(blocks), 1)
+        c_off, u_off, c_size, u_size = blocks[0]
+        self.assertEqual((c_off, u_off, u_size), (12, 0, len(INPUT)))
+        self.assertEqual(c_off + c_size + backward_size + 12,
+                         len(COMPRESSED_XZ))
+        self.assertRaises(lzma.LZMAError, lzma._decode_index, index[:-1])
+
+    def test__compress_buffer(self):
+        for kwargs in ({}, {"preset": 1, "check": lzma.CHECK_SHA256},
+                       {"filters": FILTERS_RAW_4, "check": lzma.CHECK_NONE}):
+            lzc = LZMACompressor(**kwargs)
+            expected = lzc.compress(INPUT) + lzc.flush()
+            self.assertEqual(lzma._compress_buffer(INPUT, **kwargs), expected)
+        lzc = LZMACompressor()
+        self.assertEqual(lzma._compress_buffer(b""), lzc.flush())
+        self.assertRaises(ValueError, lzma._compress_buffer, INPUT,
+                          preset=1, filters=FILTERS_RAW_4)
+        self.assertRaises(LZMAError, lzma._compress_buffer, INPUT,
+                          check=lzma.CHECK_UNKNOWN)
+        self.assertRaises(TypeError, lzma._compress_buffer, INPUT, preset="1")
+        self.assertRaises(TypeError, lzma._compress_buffer, INPUT, preset=1.0)
+
+    def test__decompress_sized(self):
+        self.assertEqual(lzma._decompress_sized(COMPRESSED_XZ * 2,
+                                                lzma.FORMAT_XZ,
+                                                len(INPUT) * 2),
+                         INPUT * 2)
+        self.assertEqual(lzma._decompress_sized(COMPRESSED_XZ + COMPRESSED_ALONE,
+                                                lzma.FORMAT_AUTO,
+                                                len(INPUT) * 2),
+                         INPUT * 2)
+        for size in (len(INPUT) - 1, len(INPUT) + 1, 0):
+            self.assertRaises(LZMAError, lzma._decompress_sized,
+                              COMPRESSED_XZ, lzma.FORMAT_XZ, size)
+        self.assertRaises(LZMAError, lzma._decompress_sized,
+                          COMPRESSED_XZ, lzma.FORMAT_XZ, len(INPUT), 1024)
+        self.assertRaises(LZMAError, lzma._decompress_sized,
+                          COMPRESSED_XZ[:-1], lzma.FORMAT_XZ, len(INPUT))
+        self.assertRaises(ValueError, lzma._decompress_sized,
+                          COMPRESSED_XZ, lzma.FORMAT_RAW, len(INPUT))
+
+    def test__merge_indexes(self):
+        backward_size, check = lzma._decode_stream_footer(COMPRESSED_XZ[-12:])
+        index = COMPRESSED_XZ[-12 - backward_size:-12]
+        self.assertEqual(lzma._merge_indexes([index]), index)
+        merged = lzma._merge_indexes([index, index])
+        _, uncompressed_size, blocks = lzma._decode_index(merged)
+        self.assertEqual(uncompressed_size, len(INPUT) * 2)
+        self.assertEqual(len(blocks), 2)
+        self.assertRaises(lzma.LZMAError, lzma._merge_indexes, [index[:-1]])
+        self.assertRaises(TypeError, lzma._merge_indexes, None)
+
+    def test__encode_stream_footer(self):
+        backward_size, check = lzma._decode_stream_footer(COMPRESSED_XZ[-12:])
+        self.assertEqual(lzma._encode_stream_footer(backward_size, check),
+                         COMPRESSED_XZ[-12:])
+        self.assertRaises(lzma.LZMAError, lzma._encode_stream_footer, 3, check)
+
 
 # Test data:
 
@@ -1543,6 +2882,10 @@ def test_main():
         CompressorDecompressorTestCase,
         CompressDecompressFunctionTestCase,
         FileTestCase,
+        XZIndexTestCase,
+        BlockCacheTestCase,
+        LineIndexTestCase,
+        AsyncTestCase,
         OpenTestCase,
         MiscellaneousTestCase,
     )